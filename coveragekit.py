@@ -3,6 +3,10 @@
 import sys
 import coveragekit.covdb as covdb
 import coveragekit.covbam as covbam
+import coveragekit.covcohort as covcohort
+import coveragekit.covserve as covserve
+import coveragekit.covstore as covstore
+import coveragekit.covbatch as covbatch
 
 from coveragekit.version import __version__
 
@@ -11,14 +15,26 @@ coveragekit - v{}
 coveragekit.py <command> [options]
 
 bam     import bam data
+batch   import many bam files on one worker pool
 db      work with coverage database
+cohort  build and query a multi-sample cohort store
+serve   answer db queries from a long-running local server
+store   re-evaluate region files from a saved depth store
 '''.format(__version__)
 
 try:
     if sys.argv[1] == "bam":
         covbam.run(sys.argv[2:])
+    elif sys.argv[1] == "batch":
+        covbatch.run(sys.argv[2:])
     elif sys.argv[1] == "db":
         covdb.run(sys.argv[2:])
+    elif sys.argv[1] == "cohort":
+        covcohort.run(sys.argv[2:])
+    elif sys.argv[1] == "serve":
+        covserve.run(sys.argv[2:])
+    elif sys.argv[1] == "store":
+        covstore.run(sys.argv[2:])
     else:
         print usage
         sys.exit(1)
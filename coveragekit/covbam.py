@@ -1,16 +1,43 @@
 #!/usr/bin/env python
 
-import sys, optparse, json, datetime, logging, math
+import sys, os, optparse, json, datetime, logging, traceback, heapq, Queue, hashlib, cPickle
 import pysam
 import coveragekit.utils.region as covregion
 import coveragekit.utils.db as covdb
 import coveragekit.utils.bed as covbed
-from coveragekit.utils.bam import BamReader,BamReaderAggregate,ProcessingRegionGenerator
+import coveragekit.utils.bamindex as covbamindex
+import coveragekit.utils.depthstore as covdepthstore
+import coveragekit.utils.bedgraph as covbedgraph
+from coveragekit.utils.bam import BamReader,BamReaderAggregate,ProcessingRegionGenerator,countReads
 
-from multiprocessing import Pool
+from multiprocessing import Pool, RawArray
 
 from coveragekit.version import __version__
 
+# Shared array of three longs per job slot (position reached, stop requested by the parent, stop accepted by the reader), set in every worker by _initWorker
+_splitState = None
+
+def _initWorker(splitState):
+    '''Pool initializer handing the shared split array to a worker.'''
+    global _splitState
+    _splitState = splitState
+
+class _SharedSplitter(object):
+    '''Splitter handed to a :class:`BamReader` in a worker, it talks to the parent through the three slots of the shared split array that
+    belong to the job.
+
+    '''
+    
+    def check(self, position):
+        _splitState[self.offset] = position
+        return _splitState[self.offset + 1]
+    
+    def answer(self, stop):
+        _splitState[self.offset + 2] = stop
+    
+    def __init__(self, slot):
+        self.offset = 3 * slot
+
 def _readBamRegion(inputs):
     bam = inputs[0]
     levels = inputs[1]
@@ -18,23 +45,367 @@ def _readBamRegion(inputs):
     mapq = inputs[3]
     dups = inputs[4]
     genome = inputs[5]
-    startTime = inputs[6]
-    totalRegions = inputs[7]
+    readIds = inputs[6]
+    targetFetch = inputs[7]
+    targetPadding = inputs[8]
+    slot = inputs[9]
+    keepDepthRuns = inputs[10]
     
-    logger = logging.getLogger("bam reader thread")
-    logger.setLevel(logging.INFO)
-    
-    updateSize = math.floor(totalRegions/float(100))
-    if (regions[0].index % updateSize == 0) and (regions[0].index > 0):
-        now = datetime.datetime.now()
-        timeDiff = now - startTime
-        remainingRegions = totalRegions - (regions[0].index +1)
-        logger.info("Processing region {}\tTime elapsed - {:.2f}m\tTime remaining - {:.2f}m".format(regions[0].index, (timeDiff.seconds/60.0), ((timeDiff.seconds/float(regions[0].index+1))*remainingRegions)/60.0))
-    bamRegion = BamReader(bam, regions, levels, mapq, dups, genome)
+    splitter = None
+    if (_splitState is not None) and (slot is not None):
+        splitter = _SharedSplitter(slot)
+        splitter.check(regions[0].start)
+    bamRegion = BamReader(bam, regions, levels, mapq, dups, genome, readIds, targetFetch, targetPadding, splitter, keepDepthRuns)
     bamRegion.read()
     return bamRegion.report()
 
-def bam(bamInput, regions, databases, levels, windowSize, threads, mapq, dups, genome):
+def _countBamReads(inputs):
+    '''Wraps :func:`countReads` for use with a worker pool.'''
+    return countReads(inputs[0], inputs[1], inputs[2], inputs[3])
+
+def _readBamRegionIndexed(inputs):
+    '''Wraps :func:`_readBamRegion` so that the job slot travels with its result and a failure is handed back to the parent instead of being lost in the worker.'''
+    slot = inputs[0]
+    try:
+        return (slot, _readBamRegion(inputs[1]), None)
+    except Exception:
+        return (slot, None, traceback.format_exc())
+
+def _clipJob(job, start, stop):
+    '''Returns the part of a job between start and stop as a job of its own, with its subregions clipped, the precedingStops it would have had
+    as a processing region of its own and its share of the cost. Any fields of the job past the cost are kept.'''
+    region, subregions, precedingStops, cost = job[:4]
+    clippedRegion = covregion.Region(region.chrom, start, stop, region.name, region.regionSet, region.index)
+    clippedSubregions = []
+    clippedStops = dict(precedingStops)
+    for s in subregions:
+        if (s.stop > start) and (s.start < stop):
+            clippedSubregions.append(covregion.Region(s.chrom, max(s.start, start), min(s.stop, stop), s.name, s.regionSet, s.index))
+        if (s.start < start) and (s.stop > clippedStops.get(s.regionSet, s.stop - 1)):
+            clippedStops[s.regionSet] = s.stop
+    return (clippedRegion, clippedSubregions, clippedStops, cost * (stop - start) / float(region.stop - region.start)) + tuple(job[4:])
+
+class JobScheduler(object):
+    '''Class that runs the processing regions of a bam file on a worker pool, largest estimated cost first, and yields the chunk reports as
+    they finish.
+    
+    Jobs are pulled from the plan as they are needed and at most maxQueued of them wait in the queue, so the parent never holds the
+    subregions of the whole plan. The plan is expected to give its jobs largest first, such as the jobs made by
+    :meth:`ProcessingRegionGenerator.processingRegionJob` for the processing regions sorted by cost, and the queue keeps that order along
+    with the parts split off running jobs.
+    
+    Once every job has been handed out, workers going idle would leave the run waiting on the last few large jobs. Each idle worker is
+    then given half of what is left of the running job with the most work remaining: the parent asks the reader, through the shared split
+    array, to stop at a position past the one it has reached. If the reader accepts, the rest of the region becomes a new job with its
+    subregions clipped, and with the precedingStops it would have had as a processing region of its own. A reader that has already gone
+    past the requested stop refuses, and that job is not split again.
+    
+    Jobs can also be given a priority, lower first, that is ranked before their cost, so that the jobs of a batch of bam files are read
+    one bam after the other and the reports of each bam are complete as early as possible.
+    
+    '''
+    
+    def _push(self, job, cost):
+        heapq.heappush(self.queue, (self.priority(job), -cost, self.pushed, job))
+        self.pushed += 1
+    
+    def _fill(self, ):
+        while (self.jobs is not None) and (len(self.queue) < self.maxQueued):
+            try:
+                job = next(self.jobs)
+            except StopIteration:
+                self.jobs = None
+                break
+            self._push(job, job[3])
+    
+    def _submit(self, ):
+        while (len(self.queue) > 0) and (len(self.freeSlots) > 0):
+            priority, negativeCost, order, job = heapq.heappop(self.queue)
+            slot = self.freeSlots.pop()
+            self.splitState[3 * slot] = -1
+            self.splitState[3 * slot + 1] = 0
+            self.splitState[3 * slot + 2] = 0
+            self.running[slot] = {"job" : job, "stop" : job[0].stop, "cost" : -negativeCost, "splittable" : True}
+            self.workers.apply_async(_readBamRegionIndexed, ((slot, self.makeInputs(job, slot)),), callback=self.finished.put)
+    
+    def _split(self, slot, stop):
+        '''Turns the part of the job in slot past stop into a new job.'''
+        running = self.running[slot]
+        remainder = _clipJob(running["job"], stop, running["stop"])
+        running["cost"] -= remainder[3]
+        running["stop"] = stop
+        self._push(remainder, remainder[3])
+    
+    def _poll(self, ):
+        '''Collects the answers to split requests and asks for new splits if workers are idle.'''
+        busy = []
+        started = 0
+        for slot, running in self.running.items():
+            if self.splitState[3 * slot] >= 0:
+                started += 1
+            requestedStop = self.splitState[3 * slot + 1]
+            if requestedStop > 0:
+                answer = self.splitState[3 * slot + 2]
+                if answer == requestedStop:
+                    self._split(slot, requestedStop)
+                    self.splitState[3 * slot + 1] = 0
+                elif answer == -1:
+                    running["splittable"] = False
+                    self.splitState[3 * slot + 1] = 0
+                continue
+            if self.splitState[3 * slot] >= 0:
+                busy.append(slot)
+        
+        # Jobs still waiting in the pool, in the queue or in the plan will keep the workers busy, the queue is only empty once the plan is
+        idle = self.threads - len(self.running)
+        if (len(self.queue) > 0) or (started < len(self.running)) or (idle <= 0):
+            return
+        
+        candidates = []
+        for slot in busy:
+            position = self.splitState[3 * slot]
+            remaining = self.running[slot]["stop"] - position
+            if (self.running[slot]["splittable"]) and (remaining >= 2 * self.minSplitSize):
+                remainingCost = self.running[slot]["cost"] * remaining / float(self.running[slot]["stop"] - self.running[slot]["job"][0].start)
+                candidates.append((remainingCost, slot, position + remaining // 2))
+        for remainingCost, slot, stop in sorted(candidates, reverse = True)[:idle]:
+            self.splitState[3 * slot + 2] = 0
+            self.splitState[3 * slot + 1] = stop
+    
+    def _finish(self, slot, result):
+        '''Releases the slot of a finished job and splits off any part of it the reader gave up that the parent has not seen yet.'''
+        if result[0].stop < self.running[slot]["stop"]:
+            self._split(slot, result[0].stop)
+        self.doneCost += self.running[slot]["cost"]
+        del self.running[slot]
+        self.freeSlots.append(slot)
+        
+        percentDone = int(100 * self.doneCost / self.totalCost) if self.totalCost > 0 else 100
+        if percentDone > self.percentLogged:
+            self.percentLogged = percentDone
+            timeDiff = (datetime.datetime.now() - self.startTime).total_seconds()
+            self.logger.info("Processed {}% of estimated work\tTime elapsed - {:.2f}m\tTime remaining - {:.2f}m".format(percentDone, timeDiff / 60.0, (timeDiff * (self.totalCost - self.doneCost) / max(self.doneCost, 1e-9)) / 60.0))
+    
+    def runJobs(self, ):
+        '''Yields (job, report) for every chunk as it finishes, job being the one the chunk was submitted for, along with any fields past its cost.'''
+        while (len(self.queue) > 0) or (len(self.running) > 0) or (self.jobs is not None):
+            self._fill()
+            self._submit()
+            self._poll()
+            try:
+                slot, result, error = self.finished.get(timeout = self.pollInterval)
+            except Queue.Empty:
+                continue
+            if error is not None:
+                raise Exception("Bam reader failed on {}:\n{}".format(self.running[slot]["job"][0], error))
+            job = self.running[slot]["job"]
+            self._finish(slot, result)
+            yield (job, result)
+    
+    def run(self, ):
+        '''Yields the report of every chunk as it finishes.'''
+        for job, result in self.runJobs():
+            yield result
+    
+    def __init__(self, workers, splitState, jobs, threads, makeInputs, minSplitSize, pollInterval = 0.5, priority = None, totalCost = None, maxQueued = 256):
+        '''Initializer for JobScheduler class.
+        
+        :param workers: Pool of worker processes, initialized with :func:`_initWorker` and splitState
+        :type workers: multiprocessing.Pool
+        :param splitState: Shared array of 3 longs per job slot, its length sets how many jobs are submitted at a time
+        :type splitState: multiprocessing.RawArray
+        :param jobs: Iterable of (region, subregions, precedingStops, cost) tuples from :meth:`ProcessingRegionGenerator.processingRegionJob`, largest first
+        :type jobs: iterable
+        :param threads: Number of worker processes
+        :type threads: int
+        :param makeInputs: Function of a job and its slot returning the input tuple for :func:`_readBamRegion`
+        :type makeInputs: function
+        :param minSplitSize: Smallest region in bp split off a running job
+        :type minSplitSize: int
+        :param pollInterval: Seconds between checks on split requests and idle workers
+        :type pollInterval: float
+        :param priority: Function of a job returning its rank, jobs of a lower rank are handed out first whatever their cost, all jobs rank the same if None
+        :type priority: function
+        :param totalCost: Sum of the costs of the jobs, used to log progress, the jobs are read into a list to add it up if None
+        :type totalCost: float
+        :param maxQueued: Maximum number of jobs pulled from jobs and waiting to be handed out
+        :type maxQueued: int
+        
+        '''
+        self.logger = logging.getLogger("coveragekit bam")
+        self.logger.setLevel(logging.INFO)
+        self.workers = workers
+        self.splitState = splitState
+        self.threads = threads
+        self.makeInputs = makeInputs
+        self.minSplitSize = minSplitSize
+        self.pollInterval = pollInterval
+        self.priority = priority if priority else (lambda job: 0)
+        self.finished = Queue.Queue()
+        self.freeSlots = list(range(len(splitState) // 3))
+        self.running = {}
+        self.queue = []
+        self.pushed = 0
+        if totalCost is None:
+            jobs = list(jobs)
+            totalCost = sum(job[3] for job in jobs)
+        self.jobs = iter(jobs)
+        self.maxQueued = maxQueued
+        self.totalCost = totalCost
+        self.doneCost = 0.0
+        self.percentLogged = 0
+        self.startTime = datetime.datetime.now()
+
+class ChunkCheckpoint(object):
+    '''Class that saves the report of every chunk of a bam run to a checkpoint directory as it finishes, so a run that dies can be resumed
+    without reading the chunks again. Chunks are kept in a subdirectory named after a hash of everything the reports depend on: the bam
+    file and its index (path, size and modification time), the contents of the region files, and the reading options. A chunk is stored
+    as the pickled report in a file named after its processing region index, start and stop, written to a temporary file and renamed so a
+    run killed while writing leaves no partial chunk.
+    
+    '''
+    
+    def _fileIdentity(self, path):
+        stat = os.stat(path)
+        return [os.path.realpath(path), stat.st_size, stat.st_mtime]
+    
+    def _key(self, bamInput, regions, levels, mapq, dups, genome, readIds, targetFetch, targetPadding, windowSize, balance, depthRuns):
+        indexFile = covbamindex.findIndex(bamInput)
+        regionFiles = {}
+        for descriptor, bedFile in regions.items():
+            with open(bedFile) as bedFH:
+                regionFiles[descriptor] = hashlib.sha1(bedFH.read()).hexdigest()
+        return {"version" : __version__,
+                "bam" : self._fileIdentity(bamInput),
+                "index" : self._fileIdentity(indexFile) if indexFile else None,
+                "regions" : regionFiles,
+                "levels" : list(levels),
+                "mapq" : mapq,
+                "dups" : dups,
+                "genome" : genome,
+                "readIds" : readIds,
+                "targetFetch" : targetFetch,
+                "targetPadding" : targetPadding,
+                "windowSize" : windowSize,
+                "balance" : balance,
+                "depthRuns" : depthRuns}
+    
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as checkpointFH:
+            cPickle.dump(data, checkpointFH, cPickle.HIGHEST_PROTOCOL)
+            checkpointFH.flush()
+            os.fsync(checkpointFH.fileno())
+        os.rename(path + ".tmp", path)
+    
+    def _read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as checkpointFH:
+            return cPickle.load(checkpointFH)
+    
+    def add(self, chunk):
+        '''Saves the report of a finished chunk.
+        
+        :param chunk: Report of a :class:`BamReader`
+        :type chunk: tuple
+        
+        '''
+        self._write("{}.{}.{}.chunk".format(chunk[0].index, chunk[0].start, chunk[0].stop), chunk)
+    
+    def remainingRanges(self, processingRegions):
+        '''Returns the saved chunk files and the ranges left to read, made of the parts of each processing region no saved chunk covers.
+        
+        :param processingRegions: List of (region, cost) tuples from :meth:`ProcessingRegionGenerator.processingRegions`
+        :type processingRegions: list
+        
+        :returns: List of chunk file names and dict of processing region index:list of (start, stop, cost) tuples left to read
+        :rtype: tuple
+        '''
+        saved = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".chunk"):
+                index, start, stop = [int(x) for x in name[:-len(".chunk")].split(".")]
+                saved.setdefault(index, []).append((start, stop, name))
+        
+        chunkFiles = []
+        ranges = {}
+        for region, cost in processingRegions:
+            position = region.start
+            left = []
+            for start, stop, name in sorted(saved.pop(region.index, [])):
+                if (start < position) or (stop > region.stop):
+                    raise Exception("Checkpointed chunk {} overlaps another chunk or lies outside of its processing region {}.".format(name, region))
+                if start > position:
+                    left.append((position, start))
+                chunkFiles.append(name)
+                position = stop
+            if position < region.stop:
+                left.append((position, region.stop))
+            if len(left) > 0:
+                ranges[region.index] = [(start, stop, cost * (stop - start) / float(region.stop - region.start)) for start, stop in left]
+        if len(saved) > 0:
+            raise Exception("Checkpoint directory {} holds chunks of processing regions this run does not have.".format(self.directory))
+        return chunkFiles, ranges
+    
+    def remainingJobs(self, jobs, ranges):
+        '''Yields the jobs left to read, the parts of each job in the ranges from :meth:`remainingRanges`.
+        
+        :param jobs: Iterable of (region, subregions, precedingStops, cost) tuples from :meth:`ProcessingRegionGenerator.processingRegionJob`
+        :type jobs: iterable
+        :param ranges: Dict of processing region index:list of (start, stop, cost) tuples left to read
+        :type ranges: dict
+        
+        '''
+        for job in jobs:
+            for start, stop, cost in ranges.get(job[0].index, []):
+                if (start == job[0].start) and (stop == job[0].stop):
+                    yield job
+                else:
+                    yield _clipJob(job, start, stop)
+    
+    def chunks(self, chunkFiles):
+        '''Yields the saved chunk reports one at a time.'''
+        for name in chunkFiles:
+            yield self._read(name)
+    
+    def addCounts(self, counts):
+        '''Saves the whole-bam read counts of a targetFetch run.'''
+        self._write("counts", counts)
+    
+    def counts(self, ):
+        '''Returns the saved whole-bam read counts, or None if there are none.'''
+        if not os.path.isfile(os.path.join(self.directory, "counts")):
+            return None
+        return self._read("counts")
+    
+    def __init__(self, checkpointDir, resume, bamInput, regions, levels, mapq, dups, genome, readIds, targetFetch, targetPadding, windowSize, balance, depthRuns = False):
+        '''Initializer for ChunkCheckpoint class.
+        
+        :param checkpointDir: Directory holding the checkpoints of bam runs
+        :type checkpointDir: str
+        :param resume: Boolean indicating whether chunks saved by an earlier run with the same inputs are kept, otherwise they are removed
+        :type resume: bool
+        
+        :param depthRuns: Boolean indicating whether the chunks carry the runs of a depth store
+        :type depthRuns: bool
+        
+        The other parameters are those of :func:`bam`.
+        
+        '''
+        self.logger = logging.getLogger("coveragekit bam")
+        self.logger.setLevel(logging.INFO)
+        key = self._key(bamInput, regions, levels, mapq, dups, genome, readIds, targetFetch, targetPadding, windowSize, balance, depthRuns)
+        keyText = json.dumps(key, indent = 4, sort_keys = True)
+        self.directory = os.path.join(checkpointDir, hashlib.sha1(keyText).hexdigest()[:16])
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            with open(os.path.join(self.directory, "key.json"), "w") as keyFH:
+                keyFH.write(keyText)
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp") or ((not resume) and (name.endswith(".chunk") or name == "counts")):
+                os.remove(os.path.join(self.directory, name))
+        self.logger.info("Checkpointing chunks to {}".format(self.directory))
+
+def bam(bamInput, regions, databases, levels, windowSize, threads, mapq, dups, genome, readIds = "name", targetFetch = False, targetPadding = 0, balance = True, checkpointDir = None, resume = False, depthStore = None, bedGraph = None, bedGraphLevels = False):
     '''Returns a dict containing coverage data information for a given bam file.
     
     :param bamInput: file path for bam file
@@ -53,6 +424,24 @@ def bam(bamInput, regions, databases, levels, windowSize, threads, mapq, dups, g
     :type dups: bool
     :param genome: Boolean indicating whether bam file should have genome-level coverage considered 
     :type genome: bool
+    :param readIds: Read identity used for on-target counting, "name" for read name strings or "hash" for 64-bit integers
+    :type readIds: str
+    :param targetFetch: Boolean indicating whether bam readers should only fetch reads overlapping the input regions, read totals are then counted separately from flags and mapping qualities
+    :type targetFetch: bool
+    :param targetPadding: Number of bases added to each side of the input regions fetched when targetFetch is set
+    :type targetPadding: int
+    :param balance: Boolean indicating whether processing windows should be balanced using the bam index rather than all being windowSize long
+    :type balance: bool
+    :param checkpointDir: Directory the report of every chunk is saved to as it finishes, no checkpoints are kept if None
+    :type checkpointDir: str
+    :param resume: Boolean indicating whether the chunks saved in checkpointDir by an earlier run with the same inputs are used instead of being read again
+    :type resume: bool
+    :param depthStore: file path for a run-length encoded store of the depth of every base, for computing the stats of other region files later without the bam, not compatible with targetFetch
+    :type depthStore: str
+    :param bedGraph: file path for a bgzip compressed and tabix indexed bedGraph of the depth of every base, ending with ".gz", not compatible with targetFetch
+    :type bedGraph: str
+    :param bedGraphLevels: Boolean indicating whether the bedGraph holds the largest of levels at or below the depth of each base instead of the depth
+    :type bedGraphLevels: bool
     
     :rtype: dict
     
@@ -63,14 +452,12 @@ def bam(bamInput, regions, databases, levels, windowSize, threads, mapq, dups, g
     logger = logging.getLogger("coveragekit bam")
     logger.setLevel(logging.INFO)
     
-    startTime = datetime.datetime.now()
-    
     # Get a list of regionSets
     regionSets = regions.keys()
     logger.info("Preparing to read from {} input region files".format(len(regionSets)))
     
     # Parse region files
-    processingRegionGenerator = ProcessingRegionGenerator(bamInput,windowSize)
+    processingRegionGenerator = ProcessingRegionGenerator(bamInput, windowSize, balance, genome)
     
     if len(regions) > 0:
         for descriptor,bedFile in regions.items():
@@ -89,60 +476,108 @@ def bam(bamInput, regions, databases, levels, windowSize, threads, mapq, dups, g
     #bamFile.close()
     
 
-    # Launch bam reading threads
-    bamJobs = []
-    for r in processingRegionGenerator.returnProcessingRegion():
-        bamJobs.append((bamInput, tuple(levels), r, mapq, dups, genome, startTime))
+    # Launch bam reading threads, the plan is looked at through its processing regions and the jobs, with their subregions, are generated
+    # largest first as the scheduler needs them
+    processingRegions = processingRegionGenerator.processingRegions()
+    bamJobs = (processingRegionGenerator.processingRegionJob(region, cost) for region, cost in sorted(processingRegions, key = lambda regionCost: regionCost[1], reverse = True))
+    totalCost = sum(cost for region, cost in processingRegions)
+    numJobs = len(processingRegions)
+    logger.info("Total regions to process: {}".format(numJobs))
+    
+    # Runs of the depth of every chunk are spooled as they arrive and written out in genome order at the end
+    storeWriter = None
+    if depthStore:
+        if targetFetch:
+            raise Exception("A depth store needs the depth of every base, it can not be written with targetFetch.")
+        storeWriter = covdepthstore.DepthStoreWriter(depthStore, processingRegionGenerator.header, {"bamSource" : bamInput, "mapq" : mapq, "dups" : dups, "genome" : genome})
     
-    # The following loop is simply for run-time estimation in the multiprocessing forks
-    for i in range(0,len(bamJobs)):
-        bamJobs[i] += (len(bamJobs),)    
+    # The bedGraph is written in genome order as chunks come in, against the processing regions before any is split or checkpointed
+    bedGraphWriter = None
+    if bedGraph:
+        if targetFetch:
+            raise Exception("A bedGraph needs the depth of every base, it can not be written with targetFetch.")
+        bedGraphWriter = covbedgraph.BedGraphWriter(bedGraph, processingRegions, levels if bedGraphLevels else None)
+    keepDepthRuns = (storeWriter is not None) or (bedGraphWriter is not None)
     
-    logger.info("Total regions to process: {}".format(len(bamJobs)))
+    # Chunks saved by an earlier run are aggregated from the checkpoint, and only the parts of the processing regions they miss are read
+    checkpoint = None
+    savedChunks = []
+    savedCounts = None
+    if checkpointDir:
+        checkpoint = ChunkCheckpoint(checkpointDir, resume, bamInput, regions, levels, mapq, dups, genome, readIds, targetFetch, targetPadding, windowSize, balance, keepDepthRuns)
+        savedChunks, remainingRanges = checkpoint.remainingRanges(processingRegions)
+        bamJobs = checkpoint.remainingJobs(bamJobs, remainingRanges)
+        remainingCost = sum(cost for ranges in remainingRanges.values() for start, stop, cost in ranges)
+        numJobs = sum(len(ranges) for ranges in remainingRanges.values())
+        savedCounts = checkpoint.counts() if targetFetch else None
+        if resume:
+            logger.info("Resuming from {} checkpointed chunks, {:.1f}% of estimated work left in {} regions".format(len(savedChunks), 100.0 * remainingCost / totalCost if totalCost > 0 else 0.0, numJobs))
+        totalCost = remainingCost
     
-    bamWorkers = Pool(processes = threads)
-    results = bamWorkers.map(_readBamRegion, bamJobs, chunksize=1)
+    def makeInputs(job, slot):
+        return (bamInput, tuple(levels), job[:3], mapq, dups, genome, readIds, targetFetch, targetPadding, slot, keepDepthRuns)
+    
+    # The bam is not opened again once every chunk, and the read counts of a targetFetch run, come from the checkpoint
+    bamWorkers = None
+    results = []
+    if (numJobs > 0) or (targetFetch and (savedCounts is None)):
+        splitState = RawArray('l', 3 * threads * 2)
+        bamWorkers = Pool(processes = threads, initializer = _initWorker, initargs = (splitState,))
+        
+        # When only targets are fetched the whole-bam read totals come from a flag and mapping quality count of every chromosome
+        if targetFetch and (savedCounts is None):
+            countJobs = bamWorkers.map_async(_countBamReads, [(bamInput, sq["SN"], mapq, dups) for sq in processingRegionGenerator.header['SQ']])
+        
+        scheduler = JobScheduler(bamWorkers, splitState, bamJobs, threads, makeInputs, max(1000, windowSize // 4), totalCost = totalCost)
+        results = scheduler.run()
     
     # Uncomment the follow for debugging purposes
-    #results = []
-    #for curJob in bamJobs[321:]:
-    #    results.append(_readBamRegion(curJob))
-    #results = [_readBamRegion(bamJobs[0])]
+    #results = (_readBamRegion(makeInputs(curJob, None)) for curJob in bamJobs)
     
-    # Now we parse the results for each chunk of alignment data
-    bamAggregator = BamReaderAggregate(regionSets)
-    for chunk in results:
+    # Now we parse the results for each chunk of alignment data as they come back from the workers, chunks can arrive in any order
+    bamAggregator = BamReaderAggregate(regionSets, levels)
+    def aggregate(chunk):
+        if storeWriter:
+            storeWriter.add(chunk[0].chrom, chunk[7])
+        if bedGraphWriter:
+            bedGraphWriter.add(chunk[0], chunk[7])
+        
         # Aggregate stats for the bam in question
         bamAggregator.add(chunk)
         
         # Add subregions to region aggregator objects
-        for subRegionResult in chunk[8]:
-            regionSetAggregators[subRegionResult[0].regionSet].add(subRegionResult[0],subRegionResult[1])
+        for subRegionResult in chunk[6]:
+            regionSetAggregators[subRegionResult[0].regionSet].add(subRegionResult[0],subRegionResult[1],chunk[0].index,subRegionResult[2])
+    
+    if checkpoint:
+        for chunk in checkpoint.chunks(savedChunks):
+            aggregate(chunk)
+    for chunk in results:
+        if checkpoint:
+            checkpoint.add(chunk)
+        aggregate(chunk)
+    if targetFetch:
+        if savedCounts is None:
+            savedCounts = countJobs.get()
+            if checkpoint:
+                checkpoint.addCounts(savedCounts)
+        for readCount, uncountedMetrics in savedCounts:
+            bamAggregator.addCounts(readCount, uncountedMetrics)
+    if bamWorkers is not None:
+        bamWorkers.close()
+        bamWorkers.join()
+    if storeWriter:
+        storeWriter.close()
+        logger.info("Wrote depth store {}".format(depthStore))
+    if bedGraphWriter:
+        bedGraphWriter.close()
+        logger.info("Wrote bedGraph {}".format(bedGraph))
     
     # Reporting time
     report = bamAggregator.report(bamInput, genome)
     
-    # The following supplements the BamReaderAggregate report with region reports
-    report["regionStats"] = {}
-    for descriptor in regionSets:
-        regionReport = regionSetAggregators[descriptor].report()
-        regionSetName = regionReport["name"]
-        
-        del regionReport["name"]
-        report["regionStats"][regionSetName] = regionReport
-        report["regionStats"][regionSetName]["file"] = regions[descriptor]
-    
-    # Create coverage databases
-    for databaseKey,databaseFile in databases.items():
-        referenceDB = covdb.CoverageDB(databaseFile,
-                                       regionsource = regions[databaseKey],
-                                       coveragesource = bamInput,
-                                       levels = regionSetAggregators[databaseKey].levels,
-                                       mapq = mapq,
-                                       dups = dups,
-                                       totalCoverage = bamAggregator.totalCoverage,
-                                       overwrite = True)
-        referenceDB.insertRegionSet(regionSetAggregators[databaseKey])
+    report["regionStats"] = covregion.regionStats(regionSetAggregators, regions)
+    covdb.joinCoverageDBs(covdb.startCoverageDBs(databases, regionSetAggregators, regions, bamInput, mapq, dups, bamAggregator.totalCoverage), logger)
     
     logger.info("Finished.")
     
@@ -163,9 +598,17 @@ def report(data, jsonOut = None, txtOut = None):
                 txtFH.write("\t{}:\t{:3.2f}%\t({})\n".format(key,(value/float(data["allReads"]))*100,value))
             txtFH.write("Average insert size estimate:\t{}\n".format(data["insertMean"]))
             txtFH.write("Insert size standard deviation estimate:\t{}\n".format(data["insertSD"]))
+            txtFH.write("Median insert size:\t{}\n".format(data["insertMedian"]))
+            txtFH.write("Insert size percentiles:\n")
+            for key,value in sorted(data["insertPercentiles"].items(), key=lambda x: int(x[0])):
+                txtFH.write("\t{}th:\t{}\n".format(key,value))
             
             if "genome" in data.keys():
                 txtFH.write("Average genome-wide coverage:\t{}\n".format(data["genome"]["avgCoverage"]))
+                txtFH.write("Median genome-wide coverage:\t{}\n".format(data["genome"]["medianCoverage"]))
+                txtFH.write("Genome percent at X coverage or greater:\n")
+                for key,value in sorted(data["genome"]["coverageLevels"].items(), key=lambda x: int(x[0])):
+                    txtFH.write("\t{}X:\t{:3.2f}\n".format(key,(value*100)))
             
             txtFH.write("On target percentages:\n")
             for key,value in data["onTarget"].items():
@@ -191,12 +634,21 @@ def run(inputArgs):
     parser.add_option("-b","--bam", dest="bam", help="Input bam.", default="")
     parser.add_option("-r","--regions", action="append", dest="regions", help="Region file in bed format prepended with colon-delimited descriptor ( eg 'reference:file.bed' ).", default=[])
     parser.add_option("-d","--databases", action="append", dest="databases", help="Database files to build prepended with colon-delimited descriptor to match region file ( eg 'reference:file.db' ).", default=[])
-    parser.add_option("-w","--windowSize", type="int", dest="windowSize", help="Processing window size [1000000].", default=1000000)
+    parser.add_option("-w","--windowSize", type="int", dest="windowSize", help="Processing window size, the average size when windows are balanced [1000000].", default=1000000)
+    parser.add_option("--fixedWindows", action="store_false", dest="balance", help="Use windows of exactly windowSize rather than balancing them with the bam index.", default=True)
     parser.add_option("-t","--threads", type="int", dest="threads", help="Number of processing threads.", default=1)
     parser.add_option("-l","--levels", type="string", dest="levels", help="Comma-separated coverage levels for reporting ['5,10,20,50,100'].", default="5,10,20,50,100")
     parser.add_option("--mq", type="int", dest="mapq", help="Mapping quality cutoff [1].", default=1)
     parser.add_option("--genome", action="store_true", dest="genome", help="Calculate coverage for a genome [False].", default=False)
     parser.add_option("--allowdups", action="store_true", dest="dups", help="Count duplicate reads [False].", default=False)
+    parser.add_option("--readIds", type="choice", choices=["name","hash"], dest="readIds", help="Read identity used for on-target counting, read names or 64-bit hashes ['name'].", default="name")
+    parser.add_option("--targetFetch", action="store_true", dest="targetFetch", help="Only read alignments overlapping the region files, not compatible with --genome [False].", default=False)
+    parser.add_option("--targetPadding", type="int", dest="targetPadding", help="Bases added to each side of the regions read with --targetFetch [0].", default=0)
+    parser.add_option("--depthStore", type="string", dest="depthStore", help="Output file for a run-length encoded depth store, used by 'coveragekit store' to report on other region files without the bam.", default=None)
+    parser.add_option("--bedGraph", type="string", dest="bedGraph", help="Output bgzip compressed bedGraph of the depth of every base, ending with '.gz' and indexed with tabix.", default=None)
+    parser.add_option("--bedGraphLevels", action="store_true", dest="bedGraphLevels", help="Write the largest of the levels at or below each depth to the bedGraph instead of the depth [False].", default=False)
+    parser.add_option("--checkpointDir", type="string", dest="checkpointDir", help="Directory the report of every chunk is saved to as it finishes.", default=None)
+    parser.add_option("--resume", action="store_true", dest="resume", help="Reuse the chunks saved in --checkpointDir by an earlier run with the same inputs and only read the rest [False].", default=False)
     parser.add_option("--json", type="string", dest="json", help="Output file for json doc.", default=None)
     parser.add_option("--txt", type="string", dest="txt", help="Output file for txt report.", default=None)
     (options, args) = parser.parse_args(inputArgs)
@@ -204,6 +656,13 @@ def run(inputArgs):
     # Bam file is required as well as one output
     if len(options.bam) == 0: parser.error("Missing bam sample, use --bam or -b.")
     if (options.json is None) and (options.txt is None): parser.error("Must specify an output with --json or --txt")
+    if options.targetFetch and options.genome: parser.error("--targetFetch can not be used with --genome.")
+    if options.targetFetch and (len(options.regions) == 0): parser.error("--targetFetch requires at least one region file, use --regions or -r.")
+    if options.resume and (options.checkpointDir is None): parser.error("--resume requires --checkpointDir.")
+    if options.targetFetch and options.depthStore: parser.error("--depthStore can not be used with --targetFetch.")
+    if options.targetFetch and options.bedGraph: parser.error("--bedGraph can not be used with --targetFetch.")
+    if options.bedGraph and (not options.bedGraph.endswith(".gz")): parser.error("The --bedGraph file name must end with '.gz'.")
+    if options.bedGraphLevels and (options.bedGraph is None): parser.error("--bedGraphLevels requires --bedGraph.")
     
     # Multiple region files can be submitted
     regions = {}
@@ -229,7 +688,7 @@ def run(inputArgs):
     for i in options.levels.split(','):
         levels.append(int(i))
     levels.sort()
-    coverageReport = bam(options.bam, regions, databases, levels, options.windowSize, options.threads, options.mapq, options.dups, options.genome)
+    coverageReport = bam(options.bam, regions, databases, levels, options.windowSize, options.threads, options.mapq, options.dups, options.genome, options.readIds, options.targetFetch, options.targetPadding, options.balance, options.checkpointDir, options.resume, options.depthStore, options.bedGraph, options.bedGraphLevels)
     report(coverageReport, options.json, options.txt)
 
 
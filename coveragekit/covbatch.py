@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import sys, os, optparse, logging
+import pysam
+from multiprocessing import Pool, RawArray
+
+import coveragekit.utils.region as covregion
+import coveragekit.utils.db as covdb
+import coveragekit.utils.bed as covbed
+import coveragekit.covbam as covbam
+from coveragekit.utils.bam import BamReaderAggregate,ProcessingRegionGenerator
+
+from coveragekit.version import __version__
+
+def readSampleSheet(sampleSheet):
+    '''Returns the samples of a sample sheet, one sample per line with its name and bam file separated by a tab, or only a bam file to name
+    the sample after it. Empty lines and lines starting with "#" are skipped.
+
+    :param sampleSheet: file path for the sample sheet
+    :type sampleSheet: str
+
+    :returns: List of (sample name, bam file) tuples
+    :rtype: list
+    '''
+    samples = []
+    with open(sampleSheet) as sheetFH:
+        for line in sheetFH:
+            line = line.strip()
+            if (len(line) == 0) or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) == 1:
+                samples.append((os.path.basename(fields[0]).rsplit(".", 1)[0], fields[0]))
+            else:
+                samples.append((fields[0], fields[1]))
+    names = [name for name, bamFile in samples]
+    duplicates = set(name for name in names if names.count(name) > 1)
+    if len(duplicates) > 0:
+        raise Exception("Samples given twice in {}: {}".format(sampleSheet, ",".join(sorted(duplicates))))
+    return samples
+
+def _reference(bamInput):
+    '''Returns the (name, length) of every chromosome in the header of a bam file.'''
+    bamFile = pysam.AlignmentFile(bamInput, 'rb')
+    reference = [(sq["SN"], sq["LN"]) for sq in bamFile.header["SQ"]]
+    bamFile.close()
+    return reference
+
+class BatchSample(object):
+    '''Class that aggregates the chunks of one bam of a batch, and knows it holds every chunk once the lengths of its chunks add up to the
+    length of the processing regions.
+
+    '''
+
+    def add(self, chunk):
+        '''Adds the report of one chunk of the bam.'''
+        self.bamAggregator.add(chunk)
+        for subRegionResult in chunk[6]:
+            self.regionSetAggregators[subRegionResult[0].regionSet].add(subRegionResult[0],subRegionResult[1],chunk[0].index,subRegionResult[2])
+        self.remaining -= chunk[0].length
+
+    def complete(self, ):
+        '''Returns whether every chunk of the bam has been added.'''
+        return self.remaining <= 0
+
+    def __init__(self, name, bamInput, regions, levels, planLength):
+        '''Initializer for BatchSample class.
+
+        :param name: Sample name, used to name the outputs
+        :type name: str
+        :param bamInput: file path for bam
+        :type bamInput: str
+        :param regions: Dict of regions with key:value pairs of region descriptor:region file path
+        :type regions: dict
+        :param levels: List of integers corresponding to levels of coverage to consider
+        :type levels: list
+        :param planLength: Total length of the processing regions
+        :type planLength: int
+
+        '''
+        self.name = name
+        self.bamInput = bamInput
+        self.bamAggregator = BamReaderAggregate(regions.keys(), levels)
+        self.regionSetAggregators = {}
+        for descriptor in regions:
+            self.regionSetAggregators[descriptor] = covregion.RegionSet(descriptor, levels)
+        self.remaining = planLength
+        self.countJobs = None
+
+def batch(samples, regions, databases, outDir, levels, windowSize, threads, mapq, dups, genome, readIds = "name", targetFetch = False, targetPadding = 0, balance = True, writeTxt = False):
+    '''Runs coveragekit bam over many bam files of the same reference on one worker pool. The region files are parsed and the processing
+    regions planned once, from the header of the first bam and the indexes of all of them, and the chunks of every bam are read by the same
+    workers, one bam after the other, so workers finishing a bam go on with the next one instead of waiting for the last chunks of the bam.
+    The outputs of each sample, named after it in outDir, are the same as those of a coveragekit bam run, and are written as soon as its
+    last chunk is read.
+
+    :param samples: List of (sample name, bam file) tuples
+    :type samples: list
+    :param regions: Dict of regions to assay coverage over with key:value pairs of region descriptor:region file path
+    :type regions: dict
+    :param databases: List of region descriptors to build a coverage database for in each sample
+    :type databases: list
+    :param outDir: Directory the reports and databases of every sample are written to
+    :type outDir: str
+    :param levels: List of integers corresponding to levels of coverage to consider
+    :type levels: list
+    :param windowSize: Size of chunks of the bam file to be considered by a bam reader, the average size when windows are balanced
+    :type windowSize: int
+    :param threads: Number of processes to use for reading bam files
+    :type threads: int
+    :param mapq: Minimum mapping quality a read must have to be considered
+    :type mapq: int
+    :param dups: Boolean indicating whether duplicates should be considered
+    :type dups: bool
+    :param genome: Boolean indicating whether the whole genome is being assayed
+    :type genome: bool
+    :param readIds: Read identity used for on-target counting, "name" for read names or "hash" for 64-bit hashes
+    :type readIds: str
+    :param targetFetch: Boolean indicating whether only alignments overlapping the regions are read
+    :type targetFetch: bool
+    :param targetPadding: Bases added to each side of the regions read when targetFetch is set
+    :type targetPadding: int
+    :param balance: Boolean indicating whether processing windows should be balanced using the bam index rather than all being windowSize long
+    :type balance: bool
+    :param writeTxt: Boolean indicating whether a txt report is written next to the json report of every sample
+    :type writeTxt: bool
+
+    :returns: Dict of sample name:json report file
+    :rtype: dict
+    '''
+
+    # Set up logging
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("coveragekit batch")
+    logger.setLevel(logging.INFO)
+
+    # Chunks are shared by every bam, which needs the same chromosomes in the same order
+    reference = _reference(samples[0][1])
+    for name, bamInput in samples[1:]:
+        if _reference(bamInput) != reference:
+            raise Exception("Bam {} of sample {} does not have the chromosomes of {}, a batch needs bams aligned to the same reference.".format(bamInput, name, samples[0][1]))
+
+    # Parse region files and plan the processing regions once for the whole batch
+    logger.info("Preparing to read {} bam files over {} input region files".format(len(samples), len(regions)))
+    processingRegionGenerator = ProcessingRegionGenerator(samples[0][1], windowSize, balance, genome, [bamInput for name, bamInput in samples[1:]])
+    for descriptor,bedFile in regions.items():
+        for bedRegion in covbed.bedToRegions(descriptor,bedFile):
+            processingRegionGenerator.addRegion(bedRegion)
+    # Every sample is read over the same processing regions, largest first, and the jobs of each sample are made from them as the scheduler
+    # needs them
+    plan = sorted(processingRegionGenerator.processingRegions(), key = lambda regionCost: regionCost[1], reverse = True)
+    planLength = sum(region.length for region, cost in plan)
+    planCost = sum(cost for region, cost in plan)
+    logger.info("Total regions to process: {} in each of {} bam files".format(len(plan), len(samples)))
+
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    batchSamples = [BatchSample(name, bamInput, regions, levels, planLength) for name, bamInput in samples]
+
+    # A job is a processing region followed by the index of its sample, which ranks the jobs of a sample before those of the next one
+    batchJobs = (processingRegionGenerator.processingRegionJob(region, cost) + (sampleIndex,) for sampleIndex in range(len(samples)) for region, cost in plan)
+    def makeInputs(job, slot):
+        return (samples[job[4]][1], tuple(levels), job[:3], mapq, dups, genome, readIds, targetFetch, targetPadding, slot, False)
+
+    splitState = RawArray('l', 3 * threads * 2)
+    bamWorkers = Pool(processes = threads, initializer = covbam._initWorker, initargs = (splitState,))
+
+    # When only targets are fetched the whole-bam read totals come from a flag and mapping quality count of every chromosome
+    if targetFetch:
+        for sample in batchSamples:
+            sample.countJobs = bamWorkers.map_async(covbam._countBamReads, [(sample.bamInput, chrom, mapq, dups) for chrom, length in reference])
+
+    # Reports are written as soon as a sample is complete, its databases are built in the background while the workers read on
+    scheduler = covbam.JobScheduler(bamWorkers, splitState, batchJobs, threads, makeInputs, max(1000, windowSize // 4), priority = lambda job: job[4], totalCost = planCost * len(samples))
+    reportFiles = {}
+    databaseBuilders = []
+    for job, chunk in scheduler.runJobs():
+        sample = batchSamples[job[4]]
+        sample.add(chunk)
+        if not sample.complete():
+            continue
+
+        if targetFetch:
+            for readCount, uncountedMetrics in sample.countJobs.get():
+                sample.bamAggregator.addCounts(readCount, uncountedMetrics)
+        report = sample.bamAggregator.report(sample.bamInput, genome)
+        report["regionStats"] = covregion.regionStats(sample.regionSetAggregators, regions)
+        sampleDatabases = dict((descriptor, os.path.join(outDir, "{}.{}.db".format(sample.name, descriptor))) for descriptor in databases)
+        databaseBuilders.extend(covdb.startCoverageDBs(sampleDatabases, sample.regionSetAggregators, regions, sample.bamInput, mapq, dups, sample.bamAggregator.totalCoverage))
+
+        reportFiles[sample.name] = os.path.join(outDir, "{}.json".format(sample.name))
+        covbam.report(report, reportFiles[sample.name], os.path.join(outDir, "{}.txt".format(sample.name)) if writeTxt else None)
+        logger.info("Finished sample {} ({} of {})".format(sample.name, len(reportFiles), len(samples)))
+
+        # The aggregators of a finished sample are no longer needed once its databases have been forked
+        batchSamples[job[4]] = None
+
+    bamWorkers.close()
+    bamWorkers.join()
+    covdb.joinCoverageDBs(databaseBuilders, logger)
+
+    logger.info("Finished.")
+
+    return reportFiles
+
+def run(inputArgs):
+    usage = "%prog --samples samples.tsv --outDir coverage -r reference:file.bed"
+    parser = optparse.OptionParser(usage=usage, prog = "coveragekit batch")
+    parser.add_option("-s","--samples", dest="samples", help="Sample sheet, one sample per line as its name and bam file separated by a tab, or only a bam file.", default="")
+    parser.add_option("-o","--outDir", dest="outDir", help="Output directory for the reports and databases of every sample, named after the sample.", default="")
+    parser.add_option("-r","--regions", action="append", dest="regions", help="Region file in bed format prepended with colon-delimited descriptor ( eg 'reference:file.bed' ).", default=[])
+    parser.add_option("-d","--databases", action="append", dest="databases", help="Descriptor of a region file to build a coverage database for in each sample, written to 'sample.descriptor.db'.", default=[])
+    parser.add_option("-l","--levels", type="string", dest="levels", help="Comma-separated coverage levels for reporting ['5,10,20,50,100'].", default="5,10,20,50,100")
+    parser.add_option("-t","--threads", type="int", dest="threads", help="Number of processes shared by every bam [1].", default=1)
+    parser.add_option("-w","--windowSize", type="int", dest="windowSize", help="Processing window size, the average size when windows are balanced [1000000].", default=1000000)
+    parser.add_option("--fixedWindows", action="store_false", dest="balance", help="Use windows of exactly windowSize bp instead of balancing them with the indexes of the bams [False].", default=True)
+    parser.add_option("--mq", type="int", dest="mapq", help="Mapping quality cutoff [1].", default=1)
+    parser.add_option("--genome", action="store_true", dest="genome", help="Calculate coverage for a genome [False].", default=False)
+    parser.add_option("--allowdups", action="store_true", dest="dups", help="Count duplicate reads [False].", default=False)
+    parser.add_option("--readIds", type="choice", choices=["name","hash"], dest="readIds", help="Read identity used for on-target counting, read names or 64-bit hashes ['name'].", default="name")
+    parser.add_option("--targetFetch", action="store_true", dest="targetFetch", help="Only read alignments overlapping the region files, not compatible with --genome [False].", default=False)
+    parser.add_option("--targetPadding", type="int", dest="targetPadding", help="Bases added to each side of the regions read with --targetFetch [0].", default=0)
+    parser.add_option("--txt", action="store_true", dest="txt", help="Also write a txt report for every sample [False].", default=False)
+    (options, args) = parser.parse_args(inputArgs)
+
+    # Sample sheet and output directory are required
+    if len(options.samples) == 0: parser.error("Missing sample sheet, use --samples or -s.")
+    if not os.path.isfile(options.samples): parser.error("Sample sheet {} does not exist.".format(options.samples))
+    if len(options.outDir) == 0: parser.error("Missing output directory, use --outDir or -o.")
+    if options.targetFetch and options.genome: parser.error("--targetFetch can not be used with --genome.")
+    if options.targetFetch and (len(options.regions) == 0): parser.error("--targetFetch requires at least one region file, use --regions or -r.")
+
+    samples = readSampleSheet(options.samples)
+    if len(samples) == 0: parser.error("Sample sheet {} has no samples.".format(options.samples))
+    for name, bamFile in samples:
+        if not os.path.isfile(bamFile): parser.error("Bam file {} of sample {} does not exist.".format(bamFile, name))
+
+    # Multiple region files can be submitted
+    regions = {}
+    for curRegion in options.regions:
+        descriptorSplit = curRegion.split(":",1)
+        if len(descriptorSplit) != 2:
+            parser.error("Region files must have colon-delimited descriptor prepended.")
+        regions[descriptorSplit[0]] = descriptorSplit[1]
+    if len(set(options.databases).difference(set(regions.keys()))) > 0:
+        parser.error("Database descriptors must match colon-delimited region file descriptors.")
+
+    # Convert string of levels into sorted list of levels
+    levels = sorted([int(i) for i in options.levels.split(',')])
+    batch(samples, regions, options.databases, options.outDir, levels, options.windowSize, options.threads, options.mapq, options.dups, options.genome, options.readIds, options.targetFetch, options.targetPadding, options.balance, options.txt)
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
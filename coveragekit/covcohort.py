@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import os, json, sys, optparse, logging
+
+import coveragekit.utils.db
+import coveragekit.utils.cohort
+from coveragekit.version import __version__
+
+def append(cohortInput, databases, levels = None):
+    '''Adds samples to a cohort store, creating it if needed.
+
+    :param cohortInput: file path for the cohort store
+    :type cohortInput: str
+    :param databases: List of (sample name, database file) tuples
+    :type databases: list
+    :param levels: Coverage levels of a new cohort store, those of the first database if None
+    :type levels: list
+
+    '''
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("coveragekit cohort")
+    logger.setLevel(logging.INFO)
+
+    if (not os.path.isfile(cohortInput)) and (not levels):
+        levels = coveragekit.utils.db.CoverageDB(databases[0][1]).levels
+    cohortDB = coveragekit.utils.cohort.CohortDB(cohortInput, levels)
+    cohortDB.append(databases)
+    logger.info("Cohort {} now holds {} samples".format(cohortInput, cohortDB.numSamples()))
+
+def query(cohortInput, level, percent, minFailFraction = None):
+    '''Returns the per-gene distributions of the percent at or above a level over the samples of a cohort store.
+
+    :param cohortInput: file path for the cohort store
+    :type cohortInput: str
+    :param level: Coverage level
+    :type level: int
+    :param percent: Minimum percent at or above level for a sample to pass
+    :type percent: float
+    :param minFailFraction: Only genes failing in more than this fraction of samples are returned, all if None
+    :type minFailFraction: float
+
+    :rtype: dict
+    '''
+    cohortDB = coveragekit.utils.cohort.CohortDB(cohortInput)
+
+    results = {"meta" : {}, "queryResults" : []}
+    results["meta"]["version"] = __version__
+    results["meta"]["cohortSource"] = cohortInput
+    results["meta"]["cohortLevels"] = cohortDB.levels
+    results["meta"]["numSamples"] = cohortDB.numSamples()
+    results["meta"]["level"] = level
+    results["meta"]["percent"] = percent
+    results["meta"]["minFailFraction"] = minFailFraction
+    results["queryResults"] = list(cohortDB.query(level, percent, minFailFraction))
+    results["meta"]["queryResultNum"] = len(results["queryResults"])
+    return results
+
+def report(results, jsonOut = None, tsvOut = None):
+    if jsonOut:
+        with open(jsonOut, "w") as jsonFile:
+            jsonFile.write(json.dumps(results, indent = 4, sort_keys = True))
+
+    if tsvOut:
+        with open(tsvOut, "w") as tsvFile:
+            tsvFile.write("RegionID\tPosition\tNumSamples\tMinPercent{0}X\tMedianPercent{0}X\tMeanPercent{0}X\tNumFailing\tFailFraction\n".format(results["meta"]["level"]))
+            for r in results["queryResults"]:
+                tsvFile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(r["id"], r["position"], r["numSamples"], r["min"], r["median"], r["mean"], r["numFailing"], r["failFraction"]))
+
+    print "\n\ncoveragekit cohort results:"
+    print "--------------"
+    print "Cohort source:\t{}".format(results["meta"]["cohortSource"])
+    print "Samples:\t{}".format(results["meta"]["numSamples"])
+    print "Records retrieved:\t{}".format(results["meta"]["queryResultNum"])
+    if jsonOut:
+        print "JSON output:\t{}".format(jsonOut)
+    if tsvOut:
+        print "tsv output:\t{}".format(tsvOut)
+    print "\n\n"
+
+def run(inputArgs):
+    usage = "%prog append --cohort cohort.db [ name: ]sample.db ... | %prog query --cohort cohort.db --level 20 --percent 95 [ options ]"
+    parser = optparse.OptionParser(usage=usage, prog = "coveragekit cohort")
+    parser.add_option("-c","--cohort", dest="cohort", help="Cohort store.", default="")
+    parser.add_option("-l","--levels", type="string", dest="levels", help="Comma-separated list of coverage levels of a new cohort store, the levels of the first database by default.", default="")
+    parser.add_option("--level", type="int", dest="level", help="Coverage level to query.", default=None)
+    parser.add_option("--percent", type="float", dest="percent", help="Minimum percent at or above the level for a sample to pass a gene.", default=None)
+    parser.add_option("--minFailFraction", type="float", dest="minFailFraction", help="Only report genes failing in more than this fraction of samples ( eg 0.05 ).", default=None)
+    parser.add_option("--json", type="string", dest="json", help="Output JSON file.", default=None)
+    parser.add_option("--tsv","--txt", type="string", dest="tsv", help="Output tsv file.", default=None)
+    (options, args) = parser.parse_args(inputArgs)
+
+    if len(args) == 0 or args[0] not in ("append", "query"): parser.error("Specify a cohort command, append or query.")
+    if len(options.cohort) == 0: parser.error("Missing cohort store, use -c or --cohort.")
+
+    if args[0] == "append":
+        if len(args) < 2: parser.error("Missing sample databases to append.")
+        # Samples are named like the other descriptors of coveragekit ( eg 'NA12878:NA12878.db' ), or after their database file
+        databases = []
+        for curDB in args[1:]:
+            if (":" in curDB) and (not os.path.isfile(curDB)):
+                name, dbFile = curDB.split(":", 1)
+            else:
+                name, dbFile = os.path.splitext(os.path.basename(curDB))[0], curDB
+            if not os.path.isfile(dbFile): parser.error("Sample database {} does not exist.".format(dbFile))
+            databases.append((name, dbFile))
+        levels = tuple([int(x) for x in options.levels.split(",") if len(x) > 0])
+        append(options.cohort, databases, levels)
+    else:
+        if not os.path.isfile(options.cohort): parser.error("Cohort store {} does not exist.".format(options.cohort))
+        if (options.level is None) or (options.percent is None): parser.error("Cohort queries need --level and --percent.")
+        if (options.json is None) and (options.tsv is None): parser.error("Must specify an output with --json or --tsv")
+        results = query(options.cohort, options.level, options.percent, options.minFailFraction)
+        report(results, jsonOut = options.json, tsvOut = options.tsv)
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
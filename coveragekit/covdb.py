@@ -1,55 +1,185 @@
 #!/usr/bin/env python
 
-import sqlite3, os, json, sys, optparse, logging
+import sqlite3, os, json, sys, optparse, logging, glob, bisect, tempfile, shutil
+from multiprocessing import Pool
 
 import coveragekit.utils.db
 from coveragekit.utils.bed import stitchRegions
 from coveragekit.version import __version__
 
-def _prettifyResult(result, levelsMinKeys, levelsMaxKeys, dbLevels, reportRegions = True):
+def _prettifyResult(result, levelsMinKeys, levelsMaxKeys, coverageDB, reportLevels, percentiles = (), reportRegions = True):
     prettifiedResult = {}
     prettifiedResult["id"] = result[0]
     prettifiedResult["position"] = "{}:{}-{}".format(result[1],result[2],result[3])
     prettifiedResult["coverage"] = result[6]
     
     prettifiedResult["percentGreaterOrEqual"] = {}
-    for h in zip(dbLevels,result[8:]):
-        prettifiedResult["percentGreaterOrEqual"][h[0]] = h[1]
+    for level in reportLevels:
+        prettifiedResult["percentGreaterOrEqual"][level] = coverageDB.percentAtLeast(result, level)
     
+    if len(percentiles) > 0:
+        prettifiedResult["depthPercentiles"] = {}
+        for percentile in percentiles:
+            prettifiedResult["depthPercentiles"][percentile] = coverageDB.depthPercentile(result, percentile)
     
     if reportRegions:
+        # Regions are only stored for the levels of the database, already stitched below and at or above each of them
         prettifiedResult["coverageRegions"] = {"lessThan": {}, "greaterOrEqual": {}}
-        resultLevels = json.loads(result[7])
-        if len(levelsMaxKeys) > 0:
-            for level in levelsMaxKeys:
-                prettifiedResult["coverageRegions"]["lessThan"][level] = []
-                toStitch = [] 
-                for i in reversed(sorted(resultLevels.keys())):
-                    if int(i) < level:
-                        toStitch.extend(resultLevels[i])
-                stitched = stitchRegions(toStitch)
-                for j in stitched:
-                    prettifiedResult["coverageRegions"]["lessThan"][level].append("{}:{}-{}".format(result[1],j[0],j[1]))
-                    
-        if len(levelsMinKeys) > 0:
-            for level in levelsMinKeys:
-                prettifiedResult["coverageRegions"]["greaterOrEqual"][level] = []
-                toStitch = [] 
-                for i in sorted(resultLevels.keys()):
-                    if int(i) >= level:
-                        toStitch.extend(resultLevels[i])
-                stitched = stitchRegions(toStitch)
-                for j in stitched:
-                    prettifiedResult["coverageRegions"]["greaterOrEqual"][level].append("{}:{}-{}".format(result[1],j[0],j[1]))
+        for level in [l for l in levelsMaxKeys if l in coverageDB.levels]:
+            prettifiedResult["coverageRegions"]["lessThan"][level] = ["%s:%d-%d" % (result[1],j[0],j[1]) for j in coverageDB.thresholdIntervals(result, level, below = True)]
+        for level in [l for l in levelsMinKeys if l in coverageDB.levels]:
+            prettifiedResult["coverageRegions"]["greaterOrEqual"][level] = ["%s:%d-%d" % (result[1],j[0],j[1]) for j in coverageDB.thresholdIntervals(result, level, below = False)]
     
     return prettifiedResult
+
+def _coverageRegions(chrom, resultLevels, levelsMinKeys, levelsMaxKeys, dbLevels):
+    coverageRegions = {"lessThan": {}, "greaterOrEqual": {}}
+    if len(levelsMaxKeys) > 0:
+        for level in [l for l in levelsMaxKeys if l in dbLevels]:
+            coverageRegions["lessThan"][level] = []
+            toStitch = [] 
+            for i in reversed(sorted(resultLevels.keys())):
+                if int(i) < level:
+                    toStitch.extend(resultLevels[i])
+            stitched = stitchRegions(toStitch)
+            for j in stitched:
+                coverageRegions["lessThan"][level].append("{}:{}-{}".format(chrom,j[0],j[1]))
+                
+    if len(levelsMinKeys) > 0:
+        for level in [l for l in levelsMinKeys if l in dbLevels]:
+            coverageRegions["greaterOrEqual"][level] = []
+            toStitch = [] 
+            for i in sorted(resultLevels.keys()):
+                if int(i) >= level:
+                    toStitch.extend(resultLevels[i])
+            stitched = stitchRegions(toStitch)
+            for j in stitched:
+                coverageRegions["greaterOrEqual"][level].append("{}:{}-{}".format(chrom,j[0],j[1]))
+    return coverageRegions
+
+def _mergeLevelIntervals(levelIntervals):
+    # Overlapping subregions of a region repeat the same level intervals, so the intervals of each region and level are merged once into
+    # sorted, disjoint (starts, stops) lists that every subregion then looks its range up in
+    grouped = {}
+    for interval in sorted(levelIntervals, key = lambda interval: (interval[0], interval[4], interval[2], interval[3])):
+        starts, stops = grouped.setdefault((interval[0], interval[4]), ([], []))
+        if (len(stops) > 0) and (interval[2] <= stops[-1]):
+            stops[-1] = max(stops[-1], interval[3])
+        else:
+            starts.append(interval[2])
+            stops.append(interval[3])
+    return grouped
+
+def _prettifySubregion(subregion, levelIntervals, levelsMinKeys, levelsMaxKeys, dbLevels, reportRegions = True):
+    regionID, chrom, start, stop, coverage = subregion
+    length = stop - start
+    
+    # Level intervals of the region clipped to the subregion, the first one ending after start is found by bisection
+    clipped = {}
+    for level in dbLevels:
+        clipped[level] = []
+        starts, stops = levelIntervals.get((regionID, level), ([], []))
+        i = bisect.bisect_right(stops, start)
+        while (i < len(starts)) and (starts[i] < stop):
+            clipped[level].append([max(starts[i], start), min(stops[i], stop)])
+            i += 1
     
-def db(dbInput, genes = None, levelsMin = None, levelsMax = None, coverageMin = None, coverageMax = None, reportRegions = True):
+    prettifiedResult = {}
+    prettifiedResult["id"] = regionID
+    prettifiedResult["position"] = "{}:{}-{}".format(chrom,start,stop)
+    prettifiedResult["coverage"] = coverage / float(length)
+    
+    prettifiedResult["percentGreaterOrEqual"] = {}
+    levelAggregate = 0
+    for level in reversed(dbLevels):
+        levelAggregate += sum(j[1] - j[0] for j in clipped[level])
+        prettifiedResult["percentGreaterOrEqual"][level] = levelAggregate / float(length)
+    
+    if reportRegions:
+        prettifiedResult["coverageRegions"] = _coverageRegions(chrom, clipped, levelsMinKeys, levelsMaxKeys, dbLevels)
+    
+    return prettifiedResult
+
+def _queryRange(coverageDB, position, levelsMin, levelsMax, coverageMin, coverageMax, reportRegions = True):
+    '''Returns the prettified subregions overlapping a (chrom, start, stop) range that pass every cutoff, in the same format as region
+    results with the percents computed over each subregion.'''
+    chrom, start, stop = position
+    levelsMaxKeys = levelsMax.keys() if levelsMax else []
+    levelsMinKeys = levelsMin.keys() if levelsMin else []
+    
+    subregions = coverageDB.subregionsOverlapping(chrom, start, stop)
+    if len(subregions) == 0:
+        return []
+    # One lookup for the level intervals of every subregion found
+    levelIntervals = _mergeLevelIntervals(coverageDB.levelIntervalsOverlapping(chrom, min(s[2] for s in subregions), max(s[3] for s in subregions)))
+    
+    queryResults = []
+    for subregion in subregions:
+        prettifiedResult = _prettifySubregion(subregion, levelIntervals, levelsMinKeys, levelsMaxKeys, coverageDB.levels, reportRegions = reportRegions)
+        if coverageMin and (prettifiedResult["coverage"] < coverageMin):
+            continue
+        if coverageMax and (prettifiedResult["coverage"] >= coverageMax):
+            continue
+        if levelsMin and any((cutoff != '.') and (prettifiedResult["percentGreaterOrEqual"][level] < cutoff/100.0) for level,cutoff in levelsMin.items()):
+            continue
+        if levelsMax and any((cutoff != '.') and (prettifiedResult["percentGreaterOrEqual"][level] >= cutoff/100.0) for level,cutoff in levelsMax.items()):
+            continue
+        queryResults.append(prettifiedResult)
+    return queryResults
+    
+def queryError(coverageDB, levelsMin = None, levelsMax = None, levels = (), percentiles = (), position = None):
+    '''Returns why a query cannot be answered by a coverage database, or None if it can.
+    
+    :param coverageDB: Open coverage database
+    :type coverageDB: coveragekit.utils.db.CoverageDB
+    
+    :rtype: str
+    '''
+    dbLevelSet = set(coverageDB.levels)
+    
+    # Levels that are not columns of the db are computed from the depth histograms
+    queryLevelSet = set(levelsMax.keys() if levelsMax else []) | set(levelsMin.keys() if levelsMin else []) | set(levels)
+    if position is not None:
+        # Positional queries use the level intervals table, which only holds the db levels
+        if not queryLevelSet.issubset(dbLevelSet):
+            return "Positional queries are limited to the following levels: {}".format(coverageDB.levels)
+        if not coverageDB.hasIntervalTables:
+            return "The specified db has no interval tables, it was built by an older version and cannot be queried by position."
+    if (not queryLevelSet.issubset(dbLevelSet)) and (not coverageDB.hasHistograms):
+        return "The specified db only has the following levels available: {}".format(coverageDB.levels)
+    if (len(percentiles) > 0) and (not coverageDB.hasHistograms):
+        return "The specified db has no depth histograms, depth percentiles are not available."
+    return None
+
+def _prettifyCached(result, levelsMinKeys, levelsMaxKeys, coverageDB, reportLevels, percentiles, reportRegions, rowCache):
+    if rowCache is None:
+        return _prettifyResult(result, levelsMinKeys, levelsMaxKeys, coverageDB, reportLevels, percentiles = percentiles, reportRegions = reportRegions)
+    # Everything a prettified row depends on besides the row itself, regions are only reported for the db levels
+    key = (result[0], tuple(reportLevels), tuple(percentiles), reportRegions,
+           tuple(sorted(l for l in levelsMinKeys if l in coverageDB.levels)) if reportRegions else (),
+           tuple(sorted(l for l in levelsMaxKeys if l in coverageDB.levels)) if reportRegions else ())
+    prettifiedResult = rowCache.get(key)
+    if prettifiedResult is None:
+        prettifiedResult = _prettifyResult(result, levelsMinKeys, levelsMaxKeys, coverageDB, reportLevels, percentiles = percentiles, reportRegions = reportRegions)
+        rowCache[key] = prettifiedResult
+    return prettifiedResult
+
+def db(dbInput, genes = None, levelsMin = None, levelsMax = None, coverageMin = None, coverageMax = None, reportRegions = True, levels = (), percentiles = (), position = None, explain = False, coverageDB = None, rowCache = None):
+    '''Queries a coverage database. The query results of a gene query are a generator reading the database as they are reported.
+    
+    :param coverageDB: Already open handle on dbInput, opened here if None
+    :type coverageDB: coveragekit.utils.db.CoverageDB
+    :param rowCache: Dict-like cache of prettified region results of this database, shared between queries that report the same columns
+    :type rowCache: dict
+    
+    :rtype: dict
+    '''
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logger = logging.getLogger("coveragekit db")
     logger.setLevel(logging.INFO)
     
-    coverageDB = coveragekit.utils.db.CoverageDB(dbInput)
+    if coverageDB is None:
+        coverageDB = coveragekit.utils.db.CoverageDB(dbInput)
     
     if levelsMax:
         levelsMaxKeys = levelsMax.keys()
@@ -61,75 +191,120 @@ def db(dbInput, genes = None, levelsMin = None, levelsMax = None, coverageMin =
     else:
         levelsMinKeys = []
     
-    dbLevelSet = set(coverageDB.levels)
-
-    if (not set(levelsMaxKeys).issubset(dbLevelSet)) or (not set(levelsMinKeys).issubset(dbLevelSet)):
-        print "The specified db only has the following levels available: {}".format(coverageDB.levels)
+    error = queryError(coverageDB, levelsMin, levelsMax, levels, percentiles, position)
+    if error:
+        print error
         sys.exit(1)
     
-    returnedGenes = []
-   
+    dbLevelSet = set(coverageDB.levels)
+    queryLevelSet = set(levelsMaxKeys) | set(levelsMinKeys) | set(levels)
+    # Histograms hold no positions, so the regions of a level not stored in the db can not be rebuilt, its percents are still reported
+    missingRegionLevels = sorted((set(levelsMaxKeys) | set(levelsMinKeys)) - dbLevelSet)
+    if reportRegions and (len(missingRegionLevels) > 0):
+        logger.warning("Coverage regions are only reported for the db levels {}, levels {} are left out of coverageRegions".format(coverageDB.levels, missingRegionLevels))
+    reportLevels = sorted(dbLevelSet | queryLevelSet)
+    
     results = {"meta" : {}, "queryResults" : [], "notFound" : []}
     results["meta"]["version"] = __version__
     results["meta"]["dbSource"] = dbInput
     results["meta"]["coverageSource"] = coverageDB.coveragesource
     results["meta"]["regionSource"] = coverageDB.regionsource
     results["meta"]["dbLevels"] = coverageDB.levels
-    for result in coverageDB.query(genes, coverageMin, coverageMax, levelsMin, levelsMax):
-        results["queryResults"].append(_prettifyResult(result, levelsMinKeys, levelsMaxKeys, coverageDB.levels, reportRegions = reportRegions))
-        #returnedGenes.append(results["queryResults"][-1]["id"])
+    results["meta"]["reportLevels"] = reportLevels
+    results["meta"]["depthPercentiles"] = list(percentiles)
     
-    results["meta"]["queryString"] = coverageDB.mostRecentQuery
-    results["meta"]["queryResultNum"] = len(results["queryResults"])
+    if position is not None:
+        results["queryResults"] = _queryRange(coverageDB, position, levelsMin, levelsMax, coverageMin, coverageMax, reportRegions = reportRegions)
+        results["meta"]["queryString"] = "subregions overlapping {}:{}-{}".format(*position)
+        results["meta"]["queryResultNum"] = len(results["queryResults"])
+        return results
     
+    # Missing genes come from one anti-join before the query, as the query results are only read when they are reported
     if genes:
-        for result in coverageDB.query(genes):
-            returnedGenes.append(result[0])
-        notFound = set(genes)
-        notFound.difference_update(set(returnedGenes))
-        if notFound:
-            logger.warning("The following regions were not found in the coverage database: [{}]".format(",".join(notFound)))
-            results["notFound"].extend(list(notFound))
-            
-    results["queryResults"].sort(key=lambda k: k['id'])
-    return results
+        results["notFound"] = coverageDB.notFound(genes)
+        if len(results["notFound"]) > 0:
+            logger.warning("The following {} regions were not found in the coverage database: [{}{}]".format(len(results["notFound"]), ",".join(results["notFound"][:20]), ",..." if len(results["notFound"]) > 20 else ""))
     
-def report(results, reportRegions = True, jsonOut = None, tsvOut = None):
+    # Query results stream from the database sorted by id, report fills in queryResultNum once it has written them
+    results["queryResults"] = (_prettifyCached(result, levelsMinKeys, levelsMaxKeys, coverageDB, reportLevels, percentiles, reportRegions, rowCache)
+                               for result in coverageDB.query(genes, coverageMin, coverageMax, levelsMin, levelsMax))
+    results["meta"]["queryString"] = coverageDB.mostRecentQuery
+    results["meta"]["queryResultNum"] = None
+    if explain:
+        results["meta"]["queryPlan"] = coverageDB.queryPlan()
+    return results
 
-    if jsonOut:
-        with open(jsonOut, "w") as jsonFile:
-            jsonFile.write(json.dumps(results, indent = 4, sort_keys = True))
-            
-    if tsvOut:
-        with open(tsvOut, "w") as tsvFile:
-            atOrAbove = []
-            for l in results["meta"]["dbLevels"]:
-                atOrAbove.append("PercentAtOrAbove{}X".format(l))
-            
-            tsvFile.write("RegionID\tPosition\tAverageCoverage\t{}".format("\t".join(atOrAbove)))
-            if reportRegions:
-                tsvFile.write("\tRegionsLessThan\tRegionsGreaterThanOrEqual\n")
-            else:
-                tsvFile.write("\n")
-            for r in results["queryResults"]:
-                atOrAbove = []
-                for l in results["meta"]["dbLevels"]:
-                    atOrAbove.append(str(r["percentGreaterOrEqual"][l]))
-                tsvFile.write("{}\t{}\t{}\t{}".format(r["id"],r["position"],r["coverage"],"\t".join(atOrAbove)))
-                
-                if reportRegions:
-                    tsvFile.write("\t{}\t{}\n".format(json.dumps(r["coverageRegions"]["lessThan"]), json.dumps(r["coverageRegions"]["greaterOrEqual"])))
-                else:
-                    tsvFile.write("\n")
+def _indent(text, spaces, first = False):
+    lines = text.split("\n")
+    prefix = " " * spaces
+    return "\n".join([(prefix + lines[0]) if first else lines[0]] + [prefix + line for line in lines[1:]])
 
-            for r in results["notFound"]:
-                tsvFile.write("{}\tNot found in database\n".format(r))
+def _tsvLine(r, meta, reportRegions = True):
+    atOrAbove = []
+    for l in meta["reportLevels"]:
+        atOrAbove.append(str(r["percentGreaterOrEqual"][l]))
+    for p in meta["depthPercentiles"]:
+        atOrAbove.append(str(r["depthPercentiles"][p]))
+    line = "{}\t{}\t{}\t{}".format(r["id"],r["position"],r["coverage"],"\t".join(atOrAbove))
+    if reportRegions:
+        line += "\t{}\t{}\n".format(json.dumps(r["coverageRegions"]["lessThan"]), json.dumps(r["coverageRegions"]["greaterOrEqual"]))
+    else:
+        line += "\n"
+    return line
+    
+def writeResults(results, jsonFile = None, tsvFile = None, reportRegions = True):
+    '''Writes query results to open JSON and / or tsv files as they are read, so memory does not grow with the number of results. In the
+    JSON the meta section comes last, after the number of results is known.'''
+    if jsonFile:
+        jsonFile.write('{{\n    "notFound": {}, \n    "queryResults": ['.format(_indent(json.dumps(results["notFound"], indent = 4, sort_keys = True), 4)))
+    
+    if tsvFile:
+        atOrAbove = []
+        for l in results["meta"]["reportLevels"]:
+            atOrAbove.append("PercentAtOrAbove{}X".format(l))
+        for p in results["meta"]["depthPercentiles"]:
+            atOrAbove.append("DepthPercentile{:g}".format(p))
+        
+        tsvFile.write("RegionID\tPosition\tAverageCoverage\t{}".format("\t".join(atOrAbove)))
+        if reportRegions:
+            tsvFile.write("\tRegionsLessThan\tRegionsGreaterThanOrEqual\n")
+        else:
+            tsvFile.write("\n")
+    
+    queryResultNum = 0
+    for r in results["queryResults"]:
+        if jsonFile:
+            jsonFile.write("{}\n{}".format("" if queryResultNum == 0 else ", ", _indent(json.dumps(r, indent = 4, sort_keys = True), 8, first = True)))
+        if tsvFile:
+            tsvFile.write(_tsvLine(r, results["meta"], reportRegions = reportRegions))
+        queryResultNum += 1
+    results["meta"]["queryResultNum"] = queryResultNum
+    
+    if jsonFile:
+        jsonFile.write('\n    ], \n    "meta": {}\n}}'.format(_indent(json.dumps(results["meta"], indent = 4, sort_keys = True), 4)))
+    
+    if tsvFile:
+        for r in results["notFound"]:
+            tsvFile.write("{}\tNot found in database\n".format(r))
+
+def report(results, reportRegions = True, jsonOut = None, tsvOut = None):
+    jsonFile = open(jsonOut, "w") if jsonOut else None
+    tsvFile = open(tsvOut, "w") if tsvOut else None
+    try:
+        writeResults(results, jsonFile = jsonFile, tsvFile = tsvFile, reportRegions = reportRegions)
+    finally:
+        if jsonFile:
+            jsonFile.close()
+        if tsvFile:
+            tsvFile.close()
             
     print "\n\ncoveragekit db results:"
     print "--------------"
     print "DB coverage source:\t{}".format(results["meta"]["coverageSource"])
     print "DB region source:\t{}".format(results["meta"]["regionSource"])
     print "DB query string:\t{}".format(results["meta"]["queryString"])
+    if "queryPlan" in results["meta"]:
+        print "DB query plan:\t{}".format("; ".join(results["meta"]["queryPlan"]))
     print "Records retrieved:\t{}".format(results["meta"]["queryResultNum"])
     print "Genes not found in database:\t{}".format(len(results["notFound"]))
     if jsonOut:
@@ -138,23 +313,219 @@ def report(results, reportRegions = True, jsonOut = None, tsvOut = None):
         print "tsv output:\t{}".format(tsvOut)
     print "\n\n"
 
+def _queryDatabase(inputs):
+    '''Pool worker running the query of a multi-database query on one database. Writes its results to JSON and tsv files in the temporary
+    directory and returns their paths, or the error that stopped it, so only the paths go back to the parent process.'''
+    dbNum, dbInput, queryArgs, writeJSON, writeTSV, tmpDir = inputs
+    jsonFile = None
+    tsvFile = None
+    try:
+        if not os.path.isfile(dbInput):
+            raise Exception("Coverage database {} does not exist.".format(dbInput))
+        coverageDB = coveragekit.utils.db.CoverageDB(dbInput)
+        error = queryError(coverageDB, queryArgs["levelsMin"], queryArgs["levelsMax"], queryArgs["levels"], queryArgs["percentiles"], queryArgs["position"])
+        if error:
+            raise Exception(error)
+        results = db(dbInput, coverageDB = coverageDB, **queryArgs)
+        jsonPath = os.path.join(tmpDir, "{}.json".format(dbNum)) if writeJSON else None
+        tsvPath = os.path.join(tmpDir, "{}.tsv".format(dbNum)) if writeTSV else None
+        jsonFile = open(jsonPath, "w") if jsonPath else None
+        tsvFile = open(tsvPath, "w") if tsvPath else None
+        writeResults(results, jsonFile = jsonFile, tsvFile = tsvFile, reportRegions = queryArgs["reportRegions"])
+        return {"dbSource" : dbInput,
+                "coverageSource" : coverageDB.coveragesource,
+                "json" : jsonPath,
+                "tsv" : tsvPath,
+                "queryResultNum" : results["meta"]["queryResultNum"],
+                "notFoundNum" : len(results["notFound"]),
+                "error" : None}
+    except Exception as e:
+        return {"dbSource" : dbInput, "error" : str(e)}
+    finally:
+        if jsonFile:
+            jsonFile.close()
+        if tsvFile:
+            tsvFile.close()
+
+def _removeOutputs(outcome):
+    for path in (outcome.get("json"), outcome.get("tsv")):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def dbMulti(dbInputs, threads = 1, writeJSON = True, writeTSV = False, tmpDir = None, **queryArgs):
+    '''Runs the same query on many coverage databases, at most threads at a time so no more than threads databases are open at once. Each
+    database's results are written to files in a temporary directory, which are removed once the next outcome is asked for, so memory does
+    not grow with the results of the databases queried ahead of the one being reported.
+    
+    :param dbInputs: file paths for the coverage databases
+    :type dbInputs: list
+    :param threads: Number of worker processes
+    :type threads: int
+    :param writeJSON: Write the JSON of every database's results
+    :type writeJSON: bool
+    :param writeTSV: Write the tsv of every database's results
+    :type writeTSV: bool
+    :param tmpDir: Directory the temporary directory is made in, the system default if None
+    :type tmpDir: str
+    :param queryArgs: Keyword arguments of :func:`db`
+    
+    :returns: Dicts of dbSource, coverageSource, json and tsv file paths, queryResultNum, notFoundNum and error, or only dbSource and error
+              for a database that could not be queried, in the order of dbInputs as each finishes
+    :rtype: generator
+    '''
+    outputDir = tempfile.mkdtemp(prefix = "coveragekit_db_", dir = tmpDir)
+    inputs = [(dbNum, dbInput, queryArgs, writeJSON, writeTSV, outputDir) for dbNum, dbInput in enumerate(dbInputs)]
+    queryWorkers = None
+    try:
+        if (threads < 2) or (len(inputs) < 2):
+            outcomes = (_queryDatabase(curInputs) for curInputs in inputs)
+        else:
+            queryWorkers = Pool(processes = min(threads, len(inputs)))
+            outcomes = queryWorkers.imap(_queryDatabase, inputs)
+        for outcome in outcomes:
+            yield outcome
+            _removeOutputs(outcome)
+    finally:
+        if queryWorkers:
+            queryWorkers.terminate()
+            queryWorkers.join()
+        shutil.rmtree(outputDir, ignore_errors = True)
+
+def reportMulti(outcomes, jsonOut = None, tsvOut = None):
+    '''Writes the results of a multi-database query as they arrive, keyed by the coverage source of each database. The tsv results gain a
+    leading Sample column. Databases that could not be queried, have the coverage source of one already written or would give other tsv
+    columns than the first one are listed under "failed" without stopping the others.'''
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("coveragekit db")
+    logger.setLevel(logging.INFO)
+    
+    jsonFile = open(jsonOut, "w") if jsonOut else None
+    tsvFile = open(tsvOut, "w") if tsvOut else None
+    meta = {"version" : __version__, "dbSources" : [], "queryResultNum" : 0, "notFoundNum" : 0}
+    failed = []
+    samples = {}
+    tsvHeader = None
+    try:
+        if jsonFile:
+            jsonFile.write('{\n    "samples": {')
+        for outcome in outcomes:
+            meta["dbSources"].append(outcome["dbSource"])
+            if (outcome["error"] is None) and (outcome["coverageSource"] in samples):
+                outcome["error"] = "Coverage source {} was already reported from {}.".format(outcome["coverageSource"], samples[outcome["coverageSource"]])
+            if (outcome["error"] is None) and tsvFile:
+                with open(outcome["tsv"]) as resultsTSV:
+                    header = resultsTSV.readline().rstrip("\n")
+                if tsvHeader is None:
+                    tsvHeader = header
+                    tsvFile.write("Sample\t{}\n".format(header))
+                elif header != tsvHeader:
+                    outcome["error"] = "Results have the columns {} instead of {}.".format(header.split("\t"), tsvHeader.split("\t"))
+            if outcome["error"] is not None:
+                logger.warning("Could not query {}: {}".format(outcome["dbSource"], outcome["error"]))
+                failed.append({"dbSource" : outcome["dbSource"], "error" : outcome["error"]})
+                continue
+            
+            if jsonFile:
+                jsonFile.write("{}\n        {}: ".format("" if len(samples) == 0 else ", ", json.dumps(outcome["coverageSource"])))
+                with open(outcome["json"]) as resultsJSON:
+                    for lineNum, line in enumerate(resultsJSON):
+                        jsonFile.write(line if lineNum == 0 else "        " + line)
+            if tsvFile:
+                with open(outcome["tsv"]) as resultsTSV:
+                    resultsTSV.readline()
+                    for line in resultsTSV:
+                        tsvFile.write("{}\t{}".format(outcome["coverageSource"], line))
+            samples[outcome["coverageSource"]] = outcome["dbSource"]
+            meta["queryResultNum"] += outcome["queryResultNum"]
+            meta["notFoundNum"] += outcome["notFoundNum"]
+        
+        meta["numSamples"] = len(samples)
+        meta["numFailed"] = len(failed)
+        if jsonFile:
+            jsonFile.write('\n    }}, \n    "failed": {}, \n    "meta": {}\n}}'.format(_indent(json.dumps(failed, indent = 4, sort_keys = True), 4),
+                                                                                    _indent(json.dumps(meta, indent = 4, sort_keys = True), 4)))
+    finally:
+        if jsonFile:
+            jsonFile.close()
+        if tsvFile:
+            tsvFile.close()
+    
+    print "\n\ncoveragekit db results:"
+    print "--------------"
+    print "Databases queried:\t{}".format(len(meta["dbSources"]))
+    print "Databases failed:\t{}".format(meta["numFailed"])
+    print "Records retrieved:\t{}".format(meta["queryResultNum"])
+    print "Genes not found in databases:\t{}".format(meta["notFoundNum"])
+    if jsonOut:
+        print "JSON output:\t{}".format(jsonOut)
+    if tsvOut:
+        print "tsv output:\t{}".format(tsvOut)
+    print "\n\n"
+
+def parseRegion(region):
+    '''Returns the (chrom, start, stop) of a range given as chrom:start-end, raising ValueError if it is malformed.'''
+    # Chromosome names are stored without "chr", as they are read from the bed files
+    region = region.replace(",", "")
+    if region.startswith("chr"):
+        region = region[3:]
+    try:
+        chrom, span = region.rsplit(":", 1)
+        start, stop = [int(x) for x in span.split("-")]
+    except ValueError:
+        raise ValueError("must be given as chrom:start-end.")
+    if start >= stop:
+        raise ValueError("start must be smaller than its end.")
+    return (chrom, start, stop)
+
+def parseLevelCutoffs(cutoffs):
+    '''Returns a dict of coverage level : percent from a comma-separated list of level:percent ( eg '5:99,10:95,20:90' ), or None if empty.'''
+    if len(cutoffs) == 0:
+        return None
+    levelCutoffs = {}
+    for level in cutoffs.split(','):
+        key,value = level.split(':',1)
+        levelCutoffs[int(key)] = float(value)
+    return levelCutoffs
+
 def run(inputArgs):
     usage = "%prog --db sample.db [ options ]"
     parser = optparse.OptionParser(usage=usage, prog = "coveragekit db")
-    parser.add_option("-d","--db", dest="db", help="Input database.", default="")
+    parser.add_option("-d","--db", action="append", dest="db", help="Input database, given several times or as a quoted glob ( eg 'batch1/*.db' ) to query many databases.", default=[])
+    parser.add_option("--dbListFile", type="string", dest="dbListFile", help="File with newline-separated databases to query.", default="")
+    parser.add_option("-t","--threads", type="int", dest="threads", help="Number of databases queried at once when querying many databases [1].", default=1)
     parser.add_option("--geneList", type="string", dest="geneList", help="Comma-separated gene list.", default="")
     parser.add_option("--geneListFile", type="string", dest="geneListFile", help="File with newline-separated gene list.", default="")
+    parser.add_option("--region", type="string", dest="region", help="Report the subregions overlapping a range ( eg '17:41190000-41280000' ), using the same coordinates as the bed files.", default="")
     parser.add_option("--levelsMin", type="string", dest="levelsMin", help="Comma-separated list of minimum percents at X coverage with colon delimited coverage level prepended ( eg '5:99,10:95,20:90' ).", default="")
     parser.add_option("--levelsMax", type="string", dest="levelsMax", help="Comma-separated list of maximum percents at X coverage with colon delimited coverage level prepended ( eg '5:99,10:95,20:90' ).", default="")
     parser.add_option("--coverageMin", type="float", dest="coverageMin", help="Minimum average coverage.", default=None)
     parser.add_option("--coverageMax", type="float", dest="coverageMax", help="Maximum average coverage.", default=None)
-    parser.add_option("--reportRegions", action="store_true", dest="reportRegions", help="Report regions with coverage of intersest as JSON stings.", default=False)
+    parser.add_option("--levels", type="string", dest="levels", help="Comma-separated list of extra coverage levels to report, levels not stored in the db are computed from its depth histograms.", default="")
+    parser.add_option("--percentiles", type="string", dest="percentiles", help="Comma-separated list of depth percentiles to report for each region ( eg '5,50,95' ).", default="")
+    parser.add_option("--reportRegions", action="store_true", dest="reportRegions", help="Report regions with coverage of intersest as JSON stings, only for the levels stored in the db.", default=False)
+    parser.add_option("--explain", action="store_true", dest="explain", help="Add the SQLite query plan to the meta section of the output.", default=False)
     parser.add_option("--json", type="string", dest="json", help="Output JSON file.", default=None)
     parser.add_option("--tsv","--txt", type="string", dest="tsv", help="Output tsv file.", default=None)
     (options, args) = parser.parse_args(inputArgs)
 
     # Bam file is required as well as one output
-    if len(options.db) == 0: parser.error("Missing db, use -d or --db.")
+    # Several databases, a glob or a list file give the results of every database keyed by its coverage source
+    dbInputs = []
+    for curDB in options.db:
+        if glob.has_magic(curDB):
+            matches = sorted(glob.glob(curDB))
+            if len(matches) == 0: parser.error("No databases match {}.".format(curDB))
+            dbInputs.extend(matches)
+        else:
+            dbInputs.append(curDB)
+    if len(options.dbListFile) > 0:
+        with open(options.dbListFile) as dbListFile:
+            for line in dbListFile:
+                if len(line.strip()) > 0:
+                    dbInputs.append(line.strip())
+    if len(dbInputs) == 0: parser.error("Missing db, use -d, --db or --dbListFile.")
+    multi = (len(dbInputs) > 1) or (len(options.dbListFile) > 0) or any(glob.has_magic(curDB) for curDB in options.db)
+    if options.threads < 1: parser.error("--threads must be at least 1.")
     if (options.json is None) and (options.tsv is None): parser.error("Must specify an output with --json or --tsv")
     
     if (len(options.geneList) > 0) and (len(options.geneListFile) > 0):
@@ -169,24 +540,32 @@ def run(inputArgs):
     else:
         genes = None
     
-    if len(options.levelsMin) > 0:
-        levelsMin = {}
-        for level in options.levelsMin.split(','):
-            key,value = level.split(':',1)
-            levelsMin[int(key)] = float(value)
+    if len(options.region) > 0:
+        if genes is not None: parser.error("Cannot specify --region with --geneList or --geneListFile.")
+        if len(options.percentiles) > 0: parser.error("Cannot specify --region with --percentiles.")
+        try:
+            position = parseRegion(options.region)
+        except ValueError as e:
+            parser.error("--region {}".format(e))
     else:
-        levelsMin = None
-    
-    if len(options.levelsMax) > 0:
-        levelsMax = {}
-        for level in options.levelsMax.split(','):
-            #print level
-            key,value = level.split(':',1)
-            levelsMax[int(key)] = float(value)
-    else:
-        levelsMax = None
+        position = None
+    
+    levelsMin = parseLevelCutoffs(options.levelsMin)
+    levelsMax = parseLevelCutoffs(options.levelsMax)
+    
+    levels = tuple([int(x) for x in options.levels.split(",") if len(x) > 0])
+    percentiles = tuple([float(x) for x in options.percentiles.split(",") if len(x) > 0])
+    for percentile in percentiles:
+        if (percentile < 0) or (percentile > 100): parser.error("Percentiles must be between 0 and 100.")
+    
+    queryArgs = dict(genes = genes, levelsMin = levelsMin, levelsMax = levelsMax, coverageMin = options.coverageMin, coverageMax = options.coverageMax, reportRegions = options.reportRegions, levels = levels, percentiles = percentiles, position = position, explain = options.explain)
+    if multi:
+        outcomes = dbMulti(dbInputs, threads = options.threads, writeJSON = options.json is not None, writeTSV = options.tsv is not None,
+                           tmpDir = os.path.dirname(os.path.abspath(options.json or options.tsv)) if (options.json or options.tsv) else None, **queryArgs)
+        reportMulti(outcomes, jsonOut = options.json, tsvOut = options.tsv)
+        return
     
-    results = db(options.db, genes = genes, levelsMin = levelsMin, levelsMax = levelsMax, coverageMin = options.coverageMin, coverageMax = options.coverageMax, reportRegions = options.reportRegions)
+    results = db(dbInputs[0], **queryArgs)
     report(results, reportRegions = options.reportRegions, jsonOut = options.json, tsvOut = options.tsv)
 
 if __name__ == '__main__':
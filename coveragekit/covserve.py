@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+import os, json, sys, optparse, logging, collections, urlparse, StringIO
+import BaseHTTPServer, SocketServer
+
+import coveragekit.covdb as covdb
+import coveragekit.utils.db
+from coveragekit.version import __version__
+
+class LRUCache(object):
+    '''Dict-like cache holding at most maxSize entries, and if it is given a size function, values adding up to at most maxBytes. The least
+    recently used entries are evicted to make room for a new one.
+
+    '''
+
+    def get(self, key, default = None):
+        '''Returns the value cached for key and marks it as most recently used, or default if it is not cached.'''
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def _evictOldest(self, ):
+        evictedKey, evictedValue = self.entries.popitem(last = False)
+        self.totalBytes -= self.sizes.pop(evictedKey, 0)
+        if self.onEvict:
+            self.onEvict(evictedKey, evictedValue)
+
+    def __setitem__(self, key, value):
+        size = self.sizeOf(value) if self.sizeOf else 0
+        if key in self.entries:
+            self.pop(key)
+        while (len(self.entries) > 0) and ((len(self.entries) >= self.maxSize) or (self.totalBytes + size > self.maxBytes)):
+            self._evictOldest()
+        self.entries[key] = value
+        if self.sizeOf:
+            self.sizes[key] = size
+            self.totalBytes += size
+
+    def pop(self, key):
+        '''Removes the entry for key without evicting it and returns its value.'''
+        self.totalBytes -= self.sizes.pop(key, 0)
+        return self.entries.pop(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self, ):
+        return len(self.entries)
+
+    def keys(self, ):
+        '''Returns the cached keys from least to most recently used.'''
+        return self.entries.keys()
+
+    def clear(self, ):
+        '''Evicts every entry.'''
+        while len(self.entries) > 0:
+            self._evictOldest()
+
+    def __init__(self, maxSize, onEvict = None, maxBytes = None, sizeOf = None):
+        '''Initializer for LRUCache class.
+
+        :param maxSize: Maximum number of entries
+        :type maxSize: int
+        :param onEvict: Called with the key and value of every evicted entry
+        :type onEvict: function
+        :param maxBytes: Maximum total size of the values, only used with sizeOf, a value larger than this is the only entry of the cache
+        :type maxBytes: int
+        :param sizeOf: Function returning the size in bytes of a value, values are not sized if None
+        :type sizeOf: function
+
+        '''
+        if maxSize < 1:
+            raise Exception("Cache size must be at least 1, got {}.".format(maxSize))
+        self.maxSize = maxSize
+        self.onEvict = onEvict
+        self.maxBytes = maxBytes if (sizeOf is not None) and (maxBytes is not None) else float("inf")
+        self.sizeOf = sizeOf
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.totalBytes = 0
+
+class CoverageDBPool(object):
+    '''Class that keeps the most recently queried coverage databases open, each with a cache of its prettified region results. Databases are
+    opened read-only, the gene lists of queries go to connection private temporary tables. A database is reopened when its file changes, as
+    covbam replaces a database by renaming a new file over it.
+
+    '''
+
+    def _signature(self, path):
+        stat = os.stat(path)
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _close(self, path, entry):
+        self.logger.info("Closing coverage database {}".format(path))
+        entry[0].conn.close()
+
+    def get(self, path):
+        '''Returns an open handle on a coverage database, its row cache and the signature of the file it was opened from.
+
+        :param path: file path for the coverage database
+        :type path: str
+
+        :rtype: tuple
+        '''
+        if not os.path.isfile(path):
+            raise Exception("Coverage database {} does not exist.".format(path))
+        signature = self._signature(path)
+        entry = self.handles.get(path)
+        if (entry is not None) and (entry[2] != signature):
+            self.logger.info("Coverage database {} changed on disk, reopening".format(path))
+            self.handles.pop(path)
+            self._close(path, entry)
+            entry = None
+        if entry is None:
+            entry = (coveragekit.utils.db.CoverageDB(path, readOnly = True), LRUCache(self.rowCacheSize), signature)
+            self.handles[path] = entry
+        return entry
+
+    def close(self, ):
+        '''Closes every open coverage database.'''
+        self.handles.clear()
+
+    def __init__(self, maxOpen = 64, rowCacheSize = 1000):
+        '''Initializer for CoverageDBPool class.
+
+        :param maxOpen: Maximum number of coverage databases kept open
+        :type maxOpen: int
+        :param rowCacheSize: Maximum number of prettified region results cached for each open database
+        :type rowCacheSize: int
+
+        '''
+        self.logger = logging.getLogger("coveragekit serve")
+        self.logger.setLevel(logging.INFO)
+        self.rowCacheSize = rowCacheSize
+        self.handles = LRUCache(maxOpen, onEvict = self._close)
+
+def _listParameter(value, convert = str):
+    if isinstance(value, list):
+        return tuple([convert(x) for x in value])
+    return tuple([convert(x) for x in str(value).split(",") if len(x) > 0])
+
+def _levelCutoffs(value):
+    if isinstance(value, dict):
+        return dict((int(level), float(cutoff)) for level, cutoff in value.items()) if len(value) > 0 else None
+    return covdb.parseLevelCutoffs(str(value))
+
+def _flag(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("1", "true", "yes")
+
+def _queryArguments(parameters):
+    '''Returns the keyword arguments of covdb.db from the parameters of a query, named like the options of coveragekit db.'''
+    unknown = set(parameters.keys()) - set(["db", "geneList", "region", "levelsMin", "levelsMax", "coverageMin", "coverageMax", "levels", "percentiles", "reportRegions", "explain"])
+    if len(unknown) > 0:
+        raise ValueError("Unknown query parameters: {}".format(",".join(sorted(unknown))))
+    if not parameters.get("db"):
+        raise ValueError("Missing db.")
+
+    arguments = {}
+    arguments["genes"] = _listParameter(parameters["geneList"]) if parameters.get("geneList") else None
+    arguments["levelsMin"] = _levelCutoffs(parameters.get("levelsMin", ""))
+    arguments["levelsMax"] = _levelCutoffs(parameters.get("levelsMax", ""))
+    arguments["coverageMin"] = float(parameters["coverageMin"]) if parameters.get("coverageMin") not in (None, "") else None
+    arguments["coverageMax"] = float(parameters["coverageMax"]) if parameters.get("coverageMax") not in (None, "") else None
+    arguments["levels"] = _listParameter(parameters.get("levels", ""), int)
+    arguments["percentiles"] = _listParameter(parameters.get("percentiles", ""), float)
+    arguments["reportRegions"] = _flag(parameters.get("reportRegions", False))
+    arguments["explain"] = _flag(parameters.get("explain", False))
+    arguments["position"] = None
+    if parameters.get("region"):
+        if arguments["genes"] is not None: raise ValueError("Cannot specify region with geneList.")
+        if len(arguments["percentiles"]) > 0: raise ValueError("Cannot specify region with percentiles.")
+        try:
+            arguments["position"] = covdb.parseRegion(str(parameters["region"]))
+        except ValueError as e:
+            raise ValueError("region {}".format(e))
+    for percentile in arguments["percentiles"]:
+        if (percentile < 0) or (percentile > 100): raise ValueError("Percentiles must be between 0 and 100.")
+    return arguments
+
+class QueryService(object):
+    '''Class that answers coveragekit db queries from a pool of open coverage databases, with the JSON written by coveragekit db. Whole
+    results are cached by database file signature and query, so a repeated query is answered without reading the database. The cache is
+    bounded by the total size of the answers it holds, and answers larger than an eighth of it are not cached, so one genome-wide answer
+    does not push out every other one.
+
+    '''
+
+    def _resolve(self, db):
+        path = os.path.realpath(os.path.join(self.dbRoot, db))
+        if not path.startswith(self.dbRoot + os.sep):
+            raise ValueError("Database {} is outside of the database root {}.".format(db, self.dbRoot))
+        return path
+
+    def query(self, parameters):
+        '''Returns the JSON of one query, as written by coveragekit db --json.
+
+        :param parameters: Query parameters named like the options of coveragekit db, values as on the command line
+        :type parameters: dict
+
+        :rtype: str
+        '''
+        arguments = _queryArguments(parameters)
+        path = self._resolve(str(parameters["db"]))
+        coverageDB, rowCache, signature = self.pool.get(path)
+
+        key = (path, signature, str(parameters["db"])) + tuple((name, repr(arguments[name])) for name in sorted(arguments))
+        cached = self.results.get(key)
+        if cached is not None:
+            return cached
+
+        error = covdb.queryError(coverageDB, arguments["levelsMin"], arguments["levelsMax"], arguments["levels"], arguments["percentiles"], arguments["position"])
+        if error:
+            raise ValueError(error)
+        results = covdb.db(str(parameters["db"]), coverageDB = coverageDB, rowCache = rowCache, **arguments)
+        jsonFile = StringIO.StringIO()
+        covdb.writeResults(results, jsonFile = jsonFile, reportRegions = arguments["reportRegions"])
+        answer = jsonFile.getvalue()
+        if len(answer) <= self.maxAnswerBytes:
+            self.results[key] = answer
+        return answer
+
+    def batch(self, queries):
+        '''Returns the JSON list of the results of several queries, a query that fails gives an object with its error in its place.
+
+        :param queries: List of query parameter dicts
+        :type queries: list
+
+        :rtype: str
+        '''
+        answers = []
+        for parameters in queries:
+            try:
+                answers.append(self.query(parameters))
+            except Exception as e:
+                answers.append(json.dumps({"error" : str(e)}))
+        return "[\n{}\n]".format(",\n".join(answers))
+
+    def status(self, ):
+        '''Returns the open databases and the number and size of the cached results as JSON.
+
+        :rtype: str
+        '''
+        return json.dumps({"version" : __version__,
+                           "dbRoot" : self.dbRoot,
+                           "openDatabases" : self.pool.handles.keys(),
+                           "cachedResults" : len(self.results),
+                           "cachedBytes" : self.results.totalBytes}, indent = 4, sort_keys = True)
+
+    def __init__(self, dbRoot, maxOpen = 64, cacheSize = 10000, cacheBytes = 256 * 1024 * 1024, rowCacheSize = 1000):
+        '''Initializer for QueryService class.
+
+        :param dbRoot: Only databases under this directory are served, relative paths are relative to it
+        :type dbRoot: str
+        :param maxOpen: Maximum number of coverage databases kept open
+        :type maxOpen: int
+        :param cacheSize: Maximum number of cached query results
+        :type cacheSize: int
+        :param cacheBytes: Maximum total size in bytes of the cached query results
+        :type cacheBytes: int
+        :param rowCacheSize: Maximum number of cached region results for each open database
+        :type rowCacheSize: int
+
+        '''
+        self.dbRoot = os.path.realpath(dbRoot)
+        self.pool = CoverageDBPool(maxOpen, rowCacheSize)
+        self.results = LRUCache(cacheSize, maxBytes = cacheBytes, sizeOf = len)
+        self.maxAnswerBytes = cacheBytes // 8
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Handler for GET /query with the parameters of one query in the query string, POST /query with a JSON list of query parameter dicts,
+    or a {"queries" : [...]} object, and GET /status.
+
+    '''
+    server_version = "coveragekit/{}".format(__version__)
+
+    def _send(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self, ):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/status":
+            self._send(200, self.server.service.status())
+        elif url.path == "/query":
+            parameters = dict(urlparse.parse_qsl(url.query))
+            try:
+                self._send(200, self.server.service.query(parameters))
+            except Exception as e:
+                self._send(400, json.dumps({"error" : str(e)}))
+        else:
+            self._send(404, json.dumps({"error" : "Unknown path {}, use /query or /status.".format(url.path)}))
+
+    def do_POST(self, ):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/query":
+            self._send(404, json.dumps({"error" : "Unknown path {}, POST to /query.".format(url.path)}))
+            return
+        try:
+            queries = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+            if isinstance(queries, dict):
+                queries = queries["queries"]
+            if not isinstance(queries, list):
+                raise ValueError("Expected a list of queries.")
+        except (ValueError, KeyError) as e:
+            self._send(400, json.dumps({"error" : "Malformed query batch: {}".format(e)}))
+            return
+        self._send(200, self.server.service.batch(queries))
+
+    def address_string(self, ):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix socket"
+
+    def log_message(self, format, *args):
+        self.server.service.pool.logger.info("{} {}".format(self.address_string(), format % args))
+
+class UnixQueryServer(SocketServer.UnixStreamServer):
+    pass
+
+def serve(service, host = "127.0.0.1", port = 8765, socketPath = None):
+    '''Answers queries until interrupted, over HTTP on host:port or on a Unix socket.
+
+    :param service: Query service
+    :type service: QueryService
+    :param socketPath: file path for a Unix socket, used instead of host and port if given
+    :type socketPath: str
+
+    '''
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("coveragekit serve")
+    logger.setLevel(logging.INFO)
+
+    if socketPath:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = UnixQueryServer(socketPath, QueryHandler)
+        logger.info("Serving coverage databases under {} on {}".format(service.dbRoot, socketPath))
+    else:
+        server = BaseHTTPServer.HTTPServer((host, port), QueryHandler)
+        logger.info("Serving coverage databases under {} on http://{}:{}".format(service.dbRoot, host, port))
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.close()
+        if socketPath and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def run(inputArgs):
+    usage = "%prog [ options ]"
+    parser = optparse.OptionParser(usage=usage, prog = "coveragekit serve")
+    parser.add_option("--dbRoot", type="string", dest="dbRoot", help="Directory of the databases to serve, query db paths are relative to it. Current directory by default.", default=".")
+    parser.add_option("--host", type="string", dest="host", help="Address to listen on.", default="127.0.0.1")
+    parser.add_option("-p","--port", type="int", dest="port", help="Port to listen on.", default=8765)
+    parser.add_option("--socket", type="string", dest="socket", help="Listen on this Unix socket instead of host and port.", default=None)
+    parser.add_option("--maxOpen", type="int", dest="maxOpen", help="Maximum number of databases kept open.", default=64)
+    parser.add_option("--cacheSize", type="int", dest="cacheSize", help="Maximum number of cached query results.", default=10000)
+    parser.add_option("--cacheBytes", type="int", dest="cacheBytes", help="Maximum total size in bytes of the cached query results, larger answers than an eighth of it are not cached.", default=256 * 1024 * 1024)
+    parser.add_option("--rowCacheSize", type="int", dest="rowCacheSize", help="Maximum number of cached region results for each open database.", default=1000)
+    (options, args) = parser.parse_args(inputArgs)
+
+    if not os.path.isdir(options.dbRoot): parser.error("Database root {} is not a directory.".format(options.dbRoot))
+    if options.maxOpen < 1: parser.error("--maxOpen must be at least 1.")
+    if options.cacheSize < 1: parser.error("--cacheSize must be at least 1.")
+    if options.cacheBytes < 0: parser.error("--cacheBytes can not be negative.")
+    if options.rowCacheSize < 1: parser.error("--rowCacheSize must be at least 1.")
+
+    serve(QueryService(options.dbRoot, options.maxOpen, options.cacheSize, options.cacheBytes, options.rowCacheSize), host = options.host, port = options.port, socketPath = options.socket)
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
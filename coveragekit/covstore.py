@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import sys, os, optparse, json, logging
+
+import coveragekit.utils.region as covregion
+import coveragekit.utils.db as covdb
+import coveragekit.utils.bed as covbed
+import coveragekit.utils.histogram as covhistogram
+from coveragekit.utils.bam import BamRegion, genomeReport
+from coveragekit.utils.depthstore import DepthStore
+from coveragekit.utils.intervals import IntervalIndex
+
+from coveragekit.version import __version__
+
+def store(storeInput, regions, databases, levels):
+    '''Returns a dict of the genome and region coverage stats of a depth store written by coveragekit bam, for region files that need not be
+    those of the bam run, and builds coverage databases for them. No read is looked at, so the read counts, insert sizes and on target
+    percentages of a bam report are not available.
+
+    :param storeInput: file path for depth store
+    :type storeInput: str
+    :param regions: Dict of regions to assay coverage over with key:value pairs of region descriptor:region file path
+    :type regions: dict
+    :param databases: Dict of databases to build with key:value pairs of region descriptor:database file path
+    :type databases: dict
+    :param levels: List of integers corresponding to levels of coverage to consider
+    :type levels: list
+
+    :rtype: dict
+
+    '''
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("coveragekit store")
+    logger.setLevel(logging.INFO)
+
+    depthStore = DepthStore(storeInput)
+    metadata = depthStore.index
+    logger.info("Reading depth store of {} with {} runs".format(metadata.get("bamSource"), metadata["numRuns"]))
+
+    # Regions are ordered along the genome by chromosome, as the processing regions of a bam run are
+    chromosomeOrder = dict((chromosome["name"], rank) for rank, chromosome in enumerate(metadata["chromosomes"]))
+
+    regionSetAggregators = {}
+    storedRegions = {}
+    for descriptor, bedFile in regions.items():
+        regionSetAggregators[descriptor] = covregion.RegionSet(descriptor, levels)
+        unknownChromosomes = set()
+        for bedRegion in covbed.bedToRegions(descriptor, bedFile):
+            if not depthStore.hasChromosome(bedRegion.chrom):
+                unknownChromosomes.add(bedRegion.chrom)
+                continue
+            start = max(bedRegion.start, 0)
+            stop = min(bedRegion.stop, depthStore.chromosomeLength(bedRegion.chrom))
+            if stop <= start:
+                continue
+            region = covregion.Region(bedRegion.chrom, start, stop, bedRegion.name, bedRegion.regionSet, bedRegion.index)
+            bamRegion = BamRegion(region, tuple(levels))
+            bamRegion.addDepths(start, depthStore.depth(region.chrom, start, stop))
+            subRegionResult = bamRegion.report()
+            regionSetAggregators[descriptor].add(subRegionResult[0], subRegionResult[1], chromosomeOrder[region.chrom], subRegionResult[2])
+            storedRegions.setdefault(region.chrom, []).append(region)
+        if len(unknownChromosomes) > 0:
+            logger.warning("Regions of {} on chromosomes not in the bam were skipped: {}".format(bedFile, ",".join(sorted(unknownChromosomes))))
+    logger.info("Computed coverage of {} regions".format(sum(len(chromRegions) for chromRegions in storedRegions.values())))
+
+    # Genome coverage comes from the runs alone
+    depthHistogram = covhistogram.Histogram()
+    depthHistogram.addCounts(depthStore.depthCounts())
+    genomeLength = sum(chromosome["length"] for chromosome in metadata["chromosomes"])
+    genomeCoverage = sum(value * count for value, count in depthHistogram.items())
+
+    report = {}
+    report["version"] = __version__
+    report["depthStore"] = storeInput
+    report["inputBam"] = metadata.get("bamSource")
+    report["genome"] = genomeReport(genomeCoverage, genomeLength, depthHistogram, (0,) + tuple(l for l in sorted(levels) if l != 0))
+    report["regionStats"] = covregion.regionStats(regionSetAggregators, regions)
+
+    # Databases record the same total coverage as those of a bam run: the whole genome for a genome run, the bases of the regions otherwise
+    if metadata.get("genome"):
+        totalCoverage = genomeCoverage
+    else:
+        totalCoverage = 0
+        for chrom, chromRegions in storedRegions.items():
+            for start, stop in IntervalIndex(chromRegions).merged():
+                totalCoverage += int(depthStore.depth(chrom, start, stop).sum(dtype="int64"))
+
+    covdb.joinCoverageDBs(covdb.startCoverageDBs(databases, regionSetAggregators, regions, metadata.get("bamSource"), metadata.get("mapq", 1), metadata.get("dups", False), totalCoverage), logger)
+
+    logger.info("Finished.")
+
+    return report
+
+def report(data, jsonOut = None, txtOut = None):
+    if txtOut:
+        with open(txtOut, "w") as txtFH:
+            txtFH.write("coveragekit store (v{}) -- text report".format(data["version"]))
+            txtFH.write("\n\nInput depth store:\t{}\n".format(data["depthStore"]))
+            txtFH.write("Input BAM file:\t{}\n".format(data["inputBam"]))
+            txtFH.write("Text report file:\t{}\n".format(txtOut))
+            if jsonOut:
+                txtFH.write("JSON report file:\t{}\n".format(jsonOut))
+
+            txtFH.write("\nAverage genome-wide coverage:\t{}\n".format(data["genome"]["avgCoverage"]))
+            txtFH.write("Median genome-wide coverage:\t{}\n".format(data["genome"]["medianCoverage"]))
+            txtFH.write("Genome percent at X coverage or greater:\n")
+            for key,value in sorted(data["genome"]["coverageLevels"].items(), key=lambda x: int(x[0])):
+                txtFH.write("\t{}X:\t{:3.2f}\n".format(key,(value*100)))
+
+            txtFH.write("Region stats:\n")
+            for regionNames,stats in data["regionStats"].items():
+                txtFH.write("\t{}:\n".format(regionNames))
+                txtFH.write("\t\tRegion file:\t{}\n".format(stats["file"]))
+                txtFH.write("\t\tNumber of regions:\t{}\n".format(stats["numRegions"]))
+                txtFH.write("\t\tLength:\t{}\n".format(stats["length"]))
+                txtFH.write("\t\tAverage Coverage:\t{}\n".format(stats["avgCoverage"]))
+                txtFH.write("\t\tPercent at X coverage or greater:\n")
+                for key,value in stats["coverageLevels"].items():
+                    txtFH.write("\t\t\t{}X:\t{:3.2f}\n".format(key,(value*100)))
+
+    if jsonOut:
+        with open(jsonOut, "w") as jsonFH:
+            jsonFH.write(json.dumps(data, indent=4, sort_keys=True))
+
+def run(inputArgs):
+    usage = "%prog --store sample.ckds -r reference:file.bed"
+    parser = optparse.OptionParser(usage=usage, prog = "coveragekit store")
+    parser.add_option("-s","--store", dest="store", help="Input depth store, written by coveragekit bam --depthStore.", default="")
+    parser.add_option("-r","--regions", action="append", dest="regions", help="Region file in bed format prepended with colon-delimited descriptor ( eg 'reference:file.bed' ).", default=[])
+    parser.add_option("-d","--databases", action="append", dest="databases", help="Database files to build prepended with colon-delimited descriptor to match region file ( eg 'reference:file.db' ).", default=[])
+    parser.add_option("-l","--levels", type="string", dest="levels", help="Comma-separated coverage levels for reporting ['5,10,20,50,100'].", default="5,10,20,50,100")
+    parser.add_option("--json", type="string", dest="json", help="Output file for json doc.", default=None)
+    parser.add_option("--txt", type="string", dest="txt", help="Output file for txt report.", default=None)
+    (options, args) = parser.parse_args(inputArgs)
+
+    # Depth store is required as well as one output
+    if len(options.store) == 0: parser.error("Missing depth store, use --store or -s.")
+    if not os.path.isfile(options.store): parser.error("Depth store {} does not exist.".format(options.store))
+    if (options.json is None) and (options.txt is None): parser.error("Must specify an output with --json or --txt")
+
+    # Multiple region files can be submitted
+    regions = {}
+    for curRegion in options.regions:
+        descriptorSplit = curRegion.split(":",1)
+        if len(descriptorSplit) != 2:
+            parser.error("Region files must have colon-delimited descriptor prepended.")
+        regions[descriptorSplit[0]] = descriptorSplit[1]
+
+    # Multiple database files can be submitted
+    databases = {}
+    for curDB in options.databases:
+        descriptorSplit = curDB.split(":",1)
+        if len(descriptorSplit) != 2:
+            parser.error("Database files must have colon-delimited descriptor prepended.")
+        databases[descriptorSplit[0]] = descriptorSplit[1]
+    if len(set(databases.keys()).difference(set(regions.keys()))) > 0:
+        parser.error("Database descriptors must match colon-delimited region file descriptors.")
+
+    # Convert string of levels into sorted list of levels
+    levels = sorted([int(i) for i in options.levels.split(',')])
+    coverageReport = store(options.store, regions, databases, levels)
+    report(coverageReport, options.json, options.txt)
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
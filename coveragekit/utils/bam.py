@@ -1,46 +1,148 @@
-import pysam, logging, math
+import pysam, logging, math, array, hashlib, struct, re, bisect
+import numpy
+import coveragekit.utils.bamindex as bamindexkit
+import coveragekit.utils.depth as depthkit
+import coveragekit.utils.depthstore as depthstorekit
+import coveragekit.utils.histogram as histogramkit
+import coveragekit.utils.intervals as intervalkit
 import coveragekit.utils.levels as levelkit
-import coveragekit.utils.regioncaller as regioncaller
 import coveragekit.utils.region as regionkit
 
 from coveragekit.version import __version__
 
+def readHash(readName):
+    '''Returns a 64-bit integer identity for a read name (with its mate number appended). The hash does not depend on the process or the
+    Python hash seed.
+    
+    :param readName: Read name with mate number, eg "{query_name}.1"
+    :type readName: str
+    
+    :rtype: int
+    
+    '''
+    return struct.unpack("<q", hashlib.md5(readName).digest()[:8])[0]
+
+def pairInsertLength(bamRead):
+    '''Returns the insert length of a proper pair from its leftmost mate alone, so the length does not depend on where the mates are read.
+    The insert is made of the aligned and inserted bases of the leftmost mate up to the start of its mate, the reference bases between the
+    mates, and the aligned and inserted bases of the mate. Deleted and skipped reference bases are left out. The mate's bases come from its
+    cigar in the MC tag, or from the template length if the bam has no MC tags.
+    
+    :param bamRead: Leftmost mate of a proper pair
+    :type bamRead: pysam.AlignedSegment
+    
+    :rtype: int
+    
+    '''
+    mateStart = bamRead.next_reference_start
+    position = bamRead.reference_start
+    insertLength = 0
+    for operation, length in bamRead.cigartuples:
+        if operation in [0,7,8,2,3]:
+            # Bases of the leftmost mate past the start of its mate are counted with the mate
+            overlapping = (length + position) >= mateStart
+            if overlapping:
+                length = mateStart - position
+            position += length
+            if operation not in [2,3]:
+                insertLength += length
+            if overlapping:
+                break
+        elif operation == 1:
+            insertLength += length
+    insertLength += mateStart - position
+    
+    if bamRead.has_tag("MC"):
+        insertLength += sum(int(length) for length, operation in re.findall(r"(\d+)([MIDNSHP=X])", bamRead.get_tag("MC")) if operation in "MI=X")
+    else:
+        insertLength += max(bamRead.reference_start + bamRead.template_length - mateStart, 0)
+    return insertLength
+
+def countReads(bam, chrom, qualityCutoff = 1, allowdups = False):
+    '''Counts the reads of one chromosome / contig with the same filters as :class:`BamReader`, looking only at flags and mapping quality.
+    The counting is done by samtools so no read is decoded in Python, which makes it cheap enough to give whole-bam totals when the
+    readers only fetch target intervals.
+    
+    :param bam: file path for bam file
+    :type bam: str
+    :param chrom: Chromosome / contig name as given in the bam header
+    :type chrom: str
+    :param qualityCutoff: Minimum mapping quality score to make a read eligible for counting
+    :type qualityCutoff: int
+    :param allowdups: Boolean indicating whether duplicate reads should be counted
+    :type allowdups: bool
+    
+    :returns: (int number of reads counted, dict of uncounted stats)
+    :rtype: tuple
+    
+    '''
+    def viewCount(*args):
+        return int(pysam.samtools.view("-c", *(args + (bam, chrom))).strip())
+    
+    # Flags: 0x4 unmapped, 0x100 secondary, 0x400 duplicate, 0x800 supplementary
+    mappedFlags = 0x4 if allowdups else 0x4 | 0x400
+    uncountedMetrics = {"unmapped" : viewCount("-f", "0x4"), "duplicate" : 0, "mapquality" : 0}
+    if not allowdups:
+        uncountedMetrics["duplicate"] = viewCount("-F", "0x4", "-f", "0x400")
+    if qualityCutoff > 0:
+        uncountedMetrics["mapquality"] = viewCount("-F", str(mappedFlags)) - viewCount("-F", str(mappedFlags), "-q", str(qualityCutoff))
+    readCount = viewCount("-F", str(mappedFlags | 0x100 | 0x800), "-q", str(qualityCutoff))
+    return (readCount, uncountedMetrics)
+
+def genomeReport(totalCoverage, totalLength, depthHistogram, levels):
+    '''Returns the genome section of a bam report: the average, median and percentiles of the depth and the fraction of bases at or above
+    each level.
+    
+    :param totalCoverage: Sum of the depth of every base
+    :type totalCoverage: int
+    :param totalLength: Number of bases
+    :type totalLength: int
+    :param depthHistogram: Histogram of the depth of every base
+    :type depthHistogram: Histogram
+    :param levels: Coverage levels
+    :type levels: sequence
+    
+    :rtype: dict
+    
+    '''
+    report = { "avgCoverage" : float(totalCoverage) / totalLength }
+    report["medianCoverage"] = depthHistogram.percentile(50)
+    report["coveragePercentiles"] = {}
+    for percentile in [5, 25, 75, 95]:
+        report["coveragePercentiles"][str(percentile)] = depthHistogram.percentile(percentile)
+    report["coverageLevels"] = {}
+    for level in levels:
+        report["coverageLevels"][level] = depthHistogram.atLeast(level) / float(depthHistogram.total())
+    report["depthHistogram"] = depthHistogram.items()
+    return report
+
 class BamRegion(object):
-    ''' Class that extends the :class:`Region` class by adding callers to the :class:`CoverageLevel` class, and the onTarget attribute which keeps track of on-target reads.
+    ''' Class that extends the :class:`Region` class by adding callers to the :class:`CoverageLevel` class.
 
     '''
 
-    def add(self, pos, depth):
-        '''Makes a call to the add method of the coverageLevel attribute, adding the depth at a given position to the coverage statistics for a region.
+    def addDepths(self, pos, depths):
+        '''Makes a call to the addDepths method of the coverageLevel attribute, adding a run of depths starting at a given position to the coverage statistics for a region.
+        The depths are also counted in the depth histogram of the region.
         
-        :param pos: Chromosome coordinate (bp position).
+        :param pos: Chromosome coordinate (bp position) of the first depth.
         :type pos: int
-        :param depth: Depth of non-redundant, quality coverage
-        :type depth: int
+        :param depths: Depth of non-redundant, quality coverage for consecutive positions
+        :type depths: numpy.ndarray
         
         '''
-        self.coverageLevel.add(pos, depth)
+        self.coverageLevel.addDepths(pos, depths)
+        if len(depths) > 0:
+            self.depthHistogram.addCounts(numpy.bincount(depths))
     
-    def addOverlap(self, pos, read):
-        '''Adds a read to the onTarget attribute.
-        
-        :param pos: Chromosome coordinate (bp position).
-        :type pos: int
-        :param read: Read id
-        :type read: str
-        
-        '''
-        if pos >= self.region.start: # This if statement ensures against edge-case where read alignment end doesn't cover a region due to clipping
-            self.onTarget.update([read])
-
     def report(self, ):
         '''Returns a tuple with basic coverage metrics for a BamRegion.
         
-        :returns: Tuple with format of (region object describing the bam region, set of read names overlapping with the region, CoverageLevel report)        
+        :returns: Tuple with format of (region object describing the bam region, CoverageLevel report, binned depth histogram as [depth, bp] pairs)
         :rtype: tuple
         
         '''
-        return (self.region, self.onTarget, self.coverageLevel.report())
+        return (self.region, self.coverageLevel.report(), self.depthHistogram.binned())
 
     def __init__(self, region, levels):
         '''Initializer for BamRegion class.
@@ -52,8 +154,8 @@ class BamRegion(object):
         
         '''
         self.region = region
-        self.onTarget = set()
         self.coverageLevel = levelkit.CoverageLevel(self.region.start, self.region.stop, levels)
+        self.depthHistogram = histogramkit.Histogram()
 
 class BamReader(object):
     '''Class that reads part of a bam file and report backs coverage stats. The largest part that can be read is a chromosome / contig  listed in bam header.'''
@@ -65,62 +167,67 @@ class BamReader(object):
         
         In the second part, the pileup is walked over and used to calculate depth of coverage.
         
-        '''
-        coverage = [0 for x in range(self.region.length)]
+        Reads that overlap several chunks are fetched by each of them. Every chunk adds their bases to its depth profile, but a read is
+        only counted (read totals, uncounted stats, insert sizes) by the chunk containing its reference_start, so a pair's insert size is
+        counted by the chunk of its leftmost mate. It is counted on target for a region set by the chunk holding the first part of the read
+        that overlaps that region set, which each chunk can work out locally from the stop of the last region set target before it. Chunk
+        results therefore never overlap and can be aggregated in any order.
         
-        # Set cutoffs for updating region caller
-        sortedSubregionStarts = list(reversed(sorted(self.subregionStarts.keys())))
-        sortedSubregionStops = list(reversed(sorted(self.subregionStops.keys())))
-        if len(sortedSubregionStarts) > 0:
-            subRegionBasement = sortedSubregionStarts.pop()
-        else:
-            subRegionBasement = float("inf")
-            
-        if len(sortedSubregionStops) > 0:
-            subRegionCeiling = sortedSubregionStops.pop()
-        else:
-            subRegionCeiling = float("inf")
+        When only target intervals are fetched the reads outside them are never seen, so the read totals and uncounted stats are left at
+        zero and should be taken from :func:`countReads` instead.
         
-        overlapRegionCaller = regioncaller.RegionCaller()
-        overlapRegionCaller["_self"] = self.subregions[0].addOverlap
+        If the reader has a splitter it reports the position it has reached every 256 reads, and it may be asked to end the chunk early so
+        that the rest of it can be handed to an idle worker (see :meth:`_checkSplit`).
+        
+        '''
+        depthAccumulator = depthkit.DepthAccumulator(self.region.start, self.region.stop)
         
-        # The readTracker will keep track of insert lengths
-        readTracker = {}        
+        # Spans of counted reads (clipped to the chunk) and their alignment starts, used to assign reads to subregions once all of them are parsed
+        readStarts = array.array('i')
+        readStops = array.array('i')
+        readAlignmentStarts = array.array('i')
         
         # Iterate over bam reads
         chunkCount = 0
         for bamRead in self.bamReads:
+            if self.splitter is not None:
+                chunkCount += 1
+                if chunkCount % 256 == 0:
+                    self._checkSplit(bamRead.reference_start)
+                
+                # The chunk may have been shortened by a split, reads starting past its new stop belong to the rest of the chunk
+                if bamRead.reference_start >= self.region.stop:
+                    break
+            
+            # Reads hanging off the start of the chunk are owned, and counted, by an earlier chunk
+            owned = bamRead.reference_start >= self.region.start
             if ((not bamRead.is_duplicate) or (self.allowdups)) and (bamRead.mapping_quality >= self.qualityCutoff) and (not bamRead.is_unmapped) and (not bamRead.is_secondary) and (not bamRead.is_supplementary):
                 # Read names in bam format don't necessarily distinguish between 1st or second read in pair, so we make this explicit
                 if bamRead.is_read1:
                     readName = "{}.1".format(bamRead.query_name)
                 else:
                     readName = "{}.2".format(bamRead.query_name)
-                if bamRead.reference_start < self.region.start:
+                if self.readIdentity == "hash":
+                    readName = readHash(readName)
+                if not owned:
                     readStart = self.region.start
-                    
-                    # Want to keep track of reads hanging off of this chunk so that we don't double count
-                    self.firstColumn.append(readName)
                 else:
                     readStart = bamRead.reference_start
                 
                 if bamRead.reference_end > self.region.stop:
                     readStop = self.region.stop
-                    
-                    # Want to keep track of reads hanging off of this chunk so that we don't double count
-                    self.lastColumn.append(readName)
                 else:
                     readStop = bamRead.reference_end
                  
-                # Coverage assessment using cigar string to figure out covered regions
-                coveragePos = readStart
-                insertLength = 0
+                # Coverage assessment using cigar string to figure out covered regions, walked from the true alignment start so that reads
+                # hanging off the start of the chunk put their bases in the right place
+                coveragePos = bamRead.reference_start
                 cigarTuples = list(reversed(bamRead.cigartuples))
                 while len(cigarTuples) > 0:
                     cigar = cigarTuples.pop()
-                    if (cigar[0] in [0,7,8,2,3]): # Alignment match, sequence match, sequence mismatch - all of these add to length of insert as well coverage profile. Deletion or skip handled below
+                    if (cigar[0] in [0,7,8,2,3]): # Alignment match, sequence match, sequence mismatch, deletion or skip - all of these add to the coverage profile
                         
-                        # If the aligned portion of the read extends past the start of the paired alignment the read is overlapping and we don't count this towards coverage or insert length
+                        # If the aligned portion of the read extends past the start of the paired alignment the read is overlapping and we don't count this towards coverage
                         if ((cigar[1] + coveragePos) >= bamRead.next_reference_start) and (bamRead.is_proper_pair) and (bamRead.template_length >= 0):
                             endPoint = bamRead.next_reference_start - coveragePos
                             cigarTuples = [] # Causes loop to exit after this operation
@@ -131,178 +238,191 @@ class BamReader(object):
                         if (coveragePos + endPoint) > self.region.stop:
                             endPoint = self.region.stop - coveragePos
                         
-                        # Increment coverage array
-                        for c in range((coveragePos - self.region.start),((coveragePos - self.region.start) + endPoint)):
-                            coverage[c] += 1
+                        # Record the covered block clipped to the chunk, the depth profile is built from these events once the reads are parsed
+                        blockStart = max(coveragePos, self.region.start)
+                        if (coveragePos + endPoint) > blockStart:
+                            depthAccumulator.addBlock(blockStart, coveragePos + endPoint)
                             
                         coveragePos += endPoint
                         
-                        # Increase insert length unless there is a deletion from reference or skipped reference. Counts towards coverage profile but not insert length
-                        if cigar[0] not in [2,3]:
-                            insertLength += endPoint
-                        
-                    elif (cigar[0] == 1): # Insertion to reference. Does not count towards insert length, but not coverage profile. Maybe this should include soft clipping
-                        insertLength += cigar[1]
-                        
-                    #elif (cigar[0] in [4,5]): # Soft or hard clipping - Neither count towards insert length or coverage profile - it could be argued that soft clipping should
+                    #elif (cigar[0] in [1,4,5]): # Insertion, soft or hard clipping - None count towards the coverage profile
                     #    pass
                         
-                # Update the overlap event handler
-                while readStop >= subRegionBasement:
-                    for i in self.subregionStarts[subRegionBasement]:
-                        overlapRegionCaller[self.subregions[i+1].region.index] = self.subregions[i+1].addOverlap
-                    if len(sortedSubregionStarts) > 0:
-                        subRegionBasement = sortedSubregionStarts.pop()
-                    else:
-                        subRegionBasement = float("inf")
-                        break
-                while readStart >= subRegionCeiling:
-                    for i in self.subregionStops[subRegionCeiling]:
-                        del overlapRegionCaller[self.subregions[i+1].region.index]
-                    if len(sortedSubregionStops) > 0:
-                        subRegionCeiling = sortedSubregionStops.pop()
-                    else:
-                        subRegionCeiling = float("inf")
-                        break
-                overlapRegionCaller(readStop-1,readName)
+                readStarts.append(readStart)
+                readStops.append(readStop)
+                readAlignmentStarts.append(bamRead.reference_start)
+                self.readIds.append(readName)
                 
-                # Calculate insert size
-                if (bamRead.is_proper_pair):
-                    if bamRead.query_name in readTracker:
-                        insertLength += readTracker[bamRead.query_name]
-                        del readTracker[bamRead.query_name]
-                        #if insertLength > 10000:
-                        #    print bamRead
-                        self.insertLengths.append(insertLength)
-                    else:
-                        readTracker[bamRead.query_name] = insertLength + (bamRead.next_reference_start - coveragePos)
-                chunkCount += 1
+                # Calculate insert size, a pair is counted once by the chunk that owns its leftmost mate, the mate passing the mapping quality
+                # cutoff if its MQ tag is there
+                if owned and bamRead.is_proper_pair and ((bamRead.template_length > 0) or ((bamRead.template_length == 0) and bamRead.is_read1)):
+                    if (not bamRead.has_tag("MQ")) or (bamRead.get_tag("MQ") >= self.qualityCutoff):
+                        self.insertLengths.append(pairInsertLength(bamRead))
+            elif (not owned) or (self.targetFetch):
+                continue
             elif bamRead.is_unmapped:
                 self.uncountedMetrics["unmapped"] += 1
             elif bamRead.is_duplicate and not self.allowdups:
                 self.uncountedMetrics["duplicate"] += 1
             elif bamRead.mapping_quality < self.qualityCutoff:
                 self.uncountedMetrics["mapquality"] += 1
-        self.logger.debug(chunkCount)
-        
-        if (len(self.subregions) > 1) or (self.genome == True):
-            # Reset cutoffs for updating new region caller
-            sortedSubregionStarts = list(reversed(sorted(self.subregionStarts.keys())))
-            sortedSubregionStops = list(reversed(sorted(self.subregionStops.keys())))  
-            if len(sortedSubregionStarts) > 0:
-                subRegionBasement = sortedSubregionStarts.pop()
-            else:
-                subRegionBasement = float("inf")
-                
-            if len(sortedSubregionStops) > 0:
-                subRegionCeiling = sortedSubregionStops.pop()
-            else:
-                subRegionCeiling = float("inf")
+        
+        # Read-to-target overlap is a single batch query of all read spans against the subregion index
+        overlapMasks = self.subregionIndex.overlaps(readStarts, readStops)
+        alignmentStarts = numpy.frombuffer(readAlignmentStarts, dtype=numpy.int32)
+        ownedMask = alignmentStarts >= self.region.start
+        
+        # A read already overlapped a region set before this chunk if it starts before the stop of that set's last earlier target
+        for regionSet in overlapMasks.keys():
+            if regionSet in self.precedingStops:
+                overlapMasks[regionSet] &= ownedMask | (alignmentStarts >= self.precedingStops[regionSet])
+        
+        if self.readIdentity == "hash":
+            readIds = numpy.frombuffer(self.readIds, dtype='l')
             
-            coverageRegionCaller = regioncaller.RegionCaller()
-            coverageRegionCaller["_self"] = self.subregions[0].add
+            # Every counted read in a chunk is a distinct read/mate, so fewer distinct hashes than reads means two names collided.
+            # Redo the chunk with names so that the counts stay exact.
+            if len(numpy.unique(readIds)) != len(readIds):
+                self.logger.warning("Read hash collision in {}, counting this chunk by read name".format(self.region))
+                self.readIdentity = "name"
+                self._reset()
+                self.bamReads = self._fetch()
+                return self.read()
             
-            # Iterate over the coverage profile
-            pos = 0
-            while pos < len(coverage):
-                depth = coverage[pos]
-                # Update the event handler
-                while (pos + self.region.start) >= subRegionBasement: # If the current position is after or equal to the first base of the next set of regions in the caller, see if we need to add more regions to the caller
-                    for i in self.subregionStarts[subRegionBasement]:
-                        coverageRegionCaller[self.subregions[i+1].region.index] = self.subregions[i+1].add
-                    if len(sortedSubregionStarts) > 0:
-                        subRegionBasement = sortedSubregionStarts.pop()
-                    else:
-                        subRegionBasement = float("inf")
-                        break
-                        
-                while (pos + self.region.start) >= subRegionCeiling: # If the current position is after or equal to the last base of a set of regions in the caller, delete those regions from the caller
-                    for i in self.subregionStops[subRegionCeiling]:
-                        del coverageRegionCaller[self.subregions[i+1].region.index]
-                    if len(sortedSubregionStops) > 0:
-                        subRegionCeiling = sortedSubregionStops.pop()
-                    else:
-                        subRegionCeiling = float("inf")
-                        break
-                
-                if (len(coverageRegionCaller) > 1) or (self.genome == True):
-                    # Make a call to the event handler
-                    coverageRegionCaller((pos + self.region.start), depth)
-                    pos += 1
-                elif subRegionBasement < float("inf"):
-                    pos = subRegionBasement - self.region.start
-                else:
-                    break
+            if not self.targetFetch:
+                self.readCount = len(numpy.unique(readIds[ownedMask]))
+            for regionSet, overlapMask in overlapMasks.items():
+                self.onTarget[regionSet] = numpy.unique(readIds[overlapMask])
+        else:
+            if not self.targetFetch:
+                self.readCount = len(set(self.readIds[i] for i in numpy.flatnonzero(ownedMask).tolist()))
+            for regionSet, overlapMask in overlapMasks.items():
+                self.onTarget[regionSet] = set(self.readIds[i] for i in numpy.flatnonzero(overlapMask).tolist())
+        
+        if (len(self.subregions) > 0) or (self.genome == True) or (self.keepDepthRuns):
+            coverage = depthAccumulator.depth()[:self.region.length]
+            if self.keepDepthRuns:
+                self.depthRuns = depthstorekit.runLengths(coverage, self.region.start)
+            
+            # The chunk itself covers the whole window for a genome, reduced to a histogram of depths, otherwise only the bases that fall in
+            # at least one subregion
+            if self.genome == True:
+                self.chunkCoverage = int(coverage.sum(dtype=numpy.int64))
+                self.depthHistogram = histogramkit.Histogram()
+                self.depthHistogram.addCounts(numpy.bincount(coverage))
+            else:
+                for mergedStart, mergedStop in self.subregionIndex.merged():
+                    self.chunkCoverage += int(coverage[(mergedStart - self.region.start):(mergedStop - self.region.start)].sum(dtype=numpy.int64))
+            
+            # Each subregion gets its own slice of the depth profile
+            for subregion in self.subregions:
+                subregion.addDepths(subregion.region.start, coverage[(subregion.region.start - self.region.start):(subregion.region.stop - self.region.start)])
         
         self.readFinished = True
 
+    def _checkSplit(self, position):
+        '''Reports the position reached to the splitter and, if a split of the chunk has been requested past that position, shortens the
+        chunk to end at the requested stop. Every read starting before the new stop is still to come or already parsed since reads arrive
+        sorted by start. Blocks of parsed reads reaching past the new stop are dropped when the depth profile is cut to the chunk. A request
+        for a stop the reader has already gone past is refused.
+        
+        :param position: reference_start of the read about to be parsed
+        :type position: int
+        
+        '''
+        requestedStop = self.splitter.check(position)
+        if (requestedStop <= 0) or (requestedStop >= self.region.stop):
+            return
+        if requestedStop <= position:
+            self.splitter.answer(-1)
+            return
+        
+        self.region = regionkit.Region(self.region.chrom, self.region.start, requestedStop, self.region.name, self.region.regionSet, self.region.index)
+        subregions = []
+        for subregion in self.subregions:
+            if subregion.region.start < requestedStop:
+                subregions.append(regionkit.Region(subregion.region.chrom, subregion.region.start, min(subregion.region.stop, requestedStop), subregion.region.name, subregion.region.regionSet, subregion.region.index))
+        self._setSubregions(subregions)
+        self.splitter.answer(requestedStop)
+    
+    def _setSubregions(self, subregions):
+        '''Creates the :class:`BamRegion` objects and the interval index for the subregions of the chunk.'''
+        self.subregions = [BamRegion(r, self.levels) for r in subregions]
+        self.subregionIndex = intervalkit.IntervalIndex(subregions)
+    
+    def _fetch(self, ):
+        '''Returns an iterator over the reads of the chunk, either every read in the chunk or only those overlapping the fetch intervals.'''
+        if not self.targetFetch:
+            return self.bamfh.fetch(reference=self.bamChrom, start=self.region.start, end=self.region.stop)
+        return self._fetchTargets()
+    
+    def _fetchTargets(self, ):
+        '''Yields the reads overlapping the fetch intervals of the chunk. A read spanning several intervals is returned by the fetch of each
+        of them, so it is only yielded by the first one: any read starting before the stop of the previous interval was already yielded there.'''
+        previousStop = None
+        for start, stop in self.fetchIntervals:
+            for bamRead in self.bamfh.fetch(reference=self.bamChrom, start=start, end=stop):
+                if (previousStop is None) or (bamRead.reference_start >= previousStop):
+                    yield bamRead
+            previousStop = stop
+    
+    def _reset(self, ):
+        '''Clears the read-derived state of the reader, identities are stored as arrays of C longs (64-bit on Linux) when hashing and lists of names otherwise.'''
+        if self.readIdentity == "hash":
+            self.readIds = array.array('l')
+        else:
+            self.readIds = []
+        self.readCount = 0
+        self.onTarget = {}
+        self.chunkCoverage = 0
+        self.depthHistogram = None
+        self.depthRuns = None
+        self.insertLengths = array.array('i')
+        self.uncountedMetrics = {"unmapped" : 0, "duplicate" : 0, "mapquality": 0}
+
     def report(self, ):
         '''Returns a tuple summarizing coverage statistics for the region of the bam file read by this reader in the following format:
         
             (:class:`Region` object for this chunk,
             int number of reads,
             dict of on target by region set,
-            :class:`CoverageLevel` report for this chunk,
-            dict of reads in first column,
-            dict of reads in last column,
+            (int total depth over the chunk, or over its subregions unless genome, :class:`Histogram` of the chunk depths if genome or None),
             dict of uncounted stats,
-            list of insert sizes,
-            [(:class:`Region` object for subregion1, :class:`BamRegion` report for subregion1),...])
+            :class:`Histogram` of insert sizes,
+            [(:class:`Region` object for subregion1, :class:`CoverageLevel` report for subregion1, depth histogram for subregion1),...],
+            (run ends, run depths) of the depth over the whole chunk if keepDepthRuns or None)
         
         '''
         
-        # First get the stats for the super region or chunk itself
-        chunkTotal = self.subregions[0].report()
-        
-        # Create sets for first and last column read names as well as dicts that we will eventually return
-        fSet = set(self.firstColumn)
-        lSet = set(self.lastColumn)
-        fDict = {key : [] for key in self.firstColumn}
-        lDict = {key : [] for key in self.lastColumn}
-        
-        # Then get the stats for all of the sub-regions
+        # Get the stats for all of the sub-regions
         subRegionStats = []
-        onTargetSets = {}
         onTarget = {}
-        if len(self.subregions) > 1:
-            for subregion in self.subregions[1:]:
-                subregionReport = subregion.report()
-                subregionInfo = subregionReport[0]                
-                subRegionStats.append((subregionReport[0], subregionReport[2]))
-                
-                # Do on target aggregation by regionSet
-                if subregionInfo.regionSet in onTargetSets:
-                    onTargetSets[subregionInfo.regionSet].update(subregionReport[1])
-                else:
-                    onTargetSets[subregionInfo.regionSet] = set(subregionReport[1])
+        for subregion in self.subregions:
+            subRegionStats.append(subregion.report())
         
         # Get on-target numbers per region set
-        for r,o in onTargetSets.items():
+        for r,o in self.onTarget.items():
             onTarget[r] = len(o)
-            
-            # Append region to first and last column reads
-            for n in fSet.intersection(o):
-                fDict[n].append(r)
-            for n in lSet.intersection(o):
-                lDict[n].append(r)
-            
+        
+        # Insert sizes are shipped as a histogram so the parent can merge chunks without keeping every value
+        insertSizes = histogramkit.Histogram()
+        insertSizes.addValues(self.insertLengths)
         
         # Make final report tuple
-        report = (chunkTotal[0], len(chunkTotal[1]), onTarget, chunkTotal[2], fDict, lDict, self.uncountedMetrics, self.insertLengths, subRegionStats)
+        report = (self.region, self.readCount, onTarget, (self.chunkCoverage, self.depthHistogram), self.uncountedMetrics, insertSizes, subRegionStats, self.depthRuns)
         return report
 
-    def __init__(self, bam, region, levels, qualityCutoff = 1, allowdups = False, genome = False):
+    def __init__(self, bam, region, levels, qualityCutoff = 1, allowdups = False, genome = False, readIdentity = "name", targetFetch = False, targetPadding = 0, splitter = None, keepDepthRuns = False):
         '''Returns a tuple summarizing coverage statistics for the region of the bam file read by this reader in the following format:
         
         (region object for this chunk,
         integer number of reads,
         dict of on target by region set,
-        coverage level report for this chunk,
-        dict of reads in first column,
-        dict of reads in last column,
+        (total depth, depth histogram) for this chunk,
         dict of uncounted stats,
-        list of insert sizes,
-        [(subregion region object1, subregion coverage report1),...])
+        histogram of insert sizes,
+        [(subregion region object1, subregion coverage report1, subregion depth histogram1),...],
+        run-length encoded depth over the chunk or None)
         
         :param bamInput: file path for bam file
         :type bamInput: str
@@ -320,6 +440,16 @@ class BamReader(object):
         :type dups: bool
         :param genome: Boolean indicating whether bam file should have genome-level coverage considered 
         :type genome: bool
+        :param readIdentity: How reads are identified for on-target counting, either "name" for read name strings or "hash" for 64-bit :func:`readHash` integers
+        :type readIdentity: str
+        :param targetFetch: Boolean indicating whether only the subregions of the chunk should be fetched rather than the whole chunk, not compatible with genome
+        :type targetFetch: bool
+        :param targetPadding: Number of bases added to each side of the subregions fetched when targetFetch is set
+        :type targetPadding: int
+        :param splitter: Object with a check(position) method returning a stop requested for the chunk (0 for none) and an answer(stop) method told the stop accepted, or -1 if refused
+        :type splitter: object
+        :param keepDepthRuns: Boolean indicating whether the depth of every base of the chunk should be reported as runs, for a depth store
+        :type keepDepthRuns: bool
         
         :rtype: dict
         
@@ -330,45 +460,32 @@ class BamReader(object):
         self.logger.setLevel(logging.INFO)
         self.readFinished = False
         self.region = region[0]
-        self.firstColumn = []
-        self.lastColumn = []
-        self.insertLengths = []
+        self.precedingStops = region[2]
         self.qualityCutoff = qualityCutoff
         self.allowdups = allowdups
         self.genome = genome
+        self.readIdentity = readIdentity
+        self.targetFetch = targetFetch
+        self.splitter = splitter
+        self.keepDepthRuns = keepDepthRuns
+        self.levels = levels
         self.logger.debug(self.genome)
-        self.uncountedMetrics = {"unmapped" : 0, "duplicate" : 0, "mapquality": 0}
+        if self.targetFetch and self.genome:
+            raise Exception("Target fetching can not be used to calculate genome coverage.")
+        self._reset()
         
-        # Get reads from the current chunk
-        bamfh = pysam.AlignmentFile(bam, 'rb')
-        self.bamReads = bamfh.fetch(reference=self.region.chrom, start=self.region.start, end=self.region.stop)
+        # Get reads from the current chunk, or from its padded and merged subregions only
+        self.bamChrom = self.region.chrom
+        self.bamfh = pysam.AlignmentFile(bam, 'rb')
+        self.fetchIntervals = intervalkit.IntervalIndex(region[1]).padded(targetPadding, self.region.start, self.region.stop)
+        self.bamReads = self._fetch()
         
         # Make sure the pileup uses the right chromosome nomenclature, and then strip out that stupid "chr" if it's in there
         if self.region.chrom.startswith("chr"):
             self.region.chrom = self.region.chrom[3:]
         
-        self.subregions = []
-        self.subregionStarts = {}
-        self.subregionStops = {}
-        
-        self.regionCaller = regioncaller.RegionCaller()
-
-        # Create subregions: subregion[0] is actually the super region or chunk being interrogated by this BamReader object
-        self.subregions.append(BamRegion(self.region, levels))
-        #self.regionCaller[-1] = self._smartAdderGen(self.subregions[-1].add, self.regionCaller, -1, self.region.stop)
-        #self.regionCaller["_self"] = self.subregions[-1].add
-        
-        for i,r in enumerate(region[1]):
-            self.subregions.append(BamRegion(r, levels))
-            if r.start in self.subregionStarts:
-                self.subregionStarts[r.start].append(i)
-            else:
-                self.subregionStarts[r.start] = [i]
-            
-            if r.stop in self.subregionStops:
-                self.subregionStops[r.stop].append(i)
-            else:
-                self.subregionStops[r.stop] = [i]
+        # Create subregions
+        self._setSubregions(region[1])
                 
 class BamReaderAggregate(object):
     
@@ -378,47 +495,44 @@ class BamReaderAggregate(object):
         resultsRegion = results[0]
         resultsReads = results[1]
         resultsOnTarget = results[2]
-        resultsCoverageLevels = results[3]
-        resultsFirstColumn = results[4]
-        resultsLastColumn = results[5]
-        resultsUncountedStats = results[6]
-        resultsInsertSizes = results[7]
+        resultsCoverage = results[3]
+        resultsUncountedStats = results[4]
+        resultsInsertSizes = results[5]
         
         # Update uncounted stats
         self.uncounted["unmapped"] += resultsUncountedStats["unmapped"]
         self.uncounted["duplicate"] += resultsUncountedStats["duplicate"]
         self.uncounted["mapquality"] += resultsUncountedStats["mapquality"]
         
-        # Update insert size stats, I stop counting after 10000000
-        if len(self.insertSize) < 10000000:
-            self.insertSize.extend(resultsInsertSizes)
-        
-        # We have to account for overlap of reads before adjusting total counts
-        readOverlap = set(self.lastChunkColumn).intersection(set(resultsFirstColumn))
-        if len(readOverlap) > 0:
-            resultsReads -= len(readOverlap)
-            for readId in readOverlap:
-                for regionName in resultsFirstColumn[readId]:
-                    # This takes care of situation where an overlapping read was counted as on-target for the same region set for both results
-                    if regionName in self.lastChunkColumn[readId]:
-                        resultsOnTarget[regionName] -= 1
-        self.lastChunkColumn = resultsLastColumn
-                        
-        # With overlapping reads figured out, increment our totals
+        # Update insert size stats, merging histograms keeps every pair at a cost proportional to the number of bins
+        self.insertSize.merge(resultsInsertSizes)
+        
+        # Each read is counted by exactly one chunk, so chunk totals can simply be summed in any order
         self.totalReads += resultsReads
         for descriptor in resultsOnTarget.keys():
             self.onTarget[descriptor] += resultsOnTarget[descriptor]
-        self.totalCoverage += resultsCoverageLevels[0]
+        self.totalCoverage += resultsCoverage[0]
         self.totalLength += resultsRegion.length
+        if resultsCoverage[1] is not None:
+            self.depthHistogram.merge(resultsCoverage[1])
+    
+    def addCounts(self, readCount, uncountedMetrics):
+        '''Adds read totals from :func:`countReads`, used when the bam readers only fetch target intervals and leave their own totals at zero.
+        
+        :param readCount: Number of reads counted
+        :type readCount: int
+        :param uncountedMetrics: Dict of uncounted stats
+        :type uncountedMetrics: dict
+        
+        '''
+        self.totalReads += readCount
+        for key,value in uncountedMetrics.items():
+            self.uncounted[key] += value
     
     def report(self, bamInput, genome = False):
         
         report = {}
         
-        # Insert size calculation:    
-        insertMean = sum(self.insertSize) / float(len(self.insertSize))
-        insertSD = math.sqrt(sum(map(lambda x:(x-insertMean)**2, self.insertSize))/(len(self.insertSize)-1))
-        
         allReads = self.totalReads
         
         for key,value in self.uncounted.items():
@@ -429,17 +543,21 @@ class BamReaderAggregate(object):
         report["allReads"] = allReads
         report["readsCounted"] = self.totalReads
         report["readsNotCounted"] = self.uncounted
-        report["insertMean"] = insertMean
-        report["insertSD"] = insertSD
+        report["insertMean"] = self.insertSize.mean()
+        report["insertSD"] = self.insertSize.sd()
+        report["insertMedian"] = self.insertSize.percentile(50)
+        report["insertPercentiles"] = {}
+        for percentile in [5, 25, 75, 95]:
+            report["insertPercentiles"][str(percentile)] = self.insertSize.percentile(percentile)
         report["onTarget"] = self.onTarget
         
         if genome:
-            report["genome"] = { "avgCoverage" : float(self.totalCoverage) / self.totalLength }
+            report["genome"] = genomeReport(self.totalCoverage, self.totalLength, self.depthHistogram, self.levels)
         
         return report
     
     
-    def __init__(self, regionSets):
+    def __init__(self, regionSets, levels = ()):
         self.onTarget = {}
         if len(regionSets) > 0:
             for descriptor in regionSets:
@@ -448,9 +566,12 @@ class BamReaderAggregate(object):
         self.totalReads = 0
         self.totalCoverage = 0
         self.totalLength = 0
-        self.lastChunkColumn = {}
         self.uncounted = {"unmapped" : 0, "duplicate": 0, "mapquality": 0}
-        self.insertSize = []          
+        self.insertSize = histogramkit.Histogram()
+        self.depthHistogram = histogramkit.Histogram()
+        self.levels = tuple(sorted(levels))
+        if (len(self.levels) == 0) or (self.levels[0] != 0):
+            self.levels = (0,) + self.levels
             
     
     
@@ -462,8 +583,18 @@ class ProcessingRegionGenerator(object):
         def getStart(region):
             return region.start
         
+        # For each chromosome the starts of its regions, the largest stop reached by the regions up to each one, and the same for each region set
+        self.regionIndex = {}
         for chrom in self.regionByChromosome:
             sortedRegions[chrom] = sorted(self.regionByChromosome[chrom], key = getStart)
+            reachedStops = []
+            setStops = dict((region.regionSet, []) for region in sortedRegions[chrom])
+            for region in sortedRegions[chrom]:
+                reachedStops.append(max(region.stop, reachedStops[-1]) if len(reachedStops) > 0 else region.stop)
+                for regionSet, stops in setStops.items():
+                    lastStop = stops[-1] if len(stops) > 0 else -1
+                    stops.append(max(region.stop, lastStop) if regionSet == region.regionSet else lastStop)
+            self.regionIndex[chrom] = ([region.start for region in sortedRegions[chrom]], reachedStops, setStops)
         
         self.regionByChromosome = sortedRegions
         self.sorted = True   
@@ -478,87 +609,225 @@ class ProcessingRegionGenerator(object):
         
         self.sorted = False
     
-    def returnProcessingRegion(self, ):
-        '''Returns a list of tuples in the form [(region, [subRegion1, subRegion2...]), ...] where region and SubregionX are coveragekit.utils.region.Region objects.
-        This groups regions specified by user into the processing chuncks definied by windowSize and genome size.
+    def _fixedWindows(self, chromLength, tileBytes = None, tileSize = None):
+        '''Returns (start, stop, cost) tuples cutting a chromosome into windowSize slices. The cost is the estimated bytes of the bam file in
+        the window when tile estimates are given, and its length otherwise.'''
+        starts = numpy.arange(0, chromLength, self.windowSize)
+        stops = numpy.minimum(starts + self.windowSize, chromLength)
+        if tileBytes is None:
+            costs = (stops - starts).astype(numpy.float64)
+        else:
+            # Bytes up to any position, assuming they are spread evenly within each tile
+            tileBoundaries = numpy.arange(len(tileBytes) + 1) * tileSize
+            cumulativeBytes = numpy.concatenate(([0.0], numpy.cumsum(tileBytes)))
+            costs = numpy.interp(stops, tileBoundaries, cumulativeBytes) - numpy.interp(starts, tileBoundaries, cumulativeBytes)
+        return list(zip(starts.tolist(), stops.tolist(), costs.tolist()))
+    
+    def _balancedWindows(self, tileBytes, tileSize, chromLength, jobBytes):
+        '''Returns (start, stop, cost) tuples cutting a chromosome into windows holding about jobBytes of the bam file each. Tiles are added to a
+        window until it would go over jobBytes or maxWindowSize, so empty stretches are merged into long windows, and a tile holding more
+        than jobBytes on its own is split into equal parts of at least minWindowSize.
         
-        :param header: pysam.AlignmentFile.header
-        :type header: dict
-        :param selectRegions: list of tuples returned by coveragekit.utils.bed.parseRegionBeds
-        :type selectRegions: list
-        :param windowSize: Size of bam chunk to be considered by a bam reader
-        :type windowSize: int
+        '''
+        windows = []
+        windowStart = 0
+        windowBytes = 0.0
+        for tile, curBytes in enumerate(tileBytes.tolist()):
+            tileStart = tile * tileSize
+            tileStop = min(tileStart + tileSize, chromLength)
+            
+            # Hot spot: close the current window and split the tile on its own
+            if curBytes > jobBytes:
+                if tileStart > windowStart:
+                    windows.append((windowStart, tileStart, windowBytes))
+                pieces = max(1, min(int(math.ceil(curBytes / jobBytes)), (tileStop - tileStart) // self.minWindowSize))
+                pieceSize = int(math.ceil((tileStop - tileStart) / float(pieces)))
+                for pieceStart in range(tileStart, tileStop, pieceSize):
+                    pieceStop = min(pieceStart + pieceSize, tileStop)
+                    windows.append((pieceStart, pieceStop, curBytes * (pieceStop - pieceStart) / float(tileStop - tileStart)))
+                windowStart = tileStop
+                windowBytes = 0.0
+                continue
+            
+            if ((windowBytes + curBytes > jobBytes) or (tileStop - windowStart > self.maxWindowSize)) and (tileStart > windowStart):
+                windows.append((windowStart, tileStart, windowBytes))
+                windowStart = tileStart
+                windowBytes = 0.0
+            windowBytes += curBytes
+        if windowStart < chromLength:
+            windows.append((windowStart, chromLength, windowBytes))
+        return windows
+    
+    def _plan(self, ):
+        '''Works out the processing windows of every chromosome once, as a list of (chromosome name, [(start, stop, cost), ...]) tuples.
         
-        :rtype: dict
+        The index is used to estimate the bytes of the bam file along each chromosome, and windows are cut to hold the same number of bytes
+        as an average windowSize slice. Chromosomes with no alignments and no input regions are skipped unless genome coverage is calculated.
+        When balancing is turned off chromosomes are cut into windowSize slices costed from the index, and without an index they are cut into
+        windowSize slices costed by their length.
+        
+        A plan shared by other bam files of the same reference takes their indexes into account too: a chromosome is only skipped if none of
+        the bam files has alignments on it, or never if one of them has no index, and the bytes of the indexes with the same tile size as the
+        index of the first bam are added up to balance the windows.
         
         '''
-        if not self.sorted:
-            self._sort()
+        if self.plan is not None:
+            return self.plan
         
-        regionCount = 0
-        processingRegions = []
-        for sq in self.header['SQ']:
-            chromLength = sq["LN"]
+        bamIndex = None
+        indexFile = bamindexkit.findIndex(self.bamFile)
+        if indexFile is None:
+            self.logger.warning("No BAI or CSI index found for {}, using fixed size windows with costs estimated from their length".format(self.bamFile))
+        else:
+            bamIndex = bamindexkit.BamIndex(indexFile)
+        
+        self.plan = []
+        if bamIndex is None:
+            for sq in self.header['SQ']:
+                self.plan.append((sq["SN"], self._fixedWindows(sq["LN"])))
+            return self.plan
+        
+        tileSize = bamIndex.tileSize()
+        tileBytes = [bamIndex.tileBytes(referenceId, sq["LN"]) for referenceId, sq in enumerate(self.header['SQ'])]
+        otherIndexes = []
+        for otherBamFile in self.otherBamFiles:
+            otherIndexFile = bamindexkit.findIndex(otherBamFile)
+            otherIndexes.append(bamindexkit.BamIndex(otherIndexFile) if otherIndexFile else None)
+            if (otherIndexes[-1] is not None) and (otherIndexes[-1].tileSize() == tileSize):
+                for referenceId, sq in enumerate(self.header['SQ']):
+                    tileBytes[referenceId] = tileBytes[referenceId] + otherIndexes[-1].tileBytes(referenceId, sq["LN"])
+        
+        def hasReads(referenceId):
+            if bamIndex.hasReads(referenceId):
+                return True
+            for otherIndex in otherIndexes:
+                if (otherIndex is None) or otherIndex.hasReads(referenceId):
+                    return True
+            return False
+        
+        totalBytes = sum(t.sum() for t in tileBytes)
+        totalLength = sum(sq["LN"] for sq in self.header['SQ'])
+        jobBytes = totalBytes * self.windowSize / float(totalLength) if totalLength > 0 else 0.0
+        for referenceId, sq in enumerate(self.header['SQ']):
             chromName = sq["SN"]
-            
-            # The following deals with the stupid "chr" problem
-            if chromName.startswith("chr"):
-                editChromName = chromName[3:]
-            else:
-                editChromName = chromName
-            
-            chromStart = 0
-            lastStop = 0
-            if editChromName in self.regionByChromosome.keys():
-                selectList = self.regionByChromosome[editChromName]
+            editChromName = chromName[3:] if chromName.startswith("chr") else chromName
+            if (self.balance) and (not self.genome) and (not hasReads(referenceId)) and (editChromName not in self.regionByChromosome):
+                continue
+            if (self.balance) and (jobBytes > 0):
+                self.plan.append((chromName, self._balancedWindows(tileBytes[referenceId], tileSize, sq["LN"], jobBytes)))
             else:
-                selectList = []
+                self.plan.append((chromName, self._fixedWindows(sq["LN"], tileBytes[referenceId], tileSize)))
+        return self.plan
     
-            while lastStop < chromLength:
-                subSelectRegions = []
-                chromStart = lastStop
-                lastStop += self.windowSize
-                if lastStop > chromLength:
-                    lastStop = chromLength
-    
-                curProcessingRegion = regionkit.Region(chromName, chromStart, lastStop, regionCount, "_processing", regionCount)
-                regionCount += 1
-                
-                # Generate subregions by selections input by user
-                selectCount = 0
-                if (len(selectList) > 0) and (selectList[0].start < lastStop):
-                    while (selectCount < len(selectList)):
-                        if selectList[selectCount].stop < chromStart:
-                            selectList.pop(selectCount)
-                            continue
-                        elif selectList[selectCount].start > lastStop:
-                            break
-                        elif selectList[selectCount].stop <= lastStop:
-                            curSelect = selectList.pop(selectCount)
-                        elif selectList[selectCount].stop > lastStop:
-                            curSelect = selectList[selectCount]
-                            selectCount += 1
-    
-                        if curSelect.start < chromStart:
-                            selectStart = chromStart
-                        else:
-                            selectStart = curSelect.start
+    def numProcessingRegions(self, ):
+        '''Returns the number of processing regions :meth:`returnProcessingRegion` will yield, without generating them.
+        
+        :rtype: int
+        
+        '''
+        return sum(len(windows) for chromName, windows in self._plan())
     
-                        if curSelect.stop > lastStop:
-                            selectStop = lastStop
-                        else:
-                            selectStop = curSelect.stop
+    def processingRegions(self, ):
+        '''Returns the processing regions :meth:`returnProcessingRegion` will yield, without their subregions, so the whole plan can be looked
+        at while the jobs themselves are generated one at a time.
+        
+        :returns: List of (region, cost) tuples in genome order, region being the coveragekit.utils.region.Region of the processing region
+        :rtype: list
+        '''
+        regions = []
+        for chromName, windows in self._plan():
+            for chromStart, lastStop, cost in windows:
+                regions.append((regionkit.Region(chromName, chromStart, lastStop, len(regions), "_processing", len(regions)), cost))
+        return regions
     
-                        subSelectRegions.append(regionkit.Region(editChromName, selectStart, selectStop, curSelect.name, curSelect.regionSet, curSelect.index))
+    def processingRegionJob(self, region, cost):
+        '''Returns the job of one processing region from :meth:`processingRegions`, found with a bisect over the regions of its chromosome so
+        that jobs can be made in any order, one at a time.
+        
+        :param region: Processing region
+        :type region: coveragekit.utils.region.Region
+        :param cost: Estimated amount of work for the processing region
+        :type cost: float
+        
+        :returns: (region, [subRegion1, subRegion2...], precedingStops, cost), as yielded by :meth:`returnProcessingRegion`
+        :rtype: tuple
+        '''
+        if not self.sorted:
+            self._sort()
+        
+        # The following deals with the stupid "chr" problem
+        if region.chrom.startswith("chr"):
+            editChromName = region.chrom[3:]
+        else:
+            editChromName = region.chrom
+        if editChromName not in self.regionByChromosome:
+            return (region, [], {}, cost)
+        selectList = self.regionByChromosome[editChromName]
+        starts, reachedStops, setStops = self.regionIndex[editChromName]
+        
+        # Regions starting at or before the stop of the processing region that reach past its start, those starting before the first region
+        # whose stop, or that of a region before it, passes the start of the processing region can be skipped
+        first = bisect.bisect_right(reachedStops, region.start)
+        last = bisect.bisect_right(starts, region.stop)
+        selected = [curSelect for curSelect in selectList[first:last] if curSelect.stop > region.start]
+        
+        # Regions starting right at the stop only get a subregion when a region starts within the processing region
+        if (len(selected) == 0) or (selected[0].start >= region.stop):
+            selected = []
+        subSelectRegions = [regionkit.Region(editChromName, max(curSelect.start, region.start), min(curSelect.stop, region.stop), curSelect.name, curSelect.regionSet, curSelect.index) for curSelect in selected]
+        
+        # How far each region set reaches from the regions starting before this processing region
+        preceding = bisect.bisect_left(starts, region.start)
+        precedingStops = {}
+        if preceding > 0:
+            for regionSet, stops in setStops.items():
+                if stops[preceding - 1] >= 0:
+                    precedingStops[regionSet] = stops[preceding - 1]
+        return (region, subSelectRegions, precedingStops, cost)
     
-                yield (curProcessingRegion, subSelectRegions)
+    def returnProcessingRegion(self, ):
+        '''Returns a list of tuples in the form [(region, [subRegion1, subRegion2...], precedingStops, cost), ...] where region and SubregionX are coveragekit.utils.region.Region objects.
+        This groups regions specified by user into the processing chuncks definied by :meth:`_plan`. precedingStops is a dict of
+        region set : largest stop of the region set's regions starting before the processing region, which lets a :class:`BamReader` tell
+        whether a read overlapped the region set before its chunk. cost is the estimated amount of work for the processing region, used to
+        schedule the largest ones first.
+        
+        :rtype: generator
+        
+        '''
+        for region, cost in self.processingRegions():
+            yield self.processingRegionJob(region, cost)
     
-    def __init__(self, bamFile, windowSize):
+    def __init__(self, bamFile, windowSize, balance = True, genome = False, otherBamFiles = ()):
+        '''Initializer for ProcessingRegionGenerator class.
+        
+        :param bamFile: file path for bam file
+        :type bamFile: str
+        :param windowSize: Size of bam chunk to be considered by a bam reader, or the average size when windows are balanced
+        :type windowSize: int
+        :param balance: Boolean indicating whether windows should be balanced by the bytes of the bam file they hold according to its index
+        :type balance: bool
+        :param genome: Boolean indicating whether bam file should have genome-level coverage considered, in which case no chromosome is skipped
+        :type genome: bool
+        :param otherBamFiles: file paths for other bam files of the same reference that will be read with the same processing regions
+        :type otherBamFiles: list
+        
+        '''
+        self.logger = logging.getLogger("processing region generator")
+        self.logger.setLevel(logging.INFO)
         bam = pysam.AlignmentFile(bamFile, 'rb')
         self.header = bam.header
         bam.close()
+        self.bamFile = bamFile
         self.regionByChromosome = {}
         self.windowSize = windowSize
+        self.minWindowSize = min(1000, windowSize)
+        self.maxWindowSize = windowSize * 10
+        self.balance = balance
+        self.genome = genome
+        self.otherBamFiles = tuple(otherBamFiles)
+        self.plan = None
         self.sorted = False
+        self.regionIndex = {}
         self.regionCount = 0
     
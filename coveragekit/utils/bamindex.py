@@ -0,0 +1,139 @@
+import os, struct, gzip, io
+import numpy
+
+from coveragekit.version import __version__
+
+def _position(virtualOffset):
+    '''Converts a BGZF virtual offset into an approximate position in the compressed file. The offset within the uncompressed block is scaled
+    down by 4, about the usual BGZF compression ratio, so that reads sharing a single compressed block still get a non-zero size.'''
+    return (virtualOffset >> 16) + ((virtualOffset & 0xffff) >> 2)
+
+def findIndex(bamFile):
+    '''Returns the path of the BAI or CSI index of a bam file, or None if neither exists.
+
+    :param bamFile: file path for bam file
+    :type bamFile: str
+
+    :rtype: str
+
+    '''
+    candidates = [bamFile + ".bai", bamFile + ".csi"]
+    if bamFile.endswith(".bam"):
+        candidates.insert(1, bamFile[:-4] + ".bai")
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+class BamIndex(object):
+    '''Class that reads a BAI or CSI index and estimates how many bytes of the bam file fall in each tile of each reference, where a tile is
+    the smallest bin of the index (16kb for BAI). The compressed size of every chunk of a bin is spread evenly over the tiles the bin spans,
+    which works the same way for both formats since BAI is a CSI index with a fixed min_shift of 14 and depth of 5.
+
+    '''
+
+    def _parse(self, data):
+        magic = data[:4]
+        if magic == "BAI\1":
+            self.minShift = 14
+            self.depth = 5
+            offset = 4
+            hasLoffset = False
+        elif magic == "CSI\1":
+            self.minShift, self.depth, auxLength = struct.unpack_from("<iii", data, 4)
+            offset = 16 + auxLength
+            hasLoffset = True
+        else:
+            raise Exception("{} is not a BAI or CSI index.".format(self.indexFile))
+
+        # The pseudo-bin holding mapped / unmapped counts sits just past the last real bin
+        pseudoBin = (((1 << ((self.depth + 1) * 3)) - 1) // 7) + 1
+
+        numReferences = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        for i in range(numReferences):
+            bins = []
+            numBins = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            for j in range(numBins):
+                binNumber = struct.unpack_from("<I", data, offset)[0]
+                offset += 12 if hasLoffset else 4
+                numChunks = struct.unpack_from("<i", data, offset)[0]
+                offset += 4
+                chunks = numpy.frombuffer(data, dtype="<u8", count=numChunks * 2, offset=offset)
+                offset += numChunks * 16
+                if binNumber != pseudoBin:
+                    # A chunk ending early in a block of reads that compress well can come out negative, it then counts as empty
+                    size = sum(max(_position(int(end)) - _position(int(beg)), 0) for beg,end in zip(chunks[0::2], chunks[1::2]))
+                    bins.append((binNumber, size))
+            if not hasLoffset:
+                # BAI linear index, not used for the estimate
+                numIntervals = struct.unpack_from("<i", data, offset)[0]
+                offset += 4 + numIntervals * 8
+            self.referenceBins.append(bins)
+
+    def tileSize(self, ):
+        '''Returns the length in bp of a tile.
+
+        :rtype: int
+        '''
+        return 1 << self.minShift
+
+    def tileBytes(self, referenceId, length):
+        '''Returns the estimated number of bytes of the bam file in each tile of a reference.
+
+        :param referenceId: Position of the reference in the bam header
+        :type referenceId: int
+        :param length: Length of the reference in bp
+        :type length: int
+
+        :returns: Array with one estimate per tile, the last tile may be partial
+        :rtype: numpy.ndarray
+
+        '''
+        numTiles = ((length - 1) >> self.minShift) + 1 if length > 0 else 0
+        tiles = numpy.zeros(numTiles, dtype=numpy.float64)
+        if referenceId >= len(self.referenceBins):
+            return tiles
+
+        for binNumber, size in self.referenceBins[referenceId]:
+            # Find the level of the bin, level l holds 8**l bins starting at bin (8**l - 1) / 7
+            level = 0
+            while (level < self.depth) and (binNumber >= ((1 << ((level + 1) * 3)) - 1) // 7):
+                level += 1
+            span = 1 << (3 * (self.depth - level))
+            firstTile = (binNumber - (((1 << (level * 3)) - 1) // 7)) * span
+            lastTile = min(firstTile + span, numTiles)
+            if firstTile < lastTile:
+                tiles[firstTile:lastTile] += size / float(lastTile - firstTile)
+            elif numTiles > 0:
+                tiles[-1] += size
+        return tiles
+
+    def hasReads(self, referenceId):
+        '''Returns True if the index lists any alignments for a reference.
+
+        :param referenceId: Position of the reference in the bam header
+        :type referenceId: int
+
+        :rtype: bool
+        '''
+        return (referenceId < len(self.referenceBins)) and (len(self.referenceBins[referenceId]) > 0)
+
+    def __init__(self, indexFile):
+        '''Initializer for BamIndex class.
+
+        :param indexFile: file path for a BAI or CSI index
+        :type indexFile: str
+
+        '''
+        self.indexFile = indexFile
+        self.referenceBins = []
+
+        with open(indexFile, "rb") as indexFH:
+            data = indexFH.read()
+
+        # CSI indexes are bgzipped, BAI indexes are not
+        if data[:2] == "\x1f\x8b":
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        self._parse(data)
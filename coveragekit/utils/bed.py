@@ -1,5 +1,6 @@
 from coveragekit.version import __version__
 from coveragekit.utils.region import Region
+from coveragekit.utils.intervals import stitch
 
 def bedToRegions(descriptor, bedFile):
     with open(bedFile) as regionFile:
@@ -20,19 +21,4 @@ def bedToRegions(descriptor, bedFile):
             yield newRegion
 
 def stitchRegions(unstitched):
-    unstitched.sort(key=lambda x: int(x[0]))
-    stitched = []
-    if len(unstitched) > 0:
-        lastInterval = unstitched.pop(0)
-        lastStart = lastInterval[0]
-        lastStop = lastInterval[1]
-            
-        for i in unstitched:
-            if i[0] == lastStop:
-                lastStop = i[1]
-            else:
-                stitched.append([lastStart, lastStop])
-                lastStart = i[0]
-                lastStop = i[1]
-        stitched.append([lastStart, lastStop])
-    return stitched
\ No newline at end of file
+    return stitch(unstitched)
\ No newline at end of file
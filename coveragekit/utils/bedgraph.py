@@ -0,0 +1,122 @@
+import os
+import numpy
+import pysam
+
+from coveragekit.version import __version__
+
+class BedGraphWriter(object):
+    '''Class that streams the depth runs of bam chunks to a bgzip compressed bedGraph and indexes it with tabix. Chunks arrive in any
+    order: the next chunk in the processing regions is written as soon as it arrives, and any other chunk is spooled to a temporary file
+    until every chunk before it has been written, so memory does not grow with the chunks waiting on a large one. Runs of equal value are
+    joined across chunk boundaries and bases at 0 are left out, as in a "bedtools genomecov -bg" bedGraph.
+
+    '''
+
+    def _quantize(self, ends, depths):
+        # Each depth becomes the largest level at or below it, runs of the same level are then joined
+        values = self.levels[numpy.searchsorted(self.levels, depths, side="right") - 1]
+        if len(values) == 0:
+            return ends, values
+        keep = numpy.flatnonzero(numpy.diff(values))
+        keep = numpy.concatenate((keep, [len(values) - 1]))
+        return ends[keep], values[keep]
+
+    def _flush(self, ):
+        # The last interval is held back in case the next chunk starts with the same value
+        if self.last is not None:
+            self.bgzf.write("{}\t{}\t{}\t{}\n".format(*self.last))
+            self.last = None
+
+    def _write(self, chrom, start, ends, values):
+        ends = ends.astype(numpy.int64)
+        starts = numpy.concatenate(([start], ends[:-1]))
+        if (self.last is not None) and ((self.last[0] != chrom) or (self.last[2] != start)):
+            self._flush()
+        lines = []
+        for runStart, runEnd, value in zip(starts.tolist(), ends.tolist(), values.tolist()):
+            if self.last is not None:
+                if value == self.last[3]:
+                    self.last[2] = runEnd
+                    continue
+                lines.append("{}\t{}\t{}\t{}\n".format(*self.last))
+                self.last = None
+            if value != 0:
+                self.last = [chrom, runStart, runEnd, value]
+        self.bgzf.write("".join(lines))
+
+    def _next(self, ):
+        '''Returns the key of the chunk to write next, None once every processing region is written.'''
+        if self.position >= len(self.jobs):
+            return None
+        return (self.jobs[self.position][0], self.cursor)
+
+    def _writeChunk(self, stop, ends, depths):
+        chrom = self.jobs[self.position][1]
+        if self.levels is not None:
+            ends, depths = self._quantize(ends, depths)
+        self._write(chrom, self.cursor, ends, depths)
+        self.cursor = stop
+        if self.cursor >= self.jobs[self.position][3]:
+            self.position += 1
+            if self.position < len(self.jobs):
+                self.cursor = self.jobs[self.position][2]
+
+    def _unspool(self, key):
+        stop, offset, numRuns = self.pending.pop(key)
+        self.spool.seek(offset)
+        ends = numpy.frombuffer(self.spool.read(4 * numRuns), dtype="<u4")
+        depths = numpy.frombuffer(self.spool.read(4 * numRuns), dtype="<u4")
+        return stop, ends, depths
+
+    def add(self, region, runs):
+        '''Adds the runs of one chunk, writing it and any spooled chunks it was holding up if it is the next one in genome order.
+
+        :param region: :class:`Region` read by the chunk
+        :type region: Region
+        :param runs: (run ends, run depths) from :func:`coveragekit.utils.depthstore.runLengths`
+        :type runs: tuple
+
+        '''
+        ends, depths = runs
+        if (region.index, region.start) != self._next():
+            self.spool.seek(0, os.SEEK_END)
+            self.pending[(region.index, region.start)] = (region.stop, self.spool.tell(), len(ends))
+            self.spool.write(numpy.asarray(ends, dtype="<u4").tostring())
+            self.spool.write(numpy.asarray(depths, dtype="<u4").tostring())
+            return
+        self._writeChunk(region.stop, ends, depths)
+        while self._next() in self.pending:
+            self._writeChunk(*self._unspool(self._next()))
+
+    def close(self, ):
+        '''Writes the last interval, closes the bedGraph and builds its tabix index.'''
+        if (self.position < len(self.jobs)) or (len(self.pending) > 0):
+            raise Exception("The bedGraph {} is missing the depth of processing region {}.".format(self.bedGraphFile, self.jobs[min(self.position, len(self.jobs) - 1)][0]))
+        self._flush()
+        self.bgzf.close()
+        self.spool.close()
+        os.remove(self.bedGraphFile + ".spool")
+        pysam.tabix_index(self.bedGraphFile, preset = "bed", force = True)
+
+    def __init__(self, bedGraphFile, jobs, levels = None):
+        '''Initializer for BedGraphWriter class.
+
+        :param bedGraphFile: file path for the bedGraph, ending with ".gz", the index is written next to it with ".tbi" appended
+        :type bedGraphFile: str
+        :param jobs: List of tuples starting with a processing region, such as the (region, cost) tuples from :meth:`ProcessingRegionGenerator.processingRegions`, before any is split or checkpointed
+        :type jobs: list
+        :param levels: Coverage levels the depths are quantized to, each base getting the largest level at or below its depth, exact depths if None
+        :type levels: list
+
+        '''
+        self.bedGraphFile = bedGraphFile
+        self.jobs = sorted((job[0].index, job[0].chrom, job[0].start, job[0].stop) for job in jobs)
+        self.levels = None
+        if levels is not None:
+            self.levels = numpy.array(sorted(set((0,) + tuple(levels))), dtype=numpy.int64)
+        self.position = 0
+        self.cursor = self.jobs[0][2] if len(self.jobs) > 0 else 0
+        self.pending = {}
+        self.last = None
+        self.bgzf = pysam.BGZFile(bedGraphFile, "wb")
+        self.spool = open(bedGraphFile + ".spool", "w+b")
@@ -0,0 +1,192 @@
+import sqlite3, os, datetime, logging, itertools
+import numpy
+
+import coveragekit.utils.db as covdb
+
+from coveragekit.version import __version__
+
+class CohortDB(object):
+    '''Class that stores the per-gene coverage of many samples in one SQLite file. Samples are grouped in blocks of blockSize samples in the
+    order they were added, and every gene has one row per metric (average coverage and the percent at or above each cohort level) and
+    block holding a float32 array with one value per sample of the block, NaN where the sample has no such gene. A cohort query reads the
+    blocks of each gene together instead of opening every sample database, and appending samples only writes the last block, which is
+    full and never written again once it holds blockSize samples.
+
+    '''
+
+    def _create(self, cohortFile, levels, blockSize):
+        self.conn = sqlite3.connect(cohortFile)
+        self.c = self.conn.cursor()
+        self.levels = tuple(sorted(levels))
+        self.blockSize = blockSize
+
+        self.c.execute("CREATE TABLE samples(sampleIndex integer PRIMARY KEY, name text UNIQUE, dbSource text, coverageSource text, regionSource text, dateAdded text)")
+        self.c.execute("CREATE TABLE genes(id text PRIMARY KEY, chrom text, start integer, stop integer, length integer)")
+        self.c.execute("CREATE TABLE genevalues(metric text, id text, block integer, vals blob, PRIMARY KEY (metric, id, block))")
+
+        self.c.execute("CREATE TABLE metadata(levels text, blockSize integer)")
+        self.c.execute("INSERT INTO metadata VALUES (?,?)", (",".join(str(x) for x in self.levels), self.blockSize))
+
+        self.c.execute("CREATE TABLE coveragekit(version text, dateCreated text)")
+        self.c.execute("INSERT INTO coveragekit VALUES (?,?)",(__version__, datetime.datetime.now().isoformat()))
+        self.conn.commit()
+
+    def _load(self, cohortFile):
+        self.conn = sqlite3.connect(cohortFile)
+        self.c = self.conn.cursor()
+        try:
+            self.c.execute("SELECT levels, blockSize FROM metadata LIMIT 1")
+        except sqlite3.OperationalError:
+            raise Exception("Cohort store {} was written by an earlier version of coveragekit, rebuild it from the sample databases.".format(cohortFile))
+        levels, self.blockSize = self.c.fetchone()
+        self.levels = tuple([int(x) for x in levels.split(",")])
+
+    def metrics(self, ):
+        '''Returns the names of the metrics stored for every gene.
+
+        :rtype: list
+        '''
+        return ["coverage"] + ["percent{}X".format(i) for i in self.levels]
+
+    def numSamples(self, ):
+        '''Returns the number of samples in the cohort.
+
+        :rtype: int
+        '''
+        return self.c.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    def samples(self, ):
+        '''Returns the (name, dbSource, coverageSource) of every sample in the order of the value arrays.
+
+        :rtype: list
+        '''
+        return self.c.execute("SELECT name, dbSource, coverageSource FROM samples ORDER BY sampleIndex").fetchall()
+
+    def _readSample(self, dbFile):
+        '''Returns the (coverageSource, regionSource) of a sample database, its genes and their metric values, closing the database.'''
+        coverageDB = covdb.CoverageDB(dbFile)
+        missing = [i for i in self.levels if i not in coverageDB.levels]
+        if (len(missing) > 0) and (not coverageDB.hasHistograms):
+            coverageDB.close()
+            raise Exception("Coverage database {} has no level {} and no depth histograms to compute it from.".format(dbFile, ",".join(str(i) for i in missing)))
+        genes = {}
+        values = {}
+        for result in coverageDB.query():
+            genes[result[0]] = (result[1], result[2], result[3], result[5])
+            values[result[0]] = numpy.array([result[6]] + [coverageDB.percentAtLeast(result, i) for i in self.levels], dtype="<f4")
+        sources = (coverageDB.coveragesource, coverageDB.regionsource)
+        coverageDB.close()
+        return sources, genes, values
+
+    def append(self, databases):
+        '''Adds samples to the cohort from their coverage databases, opened one at a time. Only the blocks of the new samples are written, so
+        appending costs the same whatever the number of samples already in the cohort.
+
+        :param databases: List of (sample name, database file) tuples
+        :type databases: list
+
+        '''
+        existingNames = set(name for name, dbSource, coverageSource in self.samples())
+        names = [name for name, dbFile in databases]
+        duplicates = existingNames.intersection(names).union(set(name for name in names if names.count(name) > 1))
+        if len(duplicates) > 0:
+            raise Exception("Samples already in the cohort or given twice: {}".format(",".join(sorted(duplicates))))
+
+        firstIndex = self.numSamples()
+        newSamples = []
+        newGenes = {}
+        for name, dbFile in databases:
+            self.logger.info("Reading sample {} from {}".format(name, dbFile))
+            sources, genes, values = self._readSample(dbFile)
+            newSamples.append((name, dbFile, sources[0], sources[1], values))
+            newGenes.update(genes)
+
+        knownGenes = set(gene[0] for gene in self.c.execute("SELECT id FROM genes"))
+        self.c.executemany("INSERT INTO genes VALUES (?,?,?,?,?)", [(gene,) + newGenes[gene] for gene in sorted(newGenes) if gene not in knownGenes])
+
+        # Arrays of a block hold the values of its samples from the first one, a gene missing from the later samples of a block has a shorter
+        # array and a gene missing from every sample of a block has no row
+        lastIndex = firstIndex + len(newSamples)
+        for block in range(firstIndex // self.blockSize, (lastIndex - 1) // self.blockSize + 1 if len(newSamples) > 0 else 0):
+            blockStart = block * self.blockSize
+            blockSamples = newSamples[max(blockStart - firstIndex, 0):min(blockStart + self.blockSize, lastIndex) - firstIndex]
+            blockGenes = set()
+            for sample in blockSamples:
+                blockGenes.update(sample[4].keys())
+            for metricIndex, metric in enumerate(self.metrics()):
+                stored = {}
+                if blockStart < firstIndex:
+                    stored = dict(self.c.execute("SELECT id, vals FROM genevalues WHERE metric = ? AND block = ?", (metric, block)).fetchall())
+                rows = []
+                for gene in sorted(blockGenes):
+                    vals = numpy.frombuffer(stored[gene], dtype="<f4") if gene in stored else numpy.zeros(0, dtype="<f4")
+                    padding = numpy.full(max(firstIndex - blockStart, 0) - len(vals), numpy.nan, dtype="<f4")
+                    added = numpy.array([sample[4][gene][metricIndex] if gene in sample[4] else numpy.nan for sample in blockSamples], dtype="<f4")
+                    rows.append((metric, gene, block, buffer(numpy.concatenate((vals, padding, added)).astype("<f4").tostring())))
+                self.c.executemany("INSERT OR REPLACE INTO genevalues VALUES (?,?,?,?)", rows)
+
+        now = datetime.datetime.now().isoformat()
+        self.c.executemany("INSERT INTO samples VALUES (?,?,?,?,?,?)", [(firstIndex + i, sample[0], sample[1], sample[2], sample[3], now) for i, sample in enumerate(newSamples)])
+        self.conn.commit()
+
+    def query(self, level, percent, minFailFraction = None):
+        '''Yields the distribution over the samples of the percent at or above a level for every gene, sorted by id, in one pass over the
+        (metric, id) primary key. A sample fails a gene if less than percent of the gene is covered at level or above.
+
+        :param level: Coverage level, one of the cohort levels
+        :type level: int
+        :param percent: Minimum percent at or above level for a sample to pass
+        :type percent: float
+        :param minFailFraction: Only genes failing in more than this fraction of the samples that have them are returned, all if None
+        :type minFailFraction: float
+
+        :returns: Dicts of id, position, numSamples, min, median, mean, numFailing and failFraction
+        :rtype: generator
+        '''
+        if level not in self.levels:
+            raise Exception("Cohort only has the following levels available: {}".format(self.levels))
+        results = self.conn.execute("SELECT genes.id, genes.chrom, genes.start, genes.stop, genevalues.vals FROM genevalues JOIN genes ON genes.id = genevalues.id WHERE genevalues.metric = ? ORDER BY genevalues.id, genevalues.block", ("percent{}X".format(level),))
+        for gene, geneRows in itertools.groupby(results, key = lambda row: row[0]):
+            geneRows = list(geneRows)
+            chrom, start, stop = geneRows[0][1:4]
+            vals = numpy.concatenate([numpy.frombuffer(row[4], dtype="<f4") for row in geneRows])
+            vals = vals[~numpy.isnan(vals)]
+            if len(vals) == 0:
+                continue
+            # Values are float32, so compare against the float32 cutoff for a sample exactly at the cutoff to pass
+            numFailing = int((vals < numpy.float32(percent / 100.0)).sum())
+            failFraction = numFailing / float(len(vals))
+            if (minFailFraction is not None) and (failFraction <= minFailFraction):
+                continue
+            yield {"id" : gene,
+                   "position" : "{}:{}-{}".format(chrom, start, stop),
+                   "numSamples" : len(vals),
+                   "min" : float(vals.min()),
+                   "median" : float(numpy.median(vals)),
+                   "mean" : float(vals.mean(dtype=numpy.float64)),
+                   "numFailing" : numFailing,
+                   "failFraction" : failFraction}
+
+    def __init__(self, cohortFile, levels = None, blockSize = 256):
+        '''Initializer for CohortDB class.
+
+        :param cohortFile: file path for the cohort store
+        :type cohortFile: str
+        :param levels: Coverage levels stored for every sample, needed when the cohort store does not exist yet
+        :type levels: list
+        :param blockSize: Number of samples in a block of a new cohort store
+        :type blockSize: int
+
+        '''
+        self.cohortFile = cohortFile
+        if os.path.isfile(cohortFile):
+            self._load(cohortFile)
+        elif levels:
+            self._create(cohortFile, levels, blockSize)
+        else:
+            raise Exception("Cannot create cohort store without levels specified.")
+        self.logger = logging.getLogger("coveragekit utils.cohort.CohortDB")
+        self.logger.setLevel(logging.INFO)
+
+    def __del__(self, ):
+        self.conn.close()
@@ -1,28 +1,147 @@
 
-import sqlite3, os, json, logging, datetime
+import sqlite3, os, logging, datetime, urllib
+import numpy
+from multiprocessing import Process
+import coveragekit.utils.histogram as histogramkit
+import coveragekit.utils.encoding as encodingkit
+import coveragekit.utils.intervals as intervalkit
 
 from coveragekit.version import __version__
 
+def _lengthClass(length):
+    # Interval lengths are grouped by powers of 4, so the intervals of a class differ at most 4 fold in length
+    return int(length).bit_length() // 2
+
+def _connectReadOnly(dbfile):
+    # A file: URI with mode=ro opens the database read-only, connection private temporary tables still work as they are in the temp
+    # schema. The sqlite3 module of Python 2 cannot ask for URI filenames, so they are only used if the SQLite library parses them by
+    # default, and other builds open the file read-write as before.
+    if "USE_URI" in [option[0] for option in sqlite3.connect(":memory:").execute("PRAGMA compile_options")]:
+        return sqlite3.connect("file:{}?mode=ro".format(urllib.quote(os.path.abspath(dbfile))))
+    return sqlite3.connect(dbfile)
+
+def startCoverageDBs(databases, regionSetAggregators, regions, coveragesource, mapq, dups, totalCoverage):
+    '''Builds coverage databases in forked processes, one each so they are built at the same time from the region sets already in memory, and
+    returns the (database file, process) pairs to pass to :func:`joinCoverageDBs`.
+
+    :param databases: Dict of region descriptor:database file path
+    :type databases: dict
+    :param regionSetAggregators: Dict of region descriptor:region set
+    :type regionSetAggregators: dict
+    :param regions: Dict of region descriptor:region file path
+    :type regions: dict
+
+    :rtype: list
+    '''
+    databaseBuilders = []
+    for databaseKey,databaseFile in databases.items():
+        builder = Process(target = buildCoverageDB,
+                          args = (databaseFile, regionSetAggregators[databaseKey]),
+                          kwargs = {"regionsource" : regions[databaseKey],
+                                    "coveragesource" : coveragesource,
+                                    "mapq" : mapq,
+                                    "dups" : dups,
+                                    "totalCoverage" : totalCoverage})
+        builder.start()
+        databaseBuilders.append((databaseFile, builder))
+    return databaseBuilders
+
+def joinCoverageDBs(databaseBuilders, logger):
+    '''Waits for the processes from :func:`startCoverageDBs` and raises if any of them failed.'''
+    for databaseFile, builder in databaseBuilders:
+        builder.join()
+        if builder.exitcode != 0:
+            raise Exception("Building coverage database {} failed.".format(databaseFile))
+        logger.info("Built coverage database {}".format(databaseFile))
+
+def buildCoverageDB(dbfile, regionSet, regionsource, coveragesource, mapq = 1, dups = False, totalCoverage = 0, batchSize = 5000):
+    '''Builds a coverage database for a region set in one bulk load. The database is written to a temporary file next to dbfile with
+    journaling and syncing off, its indexes are created once every row is in, and it is then renamed over dbfile, so readers only ever see
+    either the previous database or the complete new one.
+    
+    :param dbfile: file path for the database
+    :type dbfile: str
+    :param regionSet: Region set to load
+    :type regionSet: :class:`RegionSet`
+    :param regionsource: file path of the bed file the region set was read from
+    :type regionsource: str
+    :param coveragesource: file path for the bam file
+    :type coveragesource: str
+    :param mapq: Minimum mapping quality used
+    :type mapq: int
+    :param dups: Boolean indicating whether duplicate reads were considered
+    :type dups: bool
+    :param totalCoverage: Total coverage of the bam file
+    :type totalCoverage: int
+    :param batchSize: Number of rows inserted by each executemany
+    :type batchSize: int
+    
+    '''
+    tmpFile = "{}.{}.tmp".format(dbfile, os.getpid())
+    if os.path.exists(tmpFile):
+        os.remove(tmpFile)
+    try:
+        coverageDB = CoverageDB(tmpFile, regionsource, coveragesource, regionSet.levels, mapq, dups, totalCoverage, bulk = True)
+        coverageDB.insertRegionSet(regionSet, batchSize)
+        coverageDB.finishBulkLoad()
+        coverageDB.conn.close()
+    except:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        raise
+    os.rename(tmpFile, dbfile)
+
 class CoverageDB(object):
     
-    def _create(self, dbfile, regionsource, coveragesource, levels, mapq, dup, totalCoverage):
+    def _create(self, dbfile, regionsource, coveragesource, levels, mapq, dup, totalCoverage, bulk = False):
         self.conn = sqlite3.connect(dbfile)
         self.regionsource = regionsource
         self.coveragesource = coveragesource
         self.levels = levels
         self.c = self.conn.cursor()
         
+        # A fresh file being bulk loaded has nothing to recover on failure, so skip the rollback journal and fsyncs until the load is done
+        self.bulk = bulk
+        if bulk:
+            self.c.execute("PRAGMA journal_mode = OFF")
+            self.c.execute("PRAGMA synchronous = OFF")
+            self.c.execute("PRAGMA cache_size = -65536")
+        
         # Create basic table for regions (genes)
-        self.c.execute("CREATE TABLE regions(id text, chrom text, start integer, stop integer, subregions text, length integer, coverage real, levels text)")
+        self.c.execute("CREATE TABLE regions(id text, chrom text, start integer, stop integer, subregions blob, length integer, coverage real, levels blob)")
         
         # Add additional database columns depending on the coverage levels assayed
         for i in self.levels:
             self.c.execute("ALTER TABLE regions ADD COLUMN 'percent{}X' real".format(i))
             #self.c.execute("ALTER TABLE regions ADD COLUMN 'level{}regions' text".format(i))
         
-        # Index on region (gene) id
-        self.c.execute("CREATE UNIQUE INDEX ididx ON regions(id)")
-        self.c.execute("CREATE INDEX coverageidx ON regions(coverage)")
+        # Depth histogram of the region, so that any level can be queried later
+        self.c.execute("ALTER TABLE regions ADD COLUMN histogram blob")
+        self.hasHistograms = True
+        
+        # Stitched intervals below and at or above each level, encoded like the levels column
+        self.c.execute("ALTER TABLE regions ADD COLUMN belowLevels blob")
+        self.c.execute("ALTER TABLE regions ADD COLUMN atOrAboveLevels blob")
+        self.hasThresholdIntervals = True
+        
+        # Depth histograms of the subregions, apart from that of the region so they are not read with it
+        self.c.execute("ALTER TABLE regions ADD COLUMN subregionHistograms blob")
+        self.hasSubregionHistograms = True
+        
+        # Subregions and coverage level intervals of every region, one row each so they can be looked up by position. Rows are grouped
+        # into length classes and maxLength is the length of the longest interval of each class, which bounds how far before a queried
+        # range an overlapping interval of that class can start, so a few long intervals do not widen the lookups of the short ones.
+        self.c.execute("CREATE TABLE subregionintervals(id text, chrom text, start integer, stop integer, coverage integer, lengthclass integer)")
+        self.c.execute("CREATE TABLE levelintervals(id text, chrom text, start integer, stop integer, level integer, lengthclass integer)")
+        self.c.execute("CREATE TABLE intervalspans(tablename text, lengthclass integer, maxLength integer)")
+        self.hasIntervalTables = True
+        self.hasLengthClasses = True
+        self.intervalSpans = {}
+        self.indexedLevels = set()
+        
+        # Indexes of a bulk load are built once all rows are in by finishBulkLoad
+        if not bulk:
+            self._createIndexes()
         
         # Create metadata table and put in the appropriate data
         self.c.execute("CREATE TABLE metadata(regionsource text, coveragesource text, levels text, mapqualityCutoff int, duplicatesAllowed int, totalCoverage int)")
@@ -35,8 +154,26 @@ class CoverageDB(object):
         
         self.conn.commit()
     
-    def _load(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
+    def _createIndexes(self, ):
+        # Index on region (gene) id
+        self.c.execute("CREATE UNIQUE INDEX ididx ON regions(id)")
+        self.c.execute("CREATE INDEX coverageidx ON regions(coverage)")
+        
+        # Indexes on the percent columns, except percent0X which is always 1
+        for i in self.levels:
+            if i != 0:
+                self.c.execute("CREATE INDEX percent{0}Xidx ON regions(percent{0}X)".format(i))
+        self.indexedLevels = set(i for i in self.levels if i != 0)
+        
+        # Positional indexes on the interval tables
+        self.c.execute("CREATE INDEX subregionposidx ON subregionintervals(chrom, lengthclass, start)")
+        self.c.execute("CREATE INDEX levelposidx ON levelintervals(chrom, lengthclass, start)")
+    
+    def _load(self, dbfile, readOnly = False):
+        if readOnly:
+            self.conn = _connectReadOnly(dbfile)
+        else:
+            self.conn = sqlite3.connect(dbfile)
         self.c = self.conn.cursor()
         self.c.execute("SELECT * FROM metadata LIMIT 1")
         metadata = self.c.fetchone()
@@ -44,68 +181,447 @@ class CoverageDB(object):
         self.coveragesource = metadata[1]
         self.levels = tuple([int(x) for x in metadata[2].split(",")])
         
+        # Databases built before depth histograms were stored only have the level columns
+        self.c.execute("PRAGMA table_info(regions)")
+        columns = [column[1] for column in self.c.fetchall()]
+        self.hasHistograms = "histogram" in columns
+        self.hasThresholdIntervals = "belowLevels" in columns
+        self.hasSubregionHistograms = "subregionHistograms" in columns
+        
+        # As have databases built before subregions and level intervals had tables of their own
+        self.c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        self.hasIntervalTables = "levelintervals" in [table[0] for table in self.c.fetchall()]
+        self.intervalSpans = {}
+        self.hasLengthClasses = False
+        if self.hasIntervalTables:
+            # Databases built before the interval tables had length classes have one maxLength per table
+            self.c.execute("PRAGMA table_info(intervalspans)")
+            self.hasLengthClasses = "lengthclass" in [column[1] for column in self.c.fetchall()]
+            if self.hasLengthClasses:
+                spans = self.c.execute("SELECT tablename, lengthclass, maxLength FROM intervalspans ORDER BY tablename, lengthclass").fetchall()
+            else:
+                spans = [(tableName, None, maxLength) for tableName, maxLength in self.c.execute("SELECT tablename, maxLength FROM intervalspans")]
+            for tableName, lengthClass, maxLength in spans:
+                if maxLength is not None:
+                    self.intervalSpans.setdefault(tableName, []).append((lengthClass, maxLength))
+        
+        # Only databases built by this version have indexes on the percent columns
+        self.c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexNames = set(index[0] for index in self.c.fetchall())
+        self.indexedLevels = set(i for i in self.levels if "percent{}Xidx".format(i) in indexNames)
+        self.bulk = False
+        
     def insert(self, region, levels):
         pass
     
-    def insertRegionSet(self, regionSet):
-        for setRecord in regionSet.retrieve():
-            columns = ",".join("?"*(8+(len(self.levels))))
-            self.c.execute("INSERT INTO regions VALUES ({})".format(columns),setRecord)
+    def insertRegionSet(self, regionSet, batchSize = 5000):
+        '''Inserts every region of a region set in a single transaction, batchSize rows per executemany.
+        
+        :param regionSet: Region set to insert
+        :type regionSet: :class:`RegionSet`
+        :param batchSize: Number of rows inserted by each executemany
+        :type batchSize: int
+        
+        '''
+        self._insertBatches("regions", regionSet.retrieve(), batchSize)
+        self._insertBatches("subregionintervals", (record + (_lengthClass(record[3] - record[2]),) for record in regionSet.retrieveSubregions()), batchSize)
+        self._insertBatches("levelintervals", (record + (_lengthClass(record[3] - record[2]),) for record in regionSet.retrieveLevelIntervals()), batchSize)
+        self.c.execute("DELETE FROM intervalspans")
+        self.intervalSpans = {}
+        for tableName in ("subregionintervals", "levelintervals"):
+            for lengthClass, maxLength in self.c.execute("SELECT lengthclass, MAX(stop - start) FROM {} GROUP BY lengthclass ORDER BY lengthclass".format(tableName)).fetchall():
+                self.c.execute("INSERT INTO intervalspans VALUES (?,?,?)", (tableName, lengthClass, maxLength))
+                self.intervalSpans.setdefault(tableName, []).append((lengthClass, maxLength))
         self.conn.commit()
+        
+        # Statistics for the query planner, a bulk load gathers them once its indexes exist
+        if not self.bulk:
+            self.c.execute("ANALYZE")
+            self.conn.commit()
     
-    def query(self, geneID = None, coverageLowCutoff = None, coverageHighCutoff = None, levelsLowCutoff = None, levelsHighCutoff = None):
+    def _insertBatches(self, tableName, records, batchSize):
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batchSize:
+                self.c.executemany("INSERT INTO {} VALUES ({})".format(tableName, ",".join("?"*len(batch[0]))), batch)
+                batch = []
+        if len(batch) > 0:
+            self.c.executemany("INSERT INTO {} VALUES ({})".format(tableName, ",".join("?"*len(batch[0]))), batch)
+    
+    def finishBulkLoad(self, ):
+        '''Creates the indexes of a bulk loaded database and puts journaling and syncing back to their defaults.'''
+        if not self.bulk:
+            return
+        self._createIndexes()
+        self.c.execute("ANALYZE")
+        self.conn.commit()
+        self.c.execute("PRAGMA journal_mode = DELETE")
+        self.c.execute("PRAGMA synchronous = FULL")
+        self.bulk = False
+    
+    def _overlapping(self, tableName, chrom, start, stop, extraQuery = "", extraParameters = ()):
+        if not self.hasIntervalTables:
+            raise Exception("Coverage database {} has no interval tables, it cannot be queried by position.".format(self.dbfile))
+        spans = self.intervalSpans.get(tableName)
+        if not spans:
+            return []
+        # Intervals are found through the (chrom, lengthclass, start) index, one range of it for each length class, an interval of a class
+        # overlapping [start, stop) starts at most the maxLength of the class before start. Ties are kept in the order the rows were inserted.
+        columns = "rowid, id, chrom, start, stop, {}".format("coverage" if tableName == "subregionintervals" else "level")
+        branches = []
+        parameters = []
+        for lengthClass, maxLength in spans:
+            if lengthClass is None:
+                branches.append("SELECT {} FROM {} WHERE chrom = ? AND start >= ? AND start < ? AND stop > ?{}".format(columns, tableName, extraQuery))
+                parameters.extend((chrom, start - maxLength, stop, start) + tuple(extraParameters))
+            else:
+                branches.append("SELECT {} FROM {} WHERE chrom = ? AND lengthclass = ? AND start >= ? AND start < ? AND stop > ?{}".format(columns, tableName, extraQuery))
+                parameters.extend((chrom, lengthClass, start - maxLength, stop, start) + tuple(extraParameters))
+        sqlQuery = "{} ORDER BY start, stop, rowid".format(" UNION ALL ".join(branches))
+        self.logger.debug(sqlQuery)
+        return [row[1:] for row in self.c.execute(sqlQuery, parameters)]
+    
+    def subregionsOverlapping(self, chrom, start, stop):
+        '''Returns the subregions of every region overlapping a range of a chromosome.
+        
+        :param chrom: Chromosome name
+        :type chrom: str
+        :param start: Start of the range
+        :type start: int
+        :param stop: Stop of the range
+        :type stop: int
+        
+        :returns: List of (id, chrom, start, stop, coverage) tuples sorted by start
+        :rtype: list
+        '''
+        return self._overlapping("subregionintervals", chrom, start, stop)
+    
+    def levelIntervalsOverlapping(self, chrom, start, stop, levels = None):
+        '''Returns the coverage level intervals of every region overlapping a range of a chromosome.
+        
+        :param chrom: Chromosome name
+        :type chrom: str
+        :param start: Start of the range
+        :type start: int
+        :param stop: Stop of the range
+        :type stop: int
+        :param levels: Coverage levels to return, all of them if None
+        :type levels: sequence
+        
+        :returns: List of (id, chrom, start, stop, level) tuples sorted by start
+        :rtype: list
+        '''
+        if levels is None:
+            return self._overlapping("levelintervals", chrom, start, stop)
+        levels = list(levels)
+        return self._overlapping("levelintervals", chrom, start, stop, " AND level IN ({})".format(",".join("?"*len(levels))), levels)
+    
+    def levelIntervals(self, result, levels = None):
+        '''Returns the intervals of a region at each coverage level from its row in the regions table, decoding only the levels asked for.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        :param levels: Coverage levels to decode, all of them if None
+        :type levels: sequence
+        
+        :returns: Dict of coverage level : list of [start, stop] intervals
+        :rtype: dict
+        '''
+        return encodingkit.decodeLevels(result[7], levels)
+    
+    def thresholdIntervals(self, result, level, below = True):
+        '''Returns the stitched intervals of a region below, or at or above, one of the levels of the database.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        :param level: Coverage level
+        :type level: int
+        :param below: Boolean indicating whether the intervals below level rather than at or above it are returned
+        :type below: bool
+        
+        :returns: List of [start, stop] intervals sorted by start
+        :rtype: list
+        '''
+        if self.hasThresholdIntervals:
+            return encodingkit.decodeLevels(result[(9 if below else 10) + len(self.levels)], [level]).get(level, [])
+        # Older databases only have the intervals of each level, stitch them here
+        if below:
+            levels = [l for l in reversed(sorted(self.levels)) if l < level]
+        else:
+            levels = [l for l in sorted(self.levels) if l >= level]
+        levelIntervals = self.levelIntervals(result, levels)
+        return intervalkit.stitch([interval for l in levels for interval in levelIntervals.get(l, [])])
+    
+    def subregions(self, result):
+        '''Returns the subregions of a region from its row in the regions table.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        
+        :returns: List of [start, stop, coverage] lists sorted by start
+        :rtype: list
+        '''
+        return encodingkit.decodeSubregions(result[4])
+    
+    def depthHistogram(self, result):
+        '''Returns the depth histogram of a region from its row in the regions table. Depths of 1000 and above are binned logarithmically.
+        The histogram of the last row asked for is kept, so the cutoffs, levels and percentiles of one row only decode it once.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        
+        :rtype: :class:`Histogram`
+        '''
+        if not self.hasHistograms:
+            raise Exception("Coverage database {} has no depth histograms, only levels {} are available.".format(self.dbfile, self.levels))
+        # Every row read from sqlite has a value object of its own, which the cache holds on to so it can not be reused for another row
+        value = result[8 + len(self.levels)]
+        if (self.lastHistogram is None) or (self.lastHistogram[0] is not value):
+            self.lastHistogram = (value, histogramkit.fromPairs(encodingkit.decodeHistogram(value), 0))
+        return self.lastHistogram[1]
+    
+    def subregionHistograms(self, result):
+        '''Returns the depth histograms of the subregions of a region from its row in the regions table.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        
+        :returns: List of (start, stop, :class:`Histogram`) tuples sorted by start
+        :rtype: list
+        '''
+        if not self.hasHistograms:
+            raise Exception("Coverage database {} has no depth histograms, only levels {} are available.".format(self.dbfile, self.levels))
+        # Older databases keep them in the histogram column with that of the region
+        value = result[11 + len(self.levels)] if self.hasSubregionHistograms else result[8 + len(self.levels)]
+        return [(start, stop, histogramkit.fromPairs(pairs, 0)) for start, stop, pairs in encodingkit.decodeSubregionHistograms(value)]
+    
+    def percentAtLeast(self, result, level):
+        '''Returns the fraction of a region covered at level or above, from the level column if there is one and from the depth histogram otherwise.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        :param level: Coverage level
+        :type level: int
+        
+        :rtype: float
+        '''
+        if level in self.levels:
+            return result[8 + self.levels.index(level)]
+        depthHistogram = self.depthHistogram(result)
+        total = depthHistogram.total()
+        if total == 0:
+            return 0.0
+        return depthHistogram.atLeast(level) / float(total)
+    
+    def depthPercentile(self, result, percentile):
+        '''Returns a percentile of the depth of coverage over the bases of a region, from its depth histogram.
+        
+        :param result: Row of the regions table
+        :type result: tuple
+        :param percentile: Percentile in [0, 100]
+        :type percentile: float
+        
+        :rtype: float
+        '''
+        return self.depthHistogram(result).percentile(percentile)
+    
+    def _filterByHistogram(self, results, histogramCutoffs):
+        for result in results:
+            keep = True
+            for level, cutoff, atOrAbove in histogramCutoffs:
+                if (self.percentAtLeast(result, level) >= cutoff) != atOrAbove:
+                    keep = False
+                    break
+            if keep:
+                yield result
+    
+    def _loadGeneList(self, geneID):
+        # Gene lists go in an indexed temporary table that queries join on, so their size is not bounded by the SQL expression limits
+        if self.loadedGenes == list(geneID):
+            return
+        self.loadedGenes = list(geneID)
+        self.c.execute("CREATE TEMP TABLE IF NOT EXISTS querygenes(id text PRIMARY KEY)")
+        self.c.execute("DELETE FROM querygenes")
+        self.c.executemany("INSERT OR IGNORE INTO querygenes VALUES (?)", ((gene,) for gene in geneID))
+        self.conn.commit()
+    
+    def _regionCount(self, ):
+        # Number of regions from the statistics gathered by ANALYZE, counted once for databases that have none
+        if self.regionCount is None:
+            try:
+                stat = self.c.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = 'regions' LIMIT 1").fetchone()
+            except sqlite3.OperationalError:
+                stat = None
+            if stat is not None:
+                self.regionCount = int(stat[0].split()[0])
+            else:
+                self.regionCount = self.c.execute("SELECT COUNT(*) FROM regions").fetchone()[0]
+        return self.regionCount
+    
+    def _countMatching(self, column, operator, parameter):
+        # The values of an indexed column are read once, in order from its index, and kept sorted, so the rows matching any cutoff on it
+        # are counted with a binary search instead of a COUNT(*) on every query
+        if column not in self.sortedColumns:
+            values = self.c.execute("SELECT {0} FROM regions WHERE {0} IS NOT NULL ORDER BY {0}".format(column)).fetchall()
+            self.sortedColumns[column] = numpy.array([value[0] for value in values], dtype=numpy.float64)
+        below = int(numpy.searchsorted(self.sortedColumns[column], parameter, side="left"))
+        if operator == "<":
+            return below
+        return len(self.sortedColumns[column]) - below
+    
+    def _planPredicates(self, predicates, geneID = None):
+        '''Orders the predicates of a query from the most to the least selective and returns the FROM clause, the predicate SQL and the
+        parameters. Without range statistics (sqlite_stat4) SQLite guesses that every range predicate keeps a quarter of the rows and then
+        prefers scanning ididx in id order, so the selectivity of each indexed predicate is counted on the sorted values of its column, which
+        are read from its index the first time the column is queried. The gene list, or else the most selective predicate if it keeps less than a tenth of the regions (past that reading rows in
+        index order and sorting them costs more than a scan in id order), drives the query, and the columns of the other predicates are
+        written as +column so SQLite does not pick their index instead.'''
+        counted = []
+        for column, operator, parameter, indexed in predicates:
+            if indexed:
+                matches = self._countMatching(column, operator, parameter)
+            else:
+                matches = None
+            counted.append((matches is None, matches, column, operator, parameter))
+        counted.sort()
+        self.mostRecentSelectivity = [(column, operator, parameter, matches) for unindexed, matches, column, operator, parameter in counted]
+        
+        driver = None
+        if (len(counted) > 0) and (not counted[0][0]) and (counted[0][1] * 10 < self._regionCount()):
+            driver = counted[0][2]
+        if geneID and ((driver is None) or (len(self.loadedGenes) <= counted[0][1])):
+            driver = "querygenes"
+        
+        if driver == "querygenes":
+            fromClause = 'querygenes CROSS JOIN regions ON regions.id = querygenes.id'
+        elif driver is not None:
+            fromClause = 'regions INDEXED BY {}idx'.format(driver)
+        else:
+            fromClause = 'regions'
+        if geneID and (driver != "querygenes"):
+            fromClause += ' JOIN querygenes ON regions.id = querygenes.id'
+        
         queryString = []
+        parameters = []
+        for i, (unindexed, matches, column, operator, parameter) in enumerate(counted):
+            drives = (i == 0) and ((driver is None) or (driver == column))
+            queryString.append("{}{} {} ?".format("" if drives else "+", column, operator))
+            parameters.append(parameter)
+        return fromClause, queryString, parameters
+    
+    def queryPlan(self, ):
+        '''Returns the plan SQLite chose for the most recent query, from EXPLAIN QUERY PLAN.
+        
+        :returns: List of plan steps
+        :rtype: list
+        '''
+        sqlQuery, parameters = self.mostRecentSQL
+        return [step[-1] for step in self.c.execute("EXPLAIN QUERY PLAN {}".format(sqlQuery), parameters)]
+    
+    def query(self, geneID = None, coverageLowCutoff = None, coverageHighCutoff = None, levelsLowCutoff = None, levelsHighCutoff = None):
+        '''Returns an iterator over the rows of the regions table matching every cutoff given, sorted by id. Cutoffs on levels stored as
+        columns are applied in SQL, cutoffs on any other level are computed from the depth histograms of the rows SQL returns. Rows are
+        read from their own cursor as the iterator is consumed, so other queries can run in the meantime.
+        
+        '''
+        # Predicates are (column, operator, parameter, indexed) tuples
+        predicates = []
+        histogramCutoffs = []
         if geneID:
-            queryString.append('id IN ("{}")'.format('","'.join(geneID)))
+            self._loadGeneList(geneID)
         
         if coverageLowCutoff:
-            queryString.append("coverage >= {}".format(coverageLowCutoff))
+            predicates.append(("coverage", ">=", coverageLowCutoff, True))
             
         if coverageHighCutoff:
-            queryString.append("coverage < {}".format(coverageHighCutoff))
+            predicates.append(("coverage", "<", coverageHighCutoff, True))
             
         if levelsLowCutoff:
-            levelQuery = []
             for curLevel,cutoff in levelsLowCutoff.items():
-                if cutoff != '.':
-                    levelQuery.append("percent{}X >= {}".format(curLevel,cutoff/100.0))
-            queryString.append(" AND ".join(levelQuery))
+                if (cutoff != '.') and (curLevel in self.levels):
+                    predicates.append(("percent{}X".format(int(curLevel)), ">=", cutoff/100.0, curLevel in self.indexedLevels))
+                elif cutoff != '.':
+                    histogramCutoffs.append((curLevel, cutoff/100.0, True))
         
         if levelsHighCutoff:
-            levelQuery = []
             for curLevel,cutoff in levelsHighCutoff.items():
-                if cutoff != '.':
-                    levelQuery.append("percent{}X < {}".format(curLevel,cutoff/100.0))
-            queryString.append(" AND ".join(levelQuery))
-        self.logger.debug('SELECT * FROM regions WHERE {}'.format(" AND ".join(queryString)))
-        self.mostRecentQuery = 'SELECT * FROM regions WHERE {}'.format(" AND ".join(queryString))
-        return self.c.execute('SELECT * FROM regions WHERE {}'.format(" AND ".join(queryString)))            
-    
-    def reset(self, regionsource, coveragesource, levels, mapq, dup, totalCoverage):
+                if (cutoff != '.') and (curLevel in self.levels):
+                    predicates.append(("percent{}X".format(int(curLevel)), "<", cutoff/100.0, curLevel in self.indexedLevels))
+                elif cutoff != '.':
+                    histogramCutoffs.append((curLevel, cutoff/100.0, False))
+        
+        if (len(histogramCutoffs) > 0) and (not self.hasHistograms):
+            raise Exception("Coverage database {} has no depth histograms, only levels {} can be queried.".format(self.dbfile, self.levels))
+        
+        fromClause, queryString, parameters = self._planPredicates(predicates, geneID)
+        sqlQuery = 'SELECT regions.* FROM {}'.format(fromClause)
+        if len(queryString) > 0:
+            sqlQuery += ' WHERE {}'.format(" AND ".join(queryString))
+        sqlQuery += ' ORDER BY regions.id'
+        self.logger.debug(sqlQuery)
+        self.mostRecentSQL = (sqlQuery, tuple(parameters))
+        self.mostRecentQuery = sqlQuery
+        if len(parameters) > 0:
+            self.mostRecentQuery += " [parameters {}]".format(", ".join(str(p) for p in parameters))
+        if geneID:
+            self.mostRecentQuery += " [{} genes]".format(self.c.execute("SELECT COUNT(*) FROM querygenes").fetchone()[0])
+        for level, cutoff, atOrAbove in histogramCutoffs:
+            self.mostRecentQuery += " [histogram percent{}X {} {}]".format(level, ">=" if atOrAbove else "<", cutoff)
+        
+        results = self.conn.execute(sqlQuery, parameters)
+        if len(histogramCutoffs) > 0:
+            return self._filterByHistogram(results, histogramCutoffs)
+        return results
+    
+    def notFound(self, geneID):
+        '''Returns the genes of a list that have no row in the regions table, found with one anti-join on the temporary gene table.
+        
+        :param geneID: Gene list
+        :type geneID: list
+        
+        :rtype: list
+        '''
+        self._loadGeneList(geneID)
+        return [gene[0] for gene in self.c.execute("SELECT querygenes.id FROM querygenes LEFT JOIN regions ON regions.id = querygenes.id WHERE regions.id IS NULL ORDER BY querygenes.id")]
+    
+    def reset(self, regionsource, coveragesource, levels, mapq, dup, totalCoverage, bulk = False):
         self.conn.close()
         self.regionsource = None
         self.coveragesource = None
         self.levels = None
         os.remove(self.dbfile)
-        self._create(self.dbfile, regionsource, coveragesource, levels, mapq, dup, totalCoverage)    
+        self._create(self.dbfile, regionsource, coveragesource, levels, mapq, dup, totalCoverage, bulk)
     
-    def __init__(self, db, regionsource = None, coveragesource = None, levels = None, mapq = 1, dups = False, totalCoverage = 0, overwrite = False):
+    def __init__(self, db, regionsource = None, coveragesource = None, levels = None, mapq = 1, dups = False, totalCoverage = 0, overwrite = False, bulk = False, readOnly = False):
         self.dbfile = db
+        if readOnly and (overwrite or (not os.path.isfile(db))):
+            raise Exception("Coverage database {} can only be opened read-only if it exists and is not overwritten.".format(db))
         if os.path.isfile(db):
-            self._load(db)
+            self._load(db, readOnly)
             if overwrite:
                 if regionsource and coveragesource and levels:
-                    self.reset(regionsource, coveragesource, levels, mapq, dups, totalCoverage)
+                    self.reset(regionsource, coveragesource, levels, mapq, dups, totalCoverage, bulk)
                 else:
                     raise Exception("Cannot create coverage database without regionsource, bamsource and levels specified.")
         else:
             if regionsource and coveragesource and levels:
-                self._create(db, regionsource, coveragesource, levels, mapq, dups, totalCoverage)
+                self._create(db, regionsource, coveragesource, levels, mapq, dups, totalCoverage, bulk)
             else:
                 raise Exception("Cannot create coverage database without regionsource, bamsource and levels specified.")
         self.logger = logging.getLogger("coveragekit utils.db.CoverageDB")
         self.logger.setLevel(logging.INFO)
         self.mostRecentQuery = ""
+        self.mostRecentSQL = None
+        self.mostRecentSelectivity = []
+        self.regionCount = None
+        self.sortedColumns = {}
+        self.loadedGenes = None
+        self.lastHistogram = None
+    
+    def close(self, ):
+        '''Closes the database.'''
+        self.conn.close()
     
     def __del__(self, ):
         self.conn.close()
@@ -0,0 +1,49 @@
+import array
+import numpy
+
+from coveragekit.version import __version__
+
+class DepthAccumulator(object):
+    '''Class that builds a per-base depth profile for a window of the genome. Each aligned block of a read is recorded as a start and a stop
+    event in a typed array, and the events are turned into depth with a single cumulative sum when :meth:`depth` is called.
+
+    '''
+
+    def addBlock(self, start, stop):
+        '''Records an aligned block covering [start, stop) in chromosome coordinates. Blocks must already be clipped to the window.
+
+        :param start: Chromosome coordinate of the first covered base.
+        :type start: int
+        :param stop: Chromosome coordinate one past the last covered base.
+        :type stop: int
+
+        '''
+        self.blockStarts.append(start - self.start)
+        self.blockStops.append(stop - self.start)
+
+    def depth(self, ):
+        '''Returns the depth of coverage for every base of the window.
+
+        :returns: Array of length stop - start with the depth at each position.
+        :rtype: numpy.ndarray
+
+        '''
+        starts = numpy.frombuffer(self.blockStarts, dtype=numpy.int32) if len(self.blockStarts) > 0 else numpy.zeros(0, dtype=numpy.int32)
+        stops = numpy.frombuffer(self.blockStops, dtype=numpy.int32) if len(self.blockStops) > 0 else numpy.zeros(0, dtype=numpy.int32)
+        events = numpy.bincount(starts, minlength=self.length + 1) - numpy.bincount(stops, minlength=self.length + 1)
+        return numpy.cumsum(events[:self.length], dtype=numpy.int32)
+
+    def __init__(self, start, stop):
+        '''Initializer for DepthAccumulator class.
+
+        :param start: Chromosome coordinate of the first base of the window.
+        :type start: int
+        :param stop: Chromosome coordinate one past the last base of the window.
+        :type stop: int
+
+        '''
+        self.start = start
+        self.stop = stop
+        self.length = stop - start
+        self.blockStarts = array.array('i')
+        self.blockStops = array.array('i')
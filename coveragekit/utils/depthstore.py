@@ -0,0 +1,198 @@
+import os, json, struct
+import numpy
+
+from coveragekit.version import __version__
+
+# A store starts with a four byte magic, a one byte format version and the length of its JSON index, followed by the run ends and the run
+# depths of every chromosome as two little-endian uint32 arrays
+MAGIC = "CKDS"
+VERSION = 1
+_HEADER = struct.Struct("<4sBI")
+
+def _editChrom(chrom):
+    # Chromosomes are stored without "chr", like the regions read from bed files
+    return chrom[3:] if chrom.startswith("chr") else chrom
+
+def runLengths(depths, start):
+    '''Returns the run-length encoding of the depths of consecutive positions as the chromosome coordinate one past the end of every run and
+    the depth of that run.
+
+    :param depths: Depth at each position
+    :type depths: numpy.ndarray
+    :param start: Chromosome coordinate of the first depth
+    :type start: int
+
+    :returns: (numpy.ndarray of run ends, numpy.ndarray of run depths)
+    :rtype: tuple
+    '''
+    if len(depths) == 0:
+        return (numpy.zeros(0, dtype="<u4"), numpy.zeros(0, dtype="<u4"))
+    changes = numpy.flatnonzero(numpy.diff(depths)) + 1
+    ends = numpy.concatenate((changes, [len(depths)])) + start
+    return (ends.astype("<u4"), depths[numpy.concatenate(([0], changes))].astype("<u4"))
+
+class DepthStoreWriter(object):
+    '''Class that writes the per-base depth of a bam file as a depth store. Chunks of runs can be added in any order: they are spooled to a
+    temporary file as they arrive and copied into chromosome and position order by :meth:`close`, so memory does not grow with the genome.
+
+    '''
+
+    def add(self, chrom, runs):
+        '''Adds the runs of one chunk.
+
+        :param chrom: Chromosome of the chunk
+        :type chrom: str
+        :param runs: (run ends, run depths) from :func:`runLengths`
+        :type runs: tuple
+
+        '''
+        ends, depths = runs
+        if len(ends) == 0:
+            return
+        self.pieces.append((self.chromRank[_editChrom(chrom)], int(ends[0]), self.spool.tell(), len(ends)))
+        self.spool.write(numpy.asarray(ends, dtype="<u4").tostring())
+        self.spool.write(numpy.asarray(depths, dtype="<u4").tostring())
+
+    def close(self, ):
+        '''Writes the store from the spooled runs and removes the spool.'''
+        self.pieces.sort()
+        runCounts = [0] * len(self.chromosomes)
+        for rank, start, position, numRuns in self.pieces:
+            runCounts[rank] += numRuns
+
+        index = {"version" : __version__, "chromosomes" : []}
+        index.update(self.metadata)
+        offset = 0
+        for (name, length), numRuns in zip(self.chromosomes, runCounts):
+            index["chromosomes"].append({"name" : name, "length" : length, "offset" : offset, "runs" : numRuns})
+            offset += numRuns
+        index["numRuns"] = offset
+        indexText = json.dumps(index, sort_keys = True)
+        # The run arrays start on an 8 byte boundary
+        indexText += " " * (-(_HEADER.size + len(indexText)) % 8)
+
+        self.spool.flush()
+        spoolFile = self.storeFile + ".spool"
+        tmpFile = "{}.{}.tmp".format(self.storeFile, os.getpid())
+        with open(spoolFile, "rb") as spool, open(tmpFile, "wb") as store:
+            store.write(_HEADER.pack(MAGIC, VERSION, len(indexText)))
+            store.write(indexText)
+            for arrayIndex in range(2):
+                for rank, start, position, numRuns in self.pieces:
+                    spool.seek(position + arrayIndex * 4 * numRuns)
+                    store.write(spool.read(4 * numRuns))
+        self.spool.close()
+        os.remove(spoolFile)
+        os.rename(tmpFile, self.storeFile)
+
+    def __init__(self, storeFile, header, metadata = None):
+        '''Initializer for DepthStoreWriter class.
+
+        :param storeFile: file path for the depth store
+        :type storeFile: str
+        :param header: Bam header, giving the name and length of every chromosome
+        :type header: pysam.AlignmentHeader
+        :param metadata: Values saved in the index of the store, such as the bam file and its filters
+        :type metadata: dict
+
+        '''
+        self.storeFile = storeFile
+        self.metadata = metadata if metadata else {}
+        self.chromosomes = [(_editChrom(sq["SN"]), sq["LN"]) for sq in header["SQ"]]
+        self.chromRank = dict((name, rank) for rank, (name, length) in enumerate(self.chromosomes))
+        self.pieces = []
+        self.spool = open(self.storeFile + ".spool", "wb")
+
+class DepthStore(object):
+    '''Class that reads a depth store. The run arrays are memory-mapped and the index gives the runs of each chromosome, so reading the depth
+    of a region only touches the runs overlapping it.
+
+    '''
+
+    def _runs(self, chrom):
+        chromosome = self.chromosomes.get(_editChrom(chrom))
+        if chromosome is None:
+            return None, None
+        first = chromosome["offset"]
+        last = first + chromosome["runs"]
+        return self.ends[first:last], self.depths[first:last]
+
+    def hasChromosome(self, chrom):
+        '''Returns whether chrom is one of the chromosomes of the bam file.'''
+        return _editChrom(chrom) in self.chromosomes
+
+    def chromosomeLength(self, chrom):
+        '''Returns the length of a chromosome.'''
+        return self.chromosomes[_editChrom(chrom)]["length"]
+
+    def depth(self, chrom, start, stop):
+        '''Returns the depth of every position from start to stop, 0 past the runs of the chromosome.
+
+        :param chrom: Chromosome, with or without "chr"
+        :type chrom: str
+        :param start: Chromosome coordinate of the first position
+        :type start: int
+        :param stop: Chromosome coordinate one past the last position
+        :type stop: int
+
+        :rtype: numpy.ndarray
+        '''
+        ends, depths = self._runs(chrom)
+        if (ends is None) or (len(ends) == 0) or (stop <= start):
+            return numpy.zeros(max(stop - start, 0), dtype=numpy.int32)
+        # Run i covers the positions from the end of run i - 1 up to its own end
+        first = numpy.searchsorted(ends, start, side="right")
+        last = min(numpy.searchsorted(ends, stop - 1, side="right"), len(ends) - 1)
+        if first > last:
+            return numpy.zeros(stop - start, dtype=numpy.int32)
+        runEnds = numpy.minimum(ends[first:last + 1].astype(numpy.int64), stop)
+        lengths = numpy.diff(numpy.concatenate(([start], runEnds)))
+        coverage = numpy.repeat(depths[first:last + 1].astype(numpy.int32), lengths)
+        if len(coverage) < stop - start:
+            coverage = numpy.concatenate((coverage, numpy.zeros(stop - start - len(coverage), dtype=numpy.int32)))
+        return coverage
+
+    def depthCounts(self, ):
+        '''Returns the number of bases of the genome at each depth, bases past the runs of a chromosome counted at depth 0.
+
+        :returns: Array where counts[d] is the number of bases at depth d
+        :rtype: numpy.ndarray
+        '''
+        counts = numpy.zeros(1, dtype=numpy.int64)
+        for name, chromosome in self.chromosomes.items():
+            ends, depths = self._runs(name)
+            covered = 0
+            if len(ends) > 0:
+                lengths = numpy.diff(numpy.concatenate(([0], ends.astype(numpy.int64))))
+                chromCounts = numpy.bincount(depths, weights = lengths).astype(numpy.int64)
+                if len(chromCounts) > len(counts):
+                    counts = numpy.concatenate((counts, numpy.zeros(len(chromCounts) - len(counts), dtype=numpy.int64)))
+                counts[:len(chromCounts)] += chromCounts
+                covered = int(ends[-1])
+            counts[0] += max(chromosome["length"] - covered, 0)
+        return counts
+
+    def __init__(self, storeFile):
+        '''Initializer for DepthStore class.
+
+        :param storeFile: file path for the depth store
+        :type storeFile: str
+
+        '''
+        self.storeFile = storeFile
+        with open(storeFile, "rb") as store:
+            magic, version, indexLength = _HEADER.unpack(store.read(_HEADER.size))
+            if magic != MAGIC:
+                raise Exception("{} is not a coveragekit depth store.".format(storeFile))
+            if version > VERSION:
+                raise Exception("Depth store written with format version {}, this version of coveragekit reads up to version {}.".format(version, VERSION))
+            self.index = json.loads(store.read(indexLength))
+        self.chromosomes = dict((chromosome["name"], chromosome) for chromosome in self.index["chromosomes"])
+        numRuns = self.index["numRuns"]
+        dataOffset = _HEADER.size + indexLength
+        if numRuns > 0:
+            self.ends = numpy.memmap(storeFile, dtype="<u4", mode="r", offset=dataOffset, shape=(numRuns,))
+            self.depths = numpy.memmap(storeFile, dtype="<u4", mode="r", offset=dataOffset + 4 * numRuns, shape=(numRuns,))
+        else:
+            self.ends = numpy.zeros(0, dtype="<u4")
+            self.depths = numpy.zeros(0, dtype="<u4")
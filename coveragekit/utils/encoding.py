@@ -0,0 +1,192 @@
+import struct, json
+import numpy
+
+from coveragekit.version import __version__
+
+# Every blob starts with a four byte magic, a one byte format version and a count, values written by older versions are JSON text
+LEVELS_MAGIC = "CKLV"
+SUBREGIONS_MAGIC = "CKSR"
+HISTOGRAM_MAGIC = "CKHG"
+SUBREGION_HISTOGRAMS_MAGIC = "CKSH"
+VERSION = 1
+_HEADER = struct.Struct("<4sBI")
+_LEVEL_ENTRY = struct.Struct("<iI")
+
+def _isBlob(value, magic):
+    return (not isinstance(value, unicode)) and (str(value[:4]) == magic)
+
+def _deltas(intervals):
+    '''Flattens [start, stop] intervals and delta encodes them as little-endian int32, each value relative to the one before it.'''
+    flat = numpy.array(intervals, dtype=numpy.int64).reshape(-1)
+    if len(flat) == 0:
+        return ""
+    return numpy.concatenate(([flat[0]], numpy.diff(flat))).astype("<i4").tostring()
+
+def _undeltas(data, offset, numIntervals):
+    '''Decodes numIntervals delta encoded intervals starting at offset into a list of [start, stop] lists.'''
+    if numIntervals == 0:
+        return []
+    flat = numpy.cumsum(numpy.frombuffer(data, dtype="<i4", count=2 * numIntervals, offset=offset), dtype=numpy.int64)
+    return flat.reshape(-1, 2).tolist()
+
+def encodeLevels(levelIntervals):
+    '''Returns the binary encoding of the intervals of a region at each coverage level: a header, a directory of (level, number of intervals)
+    entries, and for each level its intervals as delta encoded int32.
+
+    :param levelIntervals: Dict of coverage level : list of [start, stop] intervals sorted by start
+    :type levelIntervals: dict
+
+    :rtype: str
+    '''
+    levels = sorted(levelIntervals.keys())
+    parts = [_HEADER.pack(LEVELS_MAGIC, VERSION, len(levels))]
+    for level in levels:
+        parts.append(_LEVEL_ENTRY.pack(level, len(levelIntervals[level])))
+    for level in levels:
+        parts.append(_deltas(levelIntervals[level]))
+    return "".join(parts)
+
+def decodeLevels(value, levels = None):
+    '''Returns the intervals of a region at each coverage level from either the binary encoding or the JSON text of older databases. Only
+    the levels asked for are decoded from a binary value.
+
+    :param value: Value of the levels column
+    :type value: buffer or str
+    :param levels: Coverage levels to decode, all of them if None
+    :type levels: sequence
+
+    :returns: Dict of coverage level : list of [start, stop] intervals
+    :rtype: dict
+    '''
+    if not _isBlob(value, LEVELS_MAGIC):
+        decoded = dict((int(level), intervals) for level, intervals in json.loads(value).items())
+        if levels is None:
+            return decoded
+        return dict((level, decoded[level]) for level in levels if level in decoded)
+
+    data = str(value)
+    magic, version, numLevels = _HEADER.unpack_from(data, 0)
+    if version > VERSION:
+        raise Exception("Levels encoded with format version {}, this version of coveragekit reads up to version {}.".format(version, VERSION))
+    offset = _HEADER.size + numLevels * _LEVEL_ENTRY.size
+    wanted = None if levels is None else set(levels)
+    decoded = {}
+    for i in range(numLevels):
+        level, numIntervals = _LEVEL_ENTRY.unpack_from(data, _HEADER.size + i * _LEVEL_ENTRY.size)
+        if (wanted is None) or (level in wanted):
+            decoded[level] = _undeltas(data, offset, numIntervals)
+        offset += numIntervals * 8
+    return decoded
+
+def encodeSubregions(subregions):
+    '''Returns the binary encoding of the subregions of a region: a header, the subregion intervals as delta encoded int32 and the total
+    coverage of each subregion as int64.
+
+    :param subregions: List of (start, stop, coverage) tuples sorted by start
+    :type subregions: list
+
+    :rtype: str
+    '''
+    coverage = numpy.array([s[2] for s in subregions], dtype="<i8")
+    return "".join([_HEADER.pack(SUBREGIONS_MAGIC, VERSION, len(subregions)), _deltas([s[:2] for s in subregions]), coverage.tostring()])
+
+def decodeSubregions(value):
+    '''Returns the subregions of a region from either the binary encoding or the JSON text of older databases.
+
+    :param value: Value of the subregions column
+    :type value: buffer or str
+
+    :returns: List of [start, stop, coverage] lists sorted by start
+    :rtype: list
+    '''
+    if not _isBlob(value, SUBREGIONS_MAGIC):
+        return json.loads(value)
+
+    data = str(value)
+    magic, version, numSubregions = _HEADER.unpack_from(data, 0)
+    if version > VERSION:
+        raise Exception("Subregions encoded with format version {}, this version of coveragekit reads up to version {}.".format(version, VERSION))
+    intervals = _undeltas(data, _HEADER.size, numSubregions)
+    coverage = numpy.frombuffer(data, dtype="<i8", count=numSubregions, offset=_HEADER.size + numSubregions * 8).tolist()
+    return [interval + [c] for interval, c in zip(intervals, coverage)]
+
+def encodeHistogram(pairs):
+    '''Returns the binary encoding of a depth histogram: a header, the depths as delta encoded int32 and the number of bases at each depth
+    as int64.
+
+    :param pairs: List of [depth, bp] pairs sorted by depth, such as those of :meth:`Histogram.items`
+    :type pairs: list
+
+    :rtype: str
+    '''
+    counts = numpy.array([pair[1] for pair in pairs], dtype="<i8")
+    return "".join([_HEADER.pack(HISTOGRAM_MAGIC, VERSION, len(pairs)), _deltas([pair[0] for pair in pairs]), counts.tostring()])
+
+def _decodePairs(data, offset, numPairs):
+    '''Decodes numPairs depths and bp counts starting at offset into a list of [depth, bp] lists.'''
+    if numPairs == 0:
+        return []
+    depths = numpy.cumsum(numpy.frombuffer(data, dtype="<i4", count=numPairs, offset=offset), dtype=numpy.int64)
+    counts = numpy.frombuffer(data, dtype="<i8", count=numPairs, offset=offset + numPairs * 4)
+    return numpy.column_stack((depths, counts)).tolist()
+
+def decodeHistogram(value):
+    '''Returns the depth histogram of a region from either the binary encoding or the JSON text of older databases, which holds the
+    histograms of the subregions as well.
+
+    :param value: Value of the histogram column
+    :type value: buffer or str
+
+    :returns: List of [depth, bp] lists sorted by depth
+    :rtype: list
+    '''
+    if not _isBlob(value, HISTOGRAM_MAGIC):
+        return json.loads(value)["region"]
+
+    data = str(value)
+    magic, version, numPairs = _HEADER.unpack_from(data, 0)
+    if version > VERSION:
+        raise Exception("Histogram encoded with format version {}, this version of coveragekit reads up to version {}.".format(version, VERSION))
+    return _decodePairs(data, _HEADER.size, numPairs)
+
+def encodeSubregionHistograms(histograms):
+    '''Returns the binary encoding of the depth histograms of the subregions of a region: a header, the subregion intervals as delta encoded
+    int32, the number of depths of each histogram as uint32, and then each histogram encoded like :func:`encodeHistogram` without its header.
+
+    :param histograms: List of (start, stop, [depth, bp] pairs) tuples sorted by start
+    :type histograms: list
+
+    :rtype: str
+    '''
+    parts = [_HEADER.pack(SUBREGION_HISTOGRAMS_MAGIC, VERSION, len(histograms)), _deltas([h[:2] for h in histograms]), numpy.array([len(h[2]) for h in histograms], dtype="<u4").tostring()]
+    for start, stop, pairs in histograms:
+        parts.append(_deltas([pair[0] for pair in pairs]))
+        parts.append(numpy.array([pair[1] for pair in pairs], dtype="<i8").tostring())
+    return "".join(parts)
+
+def decodeSubregionHistograms(value):
+    '''Returns the depth histograms of the subregions of a region from either the binary encoding or the JSON text of the histogram column of
+    older databases.
+
+    :param value: Value of the subregionHistograms column, or of the histogram column of older databases
+    :type value: buffer or str
+
+    :returns: List of (start, stop, [depth, bp] pairs) tuples sorted by start
+    :rtype: list
+    '''
+    if not _isBlob(value, SUBREGION_HISTOGRAMS_MAGIC):
+        return [(start, stop, pairs) for start, stop, pairs in json.loads(value)["subregions"]]
+
+    data = str(value)
+    magic, version, numSubregions = _HEADER.unpack_from(data, 0)
+    if version > VERSION:
+        raise Exception("Subregion histograms encoded with format version {}, this version of coveragekit reads up to version {}.".format(version, VERSION))
+    intervals = _undeltas(data, _HEADER.size, numSubregions)
+    offset = _HEADER.size + numSubregions * 8
+    sizes = numpy.frombuffer(data, dtype="<u4", count=numSubregions, offset=offset).tolist()
+    offset += numSubregions * 4
+    histograms = []
+    for (start, stop), numPairs in zip(intervals, sizes):
+        histograms.append((start, stop, _decodePairs(data, offset, numPairs)))
+        offset += numPairs * 12
+    return histograms
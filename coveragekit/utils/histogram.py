@@ -0,0 +1,204 @@
+import numpy
+
+from coveragekit.version import __version__
+
+def fromPairs(pairs, cap = 100000):
+    '''Returns a :class:`Histogram` holding (value, count) pairs, such as those returned by :meth:`Histogram.items` or :meth:`Histogram.binned`.
+
+    :param pairs: Sequence of (value, count) pairs.
+    :type pairs: sequence
+    :param cap: Values in [0, cap) are counted in the dense array, others in a dict.
+    :type cap: int
+
+    :rtype: Histogram
+    '''
+    histogram = Histogram(cap)
+    for value, count in pairs:
+        histogram.add(value, count)
+    return histogram
+
+class Histogram(object):
+    '''Class that keeps exact counts of integer values in constant memory. Values in [0, cap) are counted in a dense array that only grows as
+    far as the largest value seen, and the rare values outside that range are counted in a dict. Histograms from different chunks are merged
+    with :meth:`merge` in O(bins), and the mean, standard deviation and percentiles are exact over every value added.
+
+    '''
+
+    def _grow(self, size):
+        if size > len(self.counts):
+            self.counts = numpy.concatenate((self.counts, numpy.zeros(size - len(self.counts), dtype=numpy.int64)))
+
+    def add(self, value, count = 1):
+        '''Adds count occurrences of a single value.
+
+        :param value: Value to add.
+        :type value: int
+        :param count: Number of occurrences.
+        :type count: int
+
+        '''
+        value = int(value)
+        if (value >= 0) and (value < self.cap):
+            self._grow(value + 1)
+            self.counts[value] += count
+        else:
+            self.tail[value] = self.tail.get(value, 0) + count
+
+    def addValues(self, values):
+        '''Adds every value of a sequence in one vectorized pass.
+
+        :param values: Values to add.
+        :type values: sequence
+
+        '''
+        values = numpy.asarray(values, dtype=numpy.int64)
+        inRange = (values >= 0) & (values < self.cap)
+        dense = values[inRange]
+        if len(dense) > 0:
+            binned = numpy.bincount(dense)
+            self._grow(len(binned))
+            self.counts[:len(binned)] += binned
+        for value in values[~inRange].tolist():
+            self.tail[value] = self.tail.get(value, 0) + 1
+
+    def addCounts(self, counts):
+        '''Adds a dense array of counts where counts[v] is the number of occurrences of value v, such as the output of numpy.bincount.
+
+        :param counts: Counts of the values 0 to len(counts) - 1.
+        :type counts: numpy.ndarray
+
+        '''
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        dense = counts[:self.cap]
+        self._grow(len(dense))
+        self.counts[:len(dense)] += dense
+        for value in numpy.flatnonzero(counts[self.cap:]).tolist():
+            self.tail[value + self.cap] = self.tail.get(value + self.cap, 0) + int(counts[value + self.cap])
+
+    def merge(self, other):
+        '''Adds the counts of another :class:`Histogram` to this one.
+
+        :param other: Histogram to merge in.
+        :type other: Histogram
+
+        '''
+        if other.cap != self.cap:
+            raise Exception("Cannot merge histograms with different caps ({} and {}).".format(self.cap, other.cap))
+        self._grow(len(other.counts))
+        self.counts[:len(other.counts)] += other.counts
+        for value, count in other.tail.items():
+            self.tail[value] = self.tail.get(value, 0) + count
+
+    def items(self, ):
+        '''Returns (value, count) tuples for every value with a non-zero count, sorted by value.
+
+        :rtype: list
+        '''
+        nonZero = numpy.flatnonzero(self.counts)
+        items = list(zip(nonZero.tolist(), self.counts[nonZero].tolist()))
+        items.extend(self.tail.items())
+        items.sort()
+        return items
+
+    def binned(self, exactCap = 1000, binsPerDoubling = 16):
+        '''Returns the histogram as sorted [value, count] pairs where values below exactCap are exact and larger values are replaced by the
+        lower edge of their logarithmic bin, binsPerDoubling bins for every doubling above exactCap. The bin edges do not depend on the data,
+        so binned histograms of different regions can be merged exactly, and their size stays small however deep the coverage is.
+
+        :param exactCap: Smallest value that is binned.
+        :type exactCap: int
+        :param binsPerDoubling: Number of logarithmic bins for each doubling of the value.
+        :type binsPerDoubling: int
+
+        :rtype: list
+        '''
+        binned = {}
+        for value, count in self.items():
+            if value >= exactCap:
+                step = int(numpy.floor(numpy.log2(value / float(exactCap)) * binsPerDoubling))
+                value = int(numpy.ceil(exactCap * 2 ** (step / float(binsPerDoubling))))
+            binned[value] = binned.get(value, 0) + count
+        return [[value, binned[value]] for value in sorted(binned)]
+
+    def total(self, ):
+        '''Returns the number of values added.
+
+        :rtype: int
+        '''
+        return int(self.counts.sum()) + sum(self.tail.values())
+
+    def atLeast(self, value):
+        '''Returns the number of values added that are greater than or equal to value.
+
+        :param value: Lower bound.
+        :type value: int
+
+        :rtype: int
+        '''
+        return int(self.counts[max(value, 0):].sum()) + sum(c for v,c in self.tail.items() if v >= value)
+
+    def mean(self, ):
+        '''Returns the mean of the values added, or None if there are none.
+
+        :rtype: float
+        '''
+        n = self.total()
+        if n == 0:
+            return None
+        return sum(v * c for v,c in self.items()) / float(n)
+
+    def sd(self, ):
+        '''Returns the sample standard deviation of the values added, or None if there are fewer than two. Sums are kept as exact integers
+        until the final division.
+
+        :rtype: float
+        '''
+        n = 0
+        s1 = 0
+        s2 = 0
+        for v,c in self.items():
+            n += c
+            s1 += v * c
+            s2 += v * v * c
+        if n < 2:
+            return None
+        return ((n * s2 - s1 * s1) / float(n * (n - 1))) ** 0.5
+
+    def percentile(self, q):
+        '''Returns the q-th percentile of the values added, interpolating linearly between the closest ranks, or None if there are no values.
+
+        :param q: Percentile in [0, 100].
+        :type q: float
+
+        :rtype: float
+        '''
+        items = self.items()
+        n = sum(c for v,c in items)
+        if n == 0:
+            return None
+        rank = (n - 1) * q / 100.0
+        lowRank = int(rank)
+        fraction = rank - lowRank
+
+        seen = 0
+        low = None
+        for v,c in items:
+            seen += c
+            if (low is None) and (seen > lowRank):
+                low = v
+                if (fraction == 0) or (seen > lowRank + 1):
+                    return float(low)
+            elif low is not None:
+                return low + (v - low) * fraction
+        return float(low)
+
+    def __init__(self, cap = 100000):
+        '''Initializer for Histogram class.
+
+        :param cap: Values in [0, cap) are counted in the dense array, others in a dict.
+        :type cap: int
+
+        '''
+        self.cap = cap
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.tail = {}
@@ -0,0 +1,119 @@
+import numpy
+
+from coveragekit.version import __version__
+
+def _merge(spans):
+    '''Merges a list of (start, stop) tuples into sorted, non-overlapping start and stop arrays.'''
+    mergedStarts = []
+    mergedStops = []
+    for start, stop in sorted(spans):
+        if (len(mergedStops) > 0) and (start <= mergedStops[-1]):
+            if stop > mergedStops[-1]:
+                mergedStops[-1] = stop
+        else:
+            mergedStarts.append(start)
+            mergedStops.append(stop)
+    return (numpy.array(mergedStarts, dtype=numpy.int64), numpy.array(mergedStops, dtype=numpy.int64))
+
+def stitch(intervals):
+    '''Returns [start, stop] intervals sorted by start with intervals that touch end to end joined. Sorting is stable, so intervals with the
+    same start keep their input order.
+
+    :param intervals: Sequence of [start, stop] intervals.
+    :type intervals: sequence
+    :rtype: list
+
+    '''
+    stitched = []
+    for start, stop in sorted(intervals, key=lambda x: int(x[0])):
+        if (len(stitched) > 0) and (start == stitched[-1][1]):
+            stitched[-1][1] = stop
+        else:
+            stitched.append([start, stop])
+    return stitched
+
+class IntervalIndex(object):
+    '''Class that indexes the subregions of a processing window once so that reads and bases can be assigned to them with batch
+    searchsorted queries. Subregions are merged per region set into sorted start and stop arrays, so overlapping targets from several
+    bed files cost nothing extra at query time.
+
+    '''
+
+    def merged(self, regionSet = None):
+        '''Returns the merged intervals covered by the subregions of a region set, or by all subregions if no region set is given.
+
+        :param regionSet: Region set descriptor.
+        :type regionSet: str
+        :returns: List of (start, stop) tuples sorted by start.
+        :rtype: list
+
+        '''
+        if regionSet is None:
+            starts, stops = self.allMerged
+        else:
+            starts, stops = self.setMerged[regionSet]
+        return list(zip(starts.tolist(), stops.tolist()))
+
+    def padded(self, padding, start, stop):
+        '''Returns the merged intervals covered by all subregions after widening each of them by padding on both sides and clipping them to
+        [start, stop).
+
+        :param padding: Number of bases added to each side of every subregion.
+        :type padding: int
+        :param start: Smallest coordinate returned.
+        :type start: int
+        :param stop: Largest coordinate returned.
+        :type stop: int
+        :returns: List of (start, stop) tuples sorted by start.
+        :rtype: list
+
+        '''
+        spans = [(max(r.start - padding, start), min(r.stop + padding, stop)) for r in self.regions]
+        paddedStarts, paddedStops = _merge([s for s in spans if s[0] < s[1]])
+        return list(zip(paddedStarts.tolist(), paddedStops.tolist()))
+
+    def overlaps(self, starts, stops):
+        '''Returns, for every region set, a boolean mask marking the spans that overlap at least one of its subregions.
+
+        Because the merged intervals of a region set are disjoint and sorted, the only candidate for a span [start, stop) is the last
+        merged interval starting before stop, and the span overlaps the region set if that interval ends after start.
+
+        :param starts: Start coordinates of the spans.
+        :type starts: sequence
+        :param stops: Stop coordinates of the spans.
+        :type stops: sequence
+        :returns: Dict of region set descriptor : numpy.ndarray of bool
+        :rtype: dict
+
+        '''
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        stops = numpy.asarray(stops, dtype=numpy.int64)
+        masks = {}
+        for regionSet, (setStarts, setStops) in self.setMerged.items():
+            candidate = numpy.searchsorted(setStarts, stops, side='left') - 1
+            masks[regionSet] = (candidate >= 0) & (setStops[numpy.maximum(candidate, 0)] > starts)
+        return masks
+
+    def __len__(self, ):
+        return len(self.regions)
+
+    def __init__(self, regions):
+        '''Initializer for IntervalIndex class.
+
+        :param regions: List of :class:`Region` objects to index.
+        :type regions: list
+
+        '''
+        self.regions = regions
+
+        spansBySet = {}
+        for r in regions:
+            if r.regionSet in spansBySet:
+                spansBySet[r.regionSet].append((r.start, r.stop))
+            else:
+                spansBySet[r.regionSet] = [(r.start, r.stop)]
+
+        self.setMerged = {}
+        for regionSet, spans in spansBySet.items():
+            self.setMerged[regionSet] = _merge(spans)
+        self.allMerged = _merge([(r.start, r.stop) for r in regions])
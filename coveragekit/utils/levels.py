@@ -1,4 +1,6 @@
 
+import numpy
+
 from coveragekit.version import __version__
 
 class CoverageLevel(object):
@@ -24,12 +26,53 @@ class CoverageLevel(object):
                
     def add(self, pos, coverage):
         if pos > (self.curPos + 1):
-            for i in range(self.curPos + 1, pos):
-                self._add(i, 0)
+            self.addDepths(self.curPos + 1, numpy.zeros(pos - (self.curPos + 1), dtype=numpy.int32))
         elif pos < (self.curPos + 1):
             #print pos, self.curPos, self.start, self.stop
             raise Exception("CoverageLevel.add can only go left to right along chromosome.")
         self._add(pos, coverage)
+    
+    def addDepths(self, pos, depths):
+        '''Adds a run of consecutive depths starting at pos. Every position is binned against the level boundaries in one pass and the
+        positions where the level changes are turned into level intervals with array operations, so the result is the same as calling
+        :meth:`add` once per position.
+        
+        :param pos: Chromosome coordinate (bp position) of the first depth.
+        :type pos: int
+        :param depths: Depth of coverage for consecutive positions starting at pos.
+        :type depths: numpy.ndarray
+        
+        '''
+        if pos > (self.curPos + 1):
+            self.addDepths(self.curPos + 1, numpy.zeros(pos - (self.curPos + 1), dtype=numpy.int32))
+        elif pos < (self.curPos + 1):
+            raise Exception("CoverageLevel.addDepths can only go left to right along chromosome.")
+        
+        depths = numpy.asarray(depths)
+        if len(depths) == 0:
+            return
+        
+        bins = numpy.searchsorted(self.levelBoundaries, depths, side='right') - 1
+        changes = numpy.flatnonzero(bins[1:] != bins[:-1]) + 1
+        if bins[0] != self.curLevel:
+            changes = numpy.concatenate(([0], changes))
+        
+        if len(changes) > 0:
+            # Each change closes the interval opened by the previous one (or by curLevelStart), at the level it was opened with
+            changePositions = pos + changes
+            intervalStarts = numpy.concatenate(([self.curLevelStart], changePositions[:-1]))
+            intervalLevels = numpy.concatenate(([self.curLevel], bins[changes[:-1]]))
+            nonEmpty = changePositions > intervalStarts
+            for level in numpy.unique(intervalLevels[nonEmpty]).tolist():
+                selected = nonEmpty & (intervalLevels == level)
+                self.coverageRegions[self.levels[level]].extend(zip(intervalStarts[selected].tolist(), changePositions[selected].tolist()))
+            self.curLevelStart = int(changePositions[-1])
+            self.curLevel = int(bins[changes[-1]])
+        
+        self.curLevelMin = self.levels[self.curLevel]
+        self.curLevelMax = self.levels[self.curLevel + 1]
+        self.coverage += int(depths.sum(dtype=numpy.int64))
+        self.curPos = pos + len(depths) - 1
             
     def report(self, ):        
         # Close out currently open region
@@ -61,6 +104,7 @@ class CoverageLevel(object):
             
         for i in self.levels[:-1]:
             self.coverageRegions[i] = []
+        self.levelBoundaries = numpy.array(self.levels[:-1])
         
             
         self.curLevelMin = self.levels[0]
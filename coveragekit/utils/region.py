@@ -1,11 +1,40 @@
 
-import json, logging
+import logging
+import coveragekit.utils.histogram as histogramkit
+import coveragekit.utils.encoding as encodingkit
+from coveragekit.utils.intervals import stitch
 
 from coveragekit.version import __version__
 
+def regionStats(regionSetAggregators, regions):
+    '''Returns the "regionStats" section of a coverage report, the report of every region set keyed by its name along with its region file.
+
+    :param regionSetAggregators: Dict of region descriptor::class:`RegionSet`
+    :type regionSetAggregators: dict
+    :param regions: Dict of region descriptor:region file path
+    :type regions: dict
+
+    :rtype: dict
+    '''
+    stats = {}
+    for descriptor in regionSetAggregators:
+        regionReport = regionSetAggregators[descriptor].report()
+        regionSetName = regionReport["name"]
+
+        del regionReport["name"]
+        stats[regionSetName] = regionReport
+        stats[regionSetName]["file"] = regions[descriptor]
+    return stats
+
 class RegionSet(object):
     
-    def add(self, region, levelReport):
+    def add(self, region, levelReport, order = None, depthHistogram = None):
+        '''Adds the coverage report of a (sub)region to the set. Regions can be added in any order; order is the position of the region's
+        processing chunk along the genome and is used to resolve names found on more than one chromosome the same way regardless of the order
+        in which regions arrive: the chromosome processed last wins. depthHistogram is the binned depth histogram of the (sub)region as
+        [depth, bp] pairs, kept for the subregion and merged into the histogram of the region.
+        
+        '''
         self.calcDone = False
         newRegion = True
         
@@ -14,7 +43,16 @@ class RegionSet(object):
             if self.regionDict[region.name]["chrom"] == region.chrom:
                 newRegion = False
             else:
-                self.logger.warning("Potential ambiguity in gene name for {}. Chromosome {} versus {}.".format(region.name,region.chrom,self.regionDict[region.name]["chrom"]))
+                if (region.name, region.chrom) not in self.regionChroms:
+                    self.logger.warning("Potential ambiguity in gene name for {}. Chromosome {} versus {}.".format(region.name,region.chrom,self.regionDict[region.name]["chrom"]))
+                if (order is not None) and (self.regionDict[region.name]["order"] is not None) and (order < self.regionDict[region.name]["order"]):
+                    # Region from a chromosome that has already been superseded, it only counts towards the set totals
+                    if (region.name, region.chrom) not in self.regionChroms:
+                        self.regionChroms.add((region.name, region.chrom))
+                        self.numRegions += 1
+                    self.coverage += levelReport[0]
+                    self.length += region.length
+                    return
             
         if not newRegion:
             if region.regionSet != self.setName:
@@ -29,6 +67,12 @@ class RegionSet(object):
             for curLevel in levelReport[1]:
                 self.regionDict[region.name]["bg"][curLevel[2]].append(curLevel[:2])
             self.regionDict[region.name]["subregions"].append((region.start, region.stop, levelReport[0]))
+            if depthHistogram is not None:
+                self.regionDict[region.name]["histograms"].append((region.start, region.stop, depthHistogram))
+                for depth, count in depthHistogram:
+                    self.regionDict[region.name]["histogram"].add(depth, count)
+            if (order is not None) and ((self.regionDict[region.name]["order"] is None) or (order > self.regionDict[region.name]["order"])):
+                self.regionDict[region.name]["order"] = order
         else:
             if region.regionSet != self.setName:
                 raise Exception("Discordance between region set ({}) and {} of RegionSet object".format(region,self.setName))
@@ -39,14 +83,24 @@ class RegionSet(object):
             self.regionDict[region.name]["length"] = region.length
             self.regionDict[region.name]["name"] = region.name
             self.regionDict[region.name]["index"] = self.numRegions
+            self.regionDict[region.name]["order"] = order
             self.regionDict[region.name]["coverage"] = levelReport[0]
             self.regionDict[region.name]["subregions"] = [(region.start,region.stop, levelReport[0])]
+            self.regionDict[region.name]["histograms"] = []
+            # Per region histograms are kept sparse, they only hold the few bins of the binned subregion histograms
+            self.regionDict[region.name]["histogram"] = histogramkit.Histogram(0)
+            if depthHistogram is not None:
+                self.regionDict[region.name]["histograms"].append((region.start, region.stop, depthHistogram))
+                for depth, count in depthHistogram:
+                    self.regionDict[region.name]["histogram"].add(depth, count)
             self.regionDict[region.name]["bg"] = {}
             for i in self.levels:
                 self.regionDict[region.name]["bg"][i] = []
             for curLevel in levelReport[1]:
                 self.regionDict[region.name]["bg"][curLevel[2]].append(curLevel[:2])
-            self.numRegions += 1
+            if (region.name, region.chrom) not in self.regionChroms:
+                self.regionChroms.add((region.name, region.chrom))
+                self.numRegions += 1
             
         self.coverage += levelReport[0]
         self.length += region.length
@@ -85,9 +139,26 @@ class RegionSet(object):
             r = self.regionDict[regionID]
         except KeyError:
             return None
-        record = [regionID, r["chrom"], r["start"], r["stop"], json.dumps(r["subregions"]),r["length"],r["averageCoverage"], json.dumps(r["bg"])]
+        # Subregions may have been added out of order
+        r["subregions"].sort()
+        r["histograms"].sort()
+        for i in r["bg"]:
+            r["bg"][i].sort()
+        # Subregions and level intervals are stored as binary blobs, buffer makes sqlite keep them as BLOBs
+        record = [regionID, r["chrom"], r["start"], r["stop"], buffer(encodingkit.encodeSubregions(r["subregions"])),r["length"],r["averageCoverage"], buffer(encodingkit.encodeLevels(r["bg"]))]
         for i in self.levels:
             record.append(r["levelCoverage"][i])
+        record.append(buffer(encodingkit.encodeHistogram(r["histogram"].items())))
+        
+        # Stitched intervals below and at or above every level, so queries only have to format them
+        below = {}
+        atOrAbove = {}
+        for i in self.levels:
+            below[i] = stitch([interval for l in reversed(self.levels) if l < i for interval in r["bg"][l]])
+            atOrAbove[i] = stitch([interval for l in self.levels if l >= i for interval in r["bg"][l]])
+        record.append(buffer(encodingkit.encodeLevels(below)))
+        record.append(buffer(encodingkit.encodeLevels(atOrAbove)))
+        record.append(buffer(encodingkit.encodeSubregionHistograms(r["histograms"])))
         record = tuple(record)
         return record
     
@@ -104,6 +175,22 @@ class RegionSet(object):
         for r in retrieveList:
             yield self._retrieve(r)    
     
+    def retrieveSubregions(self, ):
+        '''Yields an (id, chrom, start, stop, coverage) record for every subregion of every region in the set.'''
+        for regionID in sorted(self.regionDict.keys()):
+            r = self.regionDict[regionID]
+            for start, stop, coverage in sorted(r["subregions"]):
+                yield (regionID, r["chrom"], start, stop, coverage)
+    
+    def retrieveLevelIntervals(self, ):
+        '''Yields an (id, chrom, start, stop, level) record for every interval of every region in the set whose depth is at level or above
+        but below the next level.'''
+        for regionID in sorted(self.regionDict.keys()):
+            r = self.regionDict[regionID]
+            for level in sorted(r["bg"].keys()):
+                for start, stop in sorted(r["bg"][level]):
+                    yield (regionID, r["chrom"], start, stop, level)
+    
     def __init__(self, setName, levels):
         self.setName = setName
         self.length = 0
@@ -119,6 +206,7 @@ class RegionSet(object):
             self.levelCoverage[i] = 0
         
         self.regionDict = {}
+        self.regionChroms = set()
         self.calcDone = False
         
         self.logger = logging.getLogger("coveragekit utils.region.RegionSet {}".format(self.setName))
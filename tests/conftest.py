@@ -0,0 +1,98 @@
+import os, random
+import pysam
+import pytest
+
+import coveragekit.covbam as covbam
+
+def makeBam(bamFile, contigs, pairs, seed = 1, hotspot = None):
+    '''Writes a small coordinate sorted and indexed bam of read pairs.
+
+    :param bamFile: file path for the bam
+    :type bamFile: str
+    :param contigs: List of (name, length) tuples for the header
+    :type contigs: list
+    :param pairs: Dict of contig name:number of read pairs, contigs left out get no reads
+    :type pairs: dict
+    :param seed: Seed of the read positions, mapping qualities and duplicate flags
+    :type seed: int
+    :param hotspot: (contig name, start, stop) range a third of the pairs of that contig start in, none if None
+    :type hotspot: tuple
+
+    '''
+    rng = random.Random(seed)
+    header = {"HD" : {"VN" : "1.0", "SO" : "coordinate"}, "SQ" : [{"SN" : name, "LN" : length} for name, length in contigs]}
+    reads = []
+    count = 0
+    for referenceId, (name, length) in enumerate(contigs):
+        for i in range(pairs.get(name, 0)):
+            count += 1
+            if (hotspot is not None) and (hotspot[0] == name) and (rng.random() < 0.3):
+                start = rng.randint(hotspot[1], hotspot[2])
+            else:
+                start = rng.randint(0, length - 700)
+            insert = rng.randint(150, 500)
+            mateStart = start + insert - 100
+            mapq = rng.choice([60] * 8 + [0, 10])
+            duplicate = rng.random() < 0.05
+            for mate, (readStart, otherStart) in enumerate([(start, mateStart), (mateStart, start)]):
+                read = pysam.AlignedSegment()
+                read.query_name = "r{}".format(count)
+                read.reference_id = referenceId
+                read.reference_start = readStart
+                read.cigartuples = [(0, 100)]
+                read.query_sequence = "A" * 100
+                read.query_qualities = pysam.qualitystring_to_array("I" * 100)
+                read.mapping_quality = mapq
+                read.next_reference_id = referenceId
+                read.next_reference_start = otherStart
+                read.template_length = insert if mate == 0 else -insert
+                read.flag = 1 | 2 | (32 if mate == 0 else 16) | (64 if mate == 0 else 128) | (1024 if duplicate else 0)
+                reads.append(read)
+    reads.sort(key = lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(bamFile, "wb", header = header) as bamFH:
+        for read in reads:
+            bamFH.write(read)
+    pysam.index(bamFile)
+    return bamFile
+
+def writeBed(bedFile, lines):
+    '''Writes bed lines given as (chrom, start, stop, name) tuples.'''
+    with open(bedFile, "w") as bedFH:
+        for line in lines:
+            bedFH.write("\t".join(str(x) for x in line) + "\n")
+    return bedFile
+
+CONTIGS = [("chr1", 60000), ("chr2", 40000), ("chrUn", 3000)]
+
+@pytest.fixture(scope = "session")
+def sampleData(tmpdir_factory):
+    '''Two bams of the same reference and two region files, shared by the tests reading bams.'''
+    directory = str(tmpdir_factory.mktemp("data"))
+    data = {}
+    data["bam"] = makeBam(os.path.join(directory, "sample.bam"), CONTIGS, {"chr1" : 1500, "chr2" : 600, "chrUn" : 20}, seed = 1, hotspot = ("chr1", 20000, 21000))
+    data["otherBam"] = makeBam(os.path.join(directory, "other.bam"), CONTIGS, {"chr1" : 1000, "chr2" : 400}, seed = 2)
+    rng = random.Random(3)
+    geneLines = []
+    for gene in range(40):
+        chrom = "chr1" if gene < 25 else "chr2"
+        start = rng.randint(0, dict(CONTIGS)[chrom] - 3000)
+        for exon in range(rng.randint(1, 4)):
+            exonStart = start + exon * 600 + rng.randint(0, 100)
+            geneLines.append((chrom, exonStart, exonStart + rng.randint(50, 400), "{}G{}".format(chrom, gene)))
+    geneLines.append(("chr1", 19500, 22000, "hotspot"))
+    geneLines.sort()
+    data["genes"] = writeBed(os.path.join(directory, "genes.bed"), geneLines)
+    data["panel"] = writeBed(os.path.join(directory, "panel.bed"), [("chr1", 1000, 1500, "P1"), ("chr1", 1400, 2600, "P2"), ("chr2", 5000, 5300, "P3"), ("chr3", 100, 200, "P4")])
+    return data
+
+@pytest.fixture(scope = "session")
+def sampleDatabases(sampleData, tmpdir_factory):
+    '''Coverage databases of the two bams over the genes and panel region files, as (name, database file) tuples.'''
+    directory = str(tmpdir_factory.mktemp("databases"))
+    databases = []
+    for name in ("bam", "otherBam"):
+        regions = {"genes" : sampleData["genes"], "panel" : sampleData["panel"]}
+        files = dict((descriptor, os.path.join(directory, "{}.{}.db".format(name, descriptor))) for descriptor in regions)
+        covbam.bam(sampleData[name], regions, files, [5, 10, 20], 10000, 1, 1, False, False)
+        databases.extend([("{}.{}".format(name, descriptor), files[descriptor]) for descriptor in sorted(files)])
+    return databases
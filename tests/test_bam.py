@@ -0,0 +1,146 @@
+import os, json, sqlite3, random
+import numpy
+import pysam
+from multiprocessing import Pool, RawArray
+
+import coveragekit.covbam as covbam
+import coveragekit.utils.bed as covbed
+from coveragekit.utils.bam import ProcessingRegionGenerator, pairInsertLength
+from coveragekit.utils.depthstore import DepthStore
+from conftest import CONTIGS
+
+def _rows(dbFile):
+    return sqlite3.connect(dbFile).execute("SELECT * FROM regions ORDER BY id").fetchall()
+
+def _expected(sampleData, regions):
+    '''Read totals, insert sizes, on target reads and per-base depth worked out straight from the reads, mates overlapping their first mate left out of the depth.'''
+    targets = {}
+    for descriptor, bedFile in regions.items():
+        for line in open(bedFile):
+            chrom, start, stop, name = line.split("\t")
+            targets.setdefault(descriptor, []).append((chrom, int(start), int(stop)))
+    depths = dict((name, numpy.zeros(length, dtype=numpy.int64)) for name, length in CONTIGS)
+    expected = {"allReads" : 0, "readsCounted" : 0, "onTarget" : dict((descriptor, set()) for descriptor in regions)}
+    inserts = []
+    for read in pysam.AlignmentFile(sampleData["bam"]):
+        expected["allReads"] += 1
+        if read.is_duplicate or (read.mapping_quality < 1):
+            continue
+        expected["readsCounted"] += 1
+        if read.is_proper_pair and (read.template_length > 0):
+            inserts.append(read.template_length)
+        stop = read.reference_end
+        if read.is_proper_pair and (read.template_length >= 0) and (stop >= read.next_reference_start):
+            stop = read.next_reference_start
+        depths[read.reference_name][read.reference_start:stop] += 1
+        for descriptor in regions:
+            if any((chrom == read.reference_name) and (start < read.reference_end) and (targetStop > read.reference_start) for chrom, start, targetStop in targets[descriptor]):
+                expected["onTarget"][descriptor].add((read.query_name, read.is_read1))
+    expected["insertMean"] = numpy.mean(inserts)
+    expected["insertMedian"] = numpy.median(inserts)
+    expected["onTarget"] = dict((descriptor, float(len(reads))) for descriptor, reads in expected["onTarget"].items())
+    return expected, depths
+
+def test_reports_of_every_plan(sampleData, tmpdir):
+    regions = {"genes" : sampleData["genes"], "panel" : sampleData["panel"]}
+    expected, depths = _expected(sampleData, regions)
+    storeFile = str(tmpdir.join("sample.ckds"))
+    reference = json.loads(json.dumps(covbam.bam(sampleData["bam"], regions, {}, [5, 10, 20], 1000000, 1, 1, False, True, balance = False, depthStore = storeFile)))
+    for key in ("allReads", "readsCounted", "onTarget", "insertMedian"):
+        assert reference[key] == expected[key]
+    assert abs(reference["insertMean"] - expected["insertMean"]) < 1e-6
+    depthStore = DepthStore(storeFile)
+    for name, length in CONTIGS:
+        assert depthStore.depth(name, 0, length).tolist() == depths[name].tolist()
+
+    # Window sizes, thread counts, balanced windows, split jobs, hashed read names and fetching only targets give the same report. Insert
+    # sizes only come from the fetched pairs when fetching targets.
+    plans = [dict(windowSize = 3000, threads = 3), dict(windowSize = 10000, threads = 2, balance = False), dict(windowSize = 500, threads = 4, readIds = "hash"),
+             dict(windowSize = 5000, threads = 2, targetFetch = True)]
+    for plan in plans:
+        report = json.loads(json.dumps(covbam.bam(sampleData["bam"], regions, {}, [5, 10, 20], plan.pop("windowSize"), plan.pop("threads"), 1, False, not plan.get("targetFetch", False), **plan)))
+        for key in ("allReads", "readsCounted", "readsNotCounted", "onTarget", "regionStats"):
+            assert report[key] == reference[key]
+        if not plan.get("targetFetch", False):
+            for key in ("genome", "insertMean", "insertSD", "insertMedian", "insertPercentiles"):
+                assert report[key] == reference[key]
+
+def test_jobs_in_any_order(sampleData):
+    generator = ProcessingRegionGenerator(sampleData["bam"], 3000, True, False)
+    for descriptor in ("genes", "panel"):
+        for bedRegion in covbed.bedToRegions(descriptor, sampleData[descriptor]):
+            generator.addRegion(bedRegion)
+    def fields(job):
+        return (repr(job[0]), [(s.chrom, s.start, s.stop, s.name, s.regionSet, s.index) for s in job[1]], job[2], job[3])
+    inOrder = [fields(job) for job in generator.returnProcessingRegion()]
+    assert sum(len(job[1]) for job in inOrder) > 0
+    processingRegions = generator.processingRegions()
+    random.Random(1).shuffle(processingRegions)
+    for region, cost in processingRegions:
+        assert fields(generator.processingRegionJob(region, cost)) == inOrder[region.index]
+
+def test_scheduler_pulls_jobs_as_needed(sampleData):
+    generator = ProcessingRegionGenerator(sampleData["bam"], 1000, False, False)
+    processingRegions = sorted(generator.processingRegions(), key = lambda regionCost: regionCost[1], reverse = True)
+    pulled = []
+    def jobs():
+        for region, cost in processingRegions:
+            pulled.append(region.index)
+            yield generator.processingRegionJob(region, cost)
+    def makeInputs(job, slot):
+        return (sampleData["bam"], (5, 10, 20), job[:3], 1, False, False, "name", False, 0, slot, False)
+    threads = 2
+    splitState = RawArray('l', 3 * threads * 2)
+    workers = Pool(processes = threads, initializer = covbam._initWorker, initargs = (splitState,))
+    scheduler = covbam.JobScheduler(workers, splitState, jobs(), threads, makeInputs, 1000, pollInterval = 0.01, totalCost = sum(cost for region, cost in processingRegions), maxQueued = 8)
+    finished = 0
+    for job, chunk in scheduler.runJobs():
+        finished += 1
+        # Queued jobs and those handed to the workers, none of the rest of the plan
+        assert len(pulled) - finished <= 8 + len(splitState) // 3
+    workers.close()
+    workers.join()
+    assert pulled == [region.index for region, cost in processingRegions]
+    assert finished >= len(processingRegions)
+
+def test_pair_insert_length():
+    def leftMate(cigar, mateStart, templateLength, mateCigar = None):
+        read = pysam.AlignedSegment()
+        read.reference_id = 0
+        read.reference_start = 1000
+        read.cigarstring = cigar
+        read.next_reference_id = 0
+        read.next_reference_start = mateStart
+        read.template_length = templateLength
+        if mateCigar is not None:
+            read.set_tag("MC", mateCigar)
+        return read
+    # Apart, with an insertion and a deletion in the left mate and the mate's cigar from its MC tag
+    assert pairInsertLength(leftMate("40M5I20M3D35M", 1300, 400, "10S50M2I30M4D10M")) == (95 + 5) + (1300 - 1098) + 92
+    # Overlapping mates, the left mate counts up to the start of its mate
+    assert pairInsertLength(leftMate("100M", 1060, 160, "100M")) == 60 + 100
+    assert pairInsertLength(leftMate("50M10I50M", 1060, 160, "100M")) == 50 + 10 + 10 + 100
+    # Without an MC tag the mate spans the reference up to the end of the template
+    assert pairInsertLength(leftMate("100M", 1300, 400)) == 100 + 200 + 100
+
+def test_resume_from_checkpoint(sampleData, tmpdir):
+    regions = {"genes" : sampleData["genes"], "panel" : sampleData["panel"]}
+    checkpointDir = str(tmpdir.join("checkpoints"))
+    runs = {}
+    for name in ("full", "resumed"):
+        databases = dict((descriptor, str(tmpdir.join("{}.{}.db".format(name, descriptor)))) for descriptor in regions)
+        bedGraph = str(tmpdir.join("{}.bg.gz".format(name)))
+        report = covbam.bam(sampleData["bam"], regions, databases, [5, 10, 20], 10000, 1, 1, False, True, balance = False, checkpointDir = checkpointDir, resume = (name == "resumed"), bedGraph = bedGraph)
+        runs[name] = (json.loads(json.dumps(report)), databases, bedGraph)
+        if name == "full":
+            # A run that died part way, every other chunk is lost and read again on resuming
+            directory = os.path.join(checkpointDir, os.listdir(checkpointDir)[0])
+            chunkFiles = sorted(chunkFile for chunkFile in os.listdir(directory) if chunkFile.endswith(".chunk"))
+            assert len(chunkFiles) > 2
+            for chunkFile in chunkFiles[::2]:
+                os.remove(os.path.join(directory, chunkFile))
+    full, resumed = runs["full"], runs["resumed"]
+    assert resumed[0] == full[0]
+    for descriptor in regions:
+        assert _rows(resumed[1][descriptor]) == _rows(full[1][descriptor])
+    assert list(pysam.TabixFile(resumed[2]).fetch()) == list(pysam.TabixFile(full[2]).fetch())
@@ -0,0 +1,87 @@
+import os, struct, gzip
+import pysam
+import pytest
+
+import coveragekit.utils.bamindex as bamindexkit
+from conftest import makeBam, CONTIGS
+
+def _bins(minShift, depth, bins):
+    # Bins as (bin number, [(begin, end), ...]) with offsets in whole BGZF blocks, the pseudo-bin of mapped and unmapped counts comes last
+    pseudoBin = (((1 << ((depth + 1) * 3)) - 1) // 7) + 1
+    return list(bins) + [(pseudoBin, [(0, 0), (10, 0)])]
+
+def _writeBai(indexFile, bins, shift = 16):
+    data = ["BAI\1", struct.pack("<i", 1), struct.pack("<i", len(bins))]
+    for binNumber, chunks in bins:
+        data.append(struct.pack("<Ii", binNumber, len(chunks)))
+        data.extend(struct.pack("<QQ", begin << shift, end << shift) for begin, end in chunks)
+    data.append(struct.pack("<i", 0))
+    with open(indexFile, "wb") as indexFH:
+        indexFH.write("".join(data))
+
+def _writeCsi(indexFile, minShift, depth, bins):
+    data = ["CSI\1", struct.pack("<iii", minShift, depth, 0), struct.pack("<i", 1), struct.pack("<i", len(bins))]
+    for binNumber, chunks in bins:
+        data.append(struct.pack("<IQi", binNumber, 0, len(chunks)))
+        data.extend(struct.pack("<QQ", begin << 16, end << 16) for begin, end in chunks)
+    indexFH = gzip.open(indexFile, "wb")
+    indexFH.write("".join(data))
+    indexFH.close()
+
+def test_tiles_of_each_bin(tmpdir):
+    # The first two 16kb bins of the deepest level, and bin 0 spanning the whole reference
+    bins = [(4681, [(0, 1000)]), (4682, [(1000, 2500), (2600, 3100)]), (0, [(5000, 5300)])]
+    indexFile = str(tmpdir.join("manual.bai"))
+    _writeBai(indexFile, _bins(14, 5, bins))
+    bamIndex = bamindexkit.BamIndex(indexFile)
+    assert bamIndex.tileSize() == 16384
+    assert bamIndex.tileBytes(0, 40000).tolist() == [1100.0, 2100.0, 100.0]
+    assert bamIndex.hasReads(0) and (not bamIndex.hasReads(1))
+    assert bamIndex.tileBytes(1, 40000).tolist() == [0.0, 0.0, 0.0]
+
+    # The same bins of a CSI index with 4kb tiles and one more level
+    csiFile = str(tmpdir.join("manual.csi"))
+    _writeCsi(csiFile, 12, 6, _bins(12, 6, [(37449, [(0, 1000)]), (37450, [(1000, 2500)]), (0, [(5000, 5300)])]))
+    csiIndex = bamindexkit.BamIndex(csiFile)
+    assert csiIndex.tileSize() == 4096
+    tiles = csiIndex.tileBytes(0, 40000)
+    assert len(tiles) == 10
+    assert tiles.tolist() == [1030.0, 1530.0] + [30.0] * 8
+
+def test_chunk_in_well_compressed_blocks(tmpdir):
+    # Chunks given as virtual offsets, the first ends early in the block after the one it begins late in and would come out negative
+    bins = [(4681, [((100 << 16) | 60000, (101 << 16) | 100)]), (4682, [((101 << 16) | 100, (140 << 16) | 4000)])]
+    indexFile = str(tmpdir.join("compressed.bai"))
+    _writeBai(indexFile, _bins(14, 5, bins), shift = 0)
+    tiles = bamindexkit.BamIndex(indexFile).tileBytes(0, 30000)
+    assert tiles.tolist() == [0.0, 39.0 + (4000 // 4) - (100 // 4)]
+
+def test_bai_and_csi_of_a_bam(tmpdir):
+    bamFile = makeBam(str(tmpdir.join("sample.bam")), CONTIGS, {"chr1" : 1500, "chr2" : 600}, seed = 1)
+    pysam.index("-c", bamFile, str(tmpdir.join("sample.csi")))
+    pysam.index("-c", "-m", "12", bamFile, str(tmpdir.join("fine.csi")))
+    bai = bamindexkit.BamIndex(bamindexkit.findIndex(bamFile))
+    csi = bamindexkit.BamIndex(str(tmpdir.join("sample.csi")))
+    fine = bamindexkit.BamIndex(str(tmpdir.join("fine.csi")))
+    total = 0.0
+    for referenceId, (name, length) in enumerate(CONTIGS):
+        tiles = bai.tileBytes(referenceId, length)
+        assert len(tiles) == (length - 1) // 16384 + 1
+        assert csi.tileBytes(referenceId, length).tolist() == tiles.tolist()
+        assert fine.tileBytes(referenceId, length).sum() == pytest.approx(tiles.sum())
+        assert bai.hasReads(referenceId) == (name != "chrUn")
+        total += tiles.sum()
+    assert 0 < total <= os.path.getsize(bamFile)
+
+def test_find_index(tmpdir):
+    bamFile = str(tmpdir.join("sample.bam"))
+    open(bamFile, "w").close()
+    assert bamindexkit.findIndex(bamFile) is None
+    open(str(tmpdir.join("sample.bai")), "w").close()
+    assert bamindexkit.findIndex(bamFile) == str(tmpdir.join("sample.bai"))
+    open(bamFile + ".csi", "w").close()
+    assert bamindexkit.findIndex(bamFile) == str(tmpdir.join("sample.bai"))
+    open(bamFile + ".bai", "w").close()
+    assert bamindexkit.findIndex(bamFile) == bamFile + ".bai"
+    with pytest.raises(Exception):
+        bamindexkit.BamIndex(bamFile + ".bai")
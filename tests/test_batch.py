@@ -0,0 +1,45 @@
+import os, json, sqlite3
+
+import coveragekit.covbam as covbam
+import coveragekit.covbatch as covbatch
+from conftest import makeBam, writeBed, CONTIGS
+
+def _rows(dbFile):
+    return sqlite3.connect(dbFile).execute("SELECT * FROM regions ORDER BY id").fetchall()
+
+def _single(bamFile, regions, directory, name, **options):
+    databases = dict((descriptor, os.path.join(directory, "{}.{}.single.db".format(name, descriptor))) for descriptor in regions)
+    report = covbam.bam(bamFile, regions, databases, [5, 10, 20], options.get("windowSize", 1000000), 1, 1, False, options.get("genome", False), balance = options.get("balance", True))
+    return json.loads(json.dumps(report)), databases
+
+def test_batch_matches_single_runs(sampleData, tmpdir):
+    directory = str(tmpdir)
+    regions = {"genes" : sampleData["genes"], "panel" : sampleData["panel"]}
+    samples = [("S1", sampleData["bam"]), ("S2", sampleData["otherBam"])]
+    covbatch.batch(samples, regions, ["genes", "panel"], directory, [5, 10, 20], 10000, 2, 1, False, False, balance = False, writeTxt = True)
+    for name, bamFile in samples:
+        report, databases = _single(bamFile, regions, directory, name, windowSize = 10000, balance = False)
+        assert json.load(open(os.path.join(directory, "{}.json".format(name)))) == report
+        assert os.path.isfile(os.path.join(directory, "{}.txt".format(name)))
+        for descriptor, dbFile in databases.items():
+            assert _rows(os.path.join(directory, "{}.{}.db".format(name, descriptor))) == _rows(dbFile)
+
+def test_batch_reads_contigs_missing_from_first_bam(tmpdir):
+    # The first bam has no reads on chr2 and no region is on chr2, a plan from its index alone would leave chr2 out for every sample
+    directory = str(tmpdir)
+    firstBam = makeBam(os.path.join(directory, "first.bam"), CONTIGS, {"chr1" : 800}, seed = 4)
+    secondBam = makeBam(os.path.join(directory, "second.bam"), CONTIGS, {"chr1" : 800, "chr2" : 500, "chrUn" : 10}, seed = 5)
+    regions = {"genes" : writeBed(os.path.join(directory, "genes.bed"), [("chr1", 1000, 1400, "G1"), ("chr1", 30000, 30500, "G2")])}
+    samples = [("first", firstBam), ("second", secondBam)]
+    covbatch.batch(samples, regions, ["genes"], directory, [5, 10, 20], 1000000, 2, 1, False, False)
+    for name, bamFile in samples:
+        report, databases = _single(bamFile, regions, directory, name)
+        assert json.load(open(os.path.join(directory, "{}.json".format(name)))) == report
+        assert _rows(os.path.join(directory, "{}.genes.db".format(name))) == _rows(databases["genes"])
+    second = json.load(open(os.path.join(directory, "second.json")))
+    assert second["allReads"] == 2 * (800 + 500 + 10)
+
+def test_sample_sheet(tmpdir):
+    sheet = tmpdir.join("samples.tsv")
+    sheet.write("# flowcell\nA\t/data/a.bam\n\n/data/B.sorted.bam\n")
+    assert covbatch.readSampleSheet(str(sheet)) == [("A", "/data/a.bam"), ("B.sorted", "/data/B.sorted.bam")]
@@ -0,0 +1,63 @@
+import os, random
+import numpy
+import pysam
+
+import coveragekit.utils.region as covregion
+from coveragekit.utils.bedgraph import BedGraphWriter
+from coveragekit.utils.depthstore import runLengths
+
+def _expected(depths, chrom, levels = None):
+    '''Returns the bedGraph lines of per-base depths starting at 0.'''
+    if levels is not None:
+        levels = numpy.array((0,) + tuple(levels))
+        depths = levels[numpy.searchsorted(levels, depths, side="right") - 1]
+    lines = []
+    start = 0
+    for position in range(1, len(depths) + 1):
+        if (position == len(depths)) or (depths[position] != depths[start]):
+            if depths[start] != 0:
+                lines.append("{}\t{}\t{}\t{}".format(chrom, start, position, depths[start]))
+            start = position
+    return lines
+
+def _writeShuffled(bedGraphFile, depths, levels = None, seed = 1):
+    # Two processing regions, the first split into uneven chunks, added in random order
+    jobs = [(covregion.Region("chr1", 0, 600, 0, "_processing", 0), [], {}, 600.0),
+            (covregion.Region("chr1", 600, len(depths), 1, "_processing", 1), [], {}, 400.0)]
+    chunks = [(0, 0, 150), (0, 150, 151), (0, 151, 600), (1, 600, 800), (1, 800, len(depths))]
+    random.Random(seed).shuffle(chunks)
+    writer = BedGraphWriter(bedGraphFile, jobs, levels)
+    for index, start, stop in chunks:
+        writer.add(covregion.Region("1", start, stop, index, "_processing", index), runLengths(depths[start:stop], start))
+    writer.close()
+
+def test_out_of_order_chunks(tmpdir):
+    depths = numpy.repeat(numpy.array([0, 3, 3, 7, 0, 12, 25, 25, 4], dtype=numpy.int32), [40, 100, 20, 200, 90, 150, 50, 300, 50])
+    for seed in range(5):
+        bedGraphFile = str(tmpdir.join("depth{}.bg.gz".format(seed)))
+        _writeShuffled(bedGraphFile, depths, seed = seed)
+        assert list(pysam.TabixFile(bedGraphFile).fetch()) == _expected(depths, "chr1")
+        assert os.path.isfile(bedGraphFile + ".tbi")
+        assert not os.path.exists(bedGraphFile + ".spool")
+    overlapping = [line for line in _expected(depths, "chr1") if (int(line.split("\t")[1]) < 520) and (int(line.split("\t")[2]) > 500)]
+    assert list(pysam.TabixFile(bedGraphFile).fetch("chr1", 500, 520)) == overlapping
+
+def test_quantized_levels(tmpdir):
+    depths = numpy.repeat(numpy.array([1, 6, 9, 11, 30, 2], dtype=numpy.int32), [100, 100, 100, 200, 300, 200])
+    bedGraphFile = str(tmpdir.join("levels.bg.gz"))
+    _writeShuffled(bedGraphFile, depths, levels = [5, 10, 20])
+    assert list(pysam.TabixFile(bedGraphFile).fetch()) == ["chr1\t100\t300\t5", "chr1\t300\t500\t10", "chr1\t500\t800\t20"]
+
+def test_spooled_chunks_leave_memory(tmpdir):
+    depths = numpy.arange(1000, dtype=numpy.int32) // 7
+    jobs = [(covregion.Region("chr1", start, start + 100, index, "_processing", index), [], {}, 100.0) for index, start in enumerate(range(0, 1000, 100))]
+    bedGraphFile = str(tmpdir.join("spool.bg.gz"))
+    writer = BedGraphWriter(bedGraphFile, jobs)
+    for index in reversed(range(1, 10)):
+        writer.add(covregion.Region("1", index * 100, index * 100 + 100, index, "_processing", index), runLengths(depths[index * 100:index * 100 + 100], index * 100))
+        # Waiting chunks only keep their place in the spool
+        assert all(isinstance(value[1], int) for value in writer.pending.values())
+    writer.add(covregion.Region("1", 0, 100, 0, "_processing", 0), runLengths(depths[:100], 0))
+    assert len(writer.pending) == 0
+    writer.close()
+    assert list(pysam.TabixFile(bedGraphFile).fetch()) == _expected(depths, "chr1")
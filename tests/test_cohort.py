@@ -0,0 +1,55 @@
+import sqlite3
+import numpy
+
+import coveragekit.utils.db as covdb
+from coveragekit.utils.cohort import CohortDB
+
+def _samples(sampleDatabases):
+    # Named copies of the same databases make a cohort of any size, the panel databases have other genes than the gene databases
+    return [("{}{}".format(name, copy), dbFile) for copy in range(3) for name, dbFile in sampleDatabases]
+
+def _expected(samples, level, percent):
+    values = {}
+    for name, dbFile in samples:
+        coverageDB = covdb.CoverageDB(dbFile)
+        for result in coverageDB.query():
+            values.setdefault(result[0], []).append(numpy.float32(coverageDB.percentAtLeast(result, level)))
+        coverageDB.close()
+    expected = {}
+    for gene, vals in values.items():
+        vals = numpy.array(vals, dtype="<f4")
+        expected[gene] = (len(vals), int((vals < numpy.float32(percent / 100.0)).sum()), float(numpy.median(vals)))
+    return expected
+
+def test_append_in_steps_matches_one_append(sampleDatabases, tmpdir):
+    samples = _samples(sampleDatabases)
+    whole = CohortDB(str(tmpdir.join("whole.db")), (5, 10, 20), blockSize = 5)
+    whole.append(samples)
+    steps = CohortDB(str(tmpdir.join("steps.db")), (5, 10, 20), blockSize = 5)
+    for first, last in [(0, 1), (1, 4), (4, 5), (5, 11), (11, len(samples))]:
+        steps.append(samples[first:last])
+    assert steps.numSamples() == whole.numSamples() == len(samples)
+    assert [row[0] for row in steps.samples()] == [name for name, dbFile in samples]
+    for level, percent in [(5, 95), (20, 50)]:
+        assert list(steps.query(level, percent)) == list(whole.query(level, percent))
+        results = dict((r["id"], (r["numSamples"], r["numFailing"], r["median"])) for r in whole.query(level, percent))
+        assert results == _expected(samples, level, percent)
+
+def test_full_blocks_are_not_rewritten(sampleDatabases, tmpdir):
+    samples = _samples(sampleDatabases)
+    cohortFile = str(tmpdir.join("cohort.db"))
+    cohortDB = CohortDB(cohortFile, (20,), blockSize = 4)
+    cohortDB.append(samples[:4])
+    firstBlock = sqlite3.connect(cohortFile).execute("SELECT metric, id, vals FROM genevalues WHERE block = 0 ORDER BY metric, id").fetchall()
+    cohortDB.append(samples[4:6])
+    cohortDB.append(samples[6:])
+    assert sqlite3.connect(cohortFile).execute("SELECT metric, id, vals FROM genevalues WHERE block = 0 ORDER BY metric, id").fetchall() == firstBlock
+    assert sqlite3.connect(cohortFile).execute("SELECT MAX(block) FROM genevalues").fetchone()[0] == (len(samples) - 1) // 4
+
+def test_reopened_cohort_keeps_block_size(sampleDatabases, tmpdir):
+    cohortFile = str(tmpdir.join("cohort.db"))
+    CohortDB(cohortFile, (20,), blockSize = 3).append(sampleDatabases[:2])
+    reopened = CohortDB(cohortFile)
+    assert (reopened.levels, reopened.blockSize) == ((20,), 3)
+    reopened.append([("late", sampleDatabases[2][1])])
+    assert reopened.numSamples() == 3
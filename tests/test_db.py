@@ -0,0 +1,113 @@
+import os, random, json, sqlite3
+
+import coveragekit.covbam as covbam
+import coveragekit.covdb
+import coveragekit.utils.db as covdb
+import coveragekit.utils.encoding as encodingkit
+from conftest import writeBed
+
+def _databases(sampleDatabases):
+    return [covdb.CoverageDB(dbFile) for name, dbFile in sampleDatabases if name.endswith("genes")]
+
+def test_selectivity_matches_sql(sampleDatabases):
+    for coverageDB in _databases(sampleDatabases):
+        for column in ["coverage", "percent5X", "percent10X", "percent20X"]:
+            values = [row[0] for row in coverageDB.c.execute("SELECT {} FROM regions".format(column))]
+            for parameter in sorted(set(values)) + [-1.0, 0.0, 0.5, 1.0, 1000.0]:
+                for operator in (">=", "<"):
+                    count = coverageDB.c.execute("SELECT COUNT(*) FROM regions WHERE {} {} ?".format(column, operator), (parameter,)).fetchone()[0]
+                    assert coverageDB._countMatching(column, operator, parameter) == count
+
+def test_query_cutoffs(sampleDatabases):
+    for coverageDB in _databases(sampleDatabases):
+        rows = coverageDB.c.execute("SELECT * FROM regions ORDER BY id").fetchall()
+        levelIndex = [column[1] for column in coverageDB.c.execute("PRAGMA table_info(regions)")].index("percent10X")
+        for coverageMin, percentMax in [(None, 50), (5, None), (8, 90), (1000, None)]:
+            expected = [row for row in rows if ((coverageMin is None) or (row[6] >= coverageMin)) and ((percentMax is None) or (row[levelIndex] < percentMax / 100.0))]
+            # Served queries repeat their cutoffs on the same handle, the second plan uses the column values read by the first
+            for repeat in range(2):
+                levelsMax = {10 : percentMax} if percentMax is not None else None
+                assert list(coverageDB.query(coverageLowCutoff = coverageMin, levelsHighCutoff = levelsMax)) == expected
+        assert set(coverageDB.sortedColumns) <= set(["coverage", "percent10X"])
+
+def test_overlapping_with_long_interval(sampleData, tmpdir):
+    # One region spanning most of chr1 puts a long interval in each table among the short ones of the genes
+    lines = [line.split("\t") for line in open(sampleData["genes"]).read().splitlines()]
+    bedFile = writeBed(str(tmpdir.join("long.bed")), [(chrom, int(start), int(stop), name) for chrom, start, stop, name in lines] + [("chr1", 100, 55000, "long")])
+    dbFile = str(tmpdir.join("long.db"))
+    covbam.bam(sampleData["bam"], {"long" : bedFile}, {"long" : dbFile}, [5, 10, 20], 1000000, 1, 1, False, False)
+    coverageDB = covdb.CoverageDB(dbFile)
+    assert len(coverageDB.intervalSpans["subregionintervals"]) > 1
+    rng = random.Random(1)
+    for i in range(50):
+        start = rng.randint(0, 60000)
+        stop = start + rng.choice([1, 50, 1000, 20000])
+        for tableName, lookup in [("subregionintervals", coverageDB.subregionsOverlapping), ("levelintervals", coverageDB.levelIntervalsOverlapping)]:
+            expected = coverageDB.c.execute("SELECT id, chrom, start, stop, {} FROM {} WHERE chrom = '1' AND start < ? AND stop > ? ORDER BY start, stop, rowid".format("coverage" if tableName == "subregionintervals" else "level", tableName), (stop, start)).fetchall()
+            assert lookup("1", start, stop) == expected
+    atLevel = coverageDB.levelIntervalsOverlapping("1", 0, 60000, [10])
+    assert (len(atLevel) > 0) and all(row[4] == 10 for row in atLevel)
+
+def test_regions_of_stored_levels_only(sampleDatabases):
+    dbFile = [dbFile for name, dbFile in sampleDatabases if name == "bam.genes"][0]
+    results = coveragekit.covdb.db(dbFile, levelsMax = {10 : 100, 15 : 100}, reportRegions = True)
+    rows = list(results["queryResults"])
+    assert len(rows) > 0
+    for row in rows:
+        # The level from the histograms filters and is reported, it only has no regions
+        assert row["percentGreaterOrEqual"][15] < 1.0
+        assert row["coverageRegions"]["lessThan"].keys() == [10]
+
+def test_histogram_decoded_once_per_row(sampleDatabases, monkeypatch):
+    dbFile = [dbFile for name, dbFile in sampleDatabases if name == "bam.genes"][0]
+    decoded = []
+    decodeHistogram = covdb.encodingkit.decodeHistogram
+    monkeypatch.setattr(covdb.encodingkit, "decodeHistogram", lambda value: decoded.append(value) or decodeHistogram(value))
+    coverageDB = covdb.CoverageDB(dbFile)
+    rows = coverageDB.c.execute("SELECT * FROM regions").fetchall()
+    results = coveragekit.covdb.db(dbFile, levelsMin = {15 : 10}, levelsMax = {7 : 100}, levels = [3, 15], percentiles = [5, 50], coverageDB = coverageDB)
+    reported = list(results["queryResults"])
+    assert 0 < len(reported) < len(rows)
+    assert len(decoded) == len(rows)
+
+def test_histograms_of_older_databases(sampleDatabases, tmpdir):
+    # Databases built before the histograms were encoded keep the region and subregion histograms as JSON text in one column
+    dbFile = [dbFile for name, dbFile in sampleDatabases if name == "bam.genes"][0]
+    coverageDB = covdb.CoverageDB(dbFile)
+    rows = coverageDB.c.execute("SELECT * FROM regions ORDER BY id").fetchall()
+    expected = [([coverageDB.percentAtLeast(row, level) for level in (3, 15)], coverageDB.depthPercentile(row, 50), [(start, stop, histogram.items()) for start, stop, histogram in coverageDB.subregionHistograms(row)]) for row in rows]
+    oldFile = str(tmpdir.join("old.db"))
+    conn = sqlite3.connect(oldFile)
+    conn.execute("ATTACH DATABASE ? AS new", (dbFile,))
+    for table in ("metadata", "coveragekit"):
+        conn.execute("CREATE TABLE {0} AS SELECT * FROM new.{0}".format(table))
+    columns = [column[1] for column in conn.execute("PRAGMA new.table_info(regions)")][:-1]
+    conn.execute("CREATE TABLE regions({})".format(", ".join(columns)))
+    histogramColumn = columns.index("histogram")
+    for row in rows:
+        oldRow = list(row[:-1])
+        oldRow[histogramColumn] = json.dumps({"region" : encodingkit.decodeHistogram(row[histogramColumn]), "subregions" : encodingkit.decodeSubregionHistograms(row[-1])})
+        conn.execute("INSERT INTO regions VALUES ({})".format(",".join("?" * len(oldRow))), oldRow)
+    conn.commit()
+    conn.close()
+    oldDB = covdb.CoverageDB(oldFile)
+    assert not oldDB.hasSubregionHistograms
+    oldRows = oldDB.c.execute("SELECT * FROM regions ORDER BY id").fetchall()
+    assert [([oldDB.percentAtLeast(row, level) for level in (3, 15)], oldDB.depthPercentile(row, 50), [(start, stop, histogram.items()) for start, stop, histogram in oldDB.subregionHistograms(row)]) for row in oldRows] == expected
+
+def test_multi_database_results_through_files(sampleDatabases, tmpdir):
+    dbFiles = [dbFile for name, dbFile in sampleDatabases if name.endswith("genes")]
+    queryArgs = dict(levelsMin = None, levelsMax = None, coverageMin = None, coverageMax = None, levels = (), percentiles = (), position = None, reportRegions = False)
+    outcomes = coveragekit.covdb.dbMulti(dbFiles + [str(tmpdir.join("missing.db"))], threads = 2, writeTSV = True, tmpDir = str(tmpdir), **queryArgs)
+    for dbFile in dbFiles:
+        outcome = next(outcomes)
+        assert outcome["error"] is None
+        with open(outcome["json"]) as jsonFile:
+            assert json.load(jsonFile)["meta"]["queryResultNum"] == outcome["queryResultNum"] > 0
+        with open(outcome["tsv"]) as tsvFile:
+            assert len(tsvFile.readlines()) == outcome["queryResultNum"] + 1
+    # The files of an outcome are removed once the next one is asked for
+    assert next(outcomes)["error"] is not None
+    assert not any(os.path.exists(path) for path in (outcome["json"], outcome["tsv"]))
+    assert list(outcomes) == []
+    assert tmpdir.listdir() == []
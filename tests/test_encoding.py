@@ -0,0 +1,77 @@
+import json, random, sqlite3
+import pytest
+
+import coveragekit.utils.encoding as encodingkit
+
+def _levels(rng):
+    levels = {}
+    for level in (0, 5, 10, 20):
+        position = rng.randint(0, 10 ** 8)
+        intervals = []
+        for i in range(rng.randint(0, 30)):
+            position += rng.randint(0, 5000)
+            stop = position + rng.randint(1, 5000)
+            intervals.append([position, stop])
+            position = stop
+        levels[level] = intervals
+    return levels
+
+def test_levels_round_trip():
+    rng = random.Random(1)
+    for i in range(50):
+        levels = _levels(rng)
+        encoded = encodingkit.encodeLevels(levels)
+        assert encodingkit.decodeLevels(encoded) == levels
+        assert encodingkit.decodeLevels(encoded, [5, 20, 40]) == dict((level, levels[level]) for level in (5, 20))
+    assert encodingkit.decodeLevels(encodingkit.encodeLevels({})) == {}
+
+def test_subregions_round_trip():
+    rng = random.Random(2)
+    for i in range(50):
+        start = rng.randint(0, 2 ** 31 - 10 ** 6)
+        subregions = []
+        for j in range(rng.randint(0, 20)):
+            start += rng.randint(0, 1000)
+            subregions.append([start, start + rng.randint(1, 1000), rng.randint(0, 2 ** 40)])
+        assert encodingkit.decodeSubregions(encodingkit.encodeSubregions(subregions)) == subregions
+
+def test_histograms_round_trip():
+    rng = random.Random(3)
+    for i in range(50):
+        histograms = []
+        start = rng.randint(0, 10 ** 8)
+        for j in range(rng.randint(0, 20)):
+            depths = sorted(rng.sample(range(5000), rng.randint(0, 30)))
+            histograms.append((start, start + rng.randint(1, 1000), [[depth, rng.randint(1, 2 ** 40)] for depth in depths]))
+            start += rng.randint(0, 2000)
+        for start, stop, pairs in histograms:
+            assert encodingkit.decodeHistogram(encodingkit.encodeHistogram(pairs)) == pairs
+        assert encodingkit.decodeSubregionHistograms(encodingkit.encodeSubregionHistograms(histograms)) == histograms
+
+def test_blobs_through_sqlite():
+    # Values come back from SQLite as buffers
+    levels = {0 : [[10, 20]], 5 : [[20, 35], [40, 41]]}
+    subregions = [[10, 41, 300]]
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t(levels blob, subregions blob)")
+    conn.execute("INSERT INTO t VALUES (?,?)", (buffer(encodingkit.encodeLevels(levels)), buffer(encodingkit.encodeSubregions(subregions))))
+    storedLevels, storedSubregions = conn.execute("SELECT * FROM t").fetchone()
+    assert encodingkit.decodeLevels(storedLevels) == levels
+    assert encodingkit.decodeSubregions(storedSubregions) == subregions
+
+def test_json_of_older_databases():
+    assert encodingkit.decodeLevels(json.dumps({"0" : [[1, 5]], "10" : [[5, 9]]})) == {0 : [[1, 5]], 10 : [[5, 9]]}
+    assert encodingkit.decodeLevels(u'{"0": [[1, 5]], "10": [[5, 9]]}', [10]) == {10 : [[5, 9]]}
+    assert encodingkit.decodeSubregions(u'[[1, 5, 20]]') == [[1, 5, 20]]
+    histogram = u'{"region": [[0, 4], [3, 10]], "subregions": [[1, 5, [[0, 4]]], [5, 15, [[3, 10]]]]}'
+    assert encodingkit.decodeHistogram(histogram) == [[0, 4], [3, 10]]
+    assert encodingkit.decodeSubregionHistograms(histogram) == [(1, 5, [[0, 4]]), (5, 15, [[3, 10]])]
+
+def test_newer_format_version():
+    encoded = encodingkit.encodeLevels({0 : [[1, 2]]})
+    newer = encoded[:4] + chr(encodingkit.VERSION + 1) + encoded[5:]
+    with pytest.raises(Exception):
+        encodingkit.decodeLevels(newer)
+    encoded = encodingkit.encodeHistogram([[1, 2]])
+    with pytest.raises(Exception):
+        encodingkit.decodeHistogram(encoded[:4] + chr(encodingkit.VERSION + 1) + encoded[5:])
@@ -0,0 +1,65 @@
+import random
+import numpy
+import pytest
+
+import coveragekit.utils.histogram as histogramkit
+
+def _values(seed, size = 2000):
+    rng = random.Random(seed)
+    # Mostly small values, some past the dense cap and some negative
+    return [rng.choice([rng.randint(0, 500), rng.randint(0, 500), rng.randint(1000, 5000), rng.randint(-10, -1)]) for i in range(size)]
+
+def test_statistics_match_numpy():
+    values = _values(1)
+    histogram = histogramkit.Histogram(cap = 1000)
+    histogram.addValues(values)
+    assert histogram.total() == len(values)
+    assert histogram.mean() == pytest.approx(numpy.mean(values))
+    assert histogram.sd() == pytest.approx(numpy.std(values, ddof=1))
+    for q in (0, 1, 10, 25, 33.3, 50, 75, 90, 99, 100):
+        assert histogram.percentile(q) == pytest.approx(numpy.percentile(values, q))
+    for value in (-5, 0, 250, 1000, 4000, 6000):
+        assert histogram.atLeast(value) == sum(1 for v in values if v >= value)
+
+def test_merge_matches_single_histogram():
+    values = _values(2)
+    whole = histogramkit.Histogram(cap = 1000)
+    whole.addValues(values)
+    merged = histogramkit.Histogram(cap = 1000)
+    for start in range(0, len(values), 300):
+        part = histogramkit.Histogram(cap = 1000)
+        # The three ways of adding values give the same counts
+        if start % 900 == 0:
+            part.addValues(values[start:start + 300])
+        elif start % 900 == 300:
+            for value in values[start:start + 300]:
+                part.add(value)
+        else:
+            chunk = values[start:start + 300]
+            for value in chunk:
+                if value < 0:
+                    part.add(value)
+            part.addCounts(numpy.bincount([value for value in chunk if value >= 0]))
+        merged.merge(part)
+    assert merged.items() == whole.items()
+    assert histogramkit.fromPairs(whole.items(), cap = 1000).items() == whole.items()
+    with pytest.raises(Exception):
+        merged.merge(histogramkit.Histogram(cap = 10))
+
+def test_binned():
+    histogram = histogramkit.Histogram()
+    histogram.addValues(_values(3))
+    binned = histogram.binned(exactCap = 1000, binsPerDoubling = 16)
+    exact = dict(histogram.items())
+    assert sum(count for value, count in binned) == histogram.total()
+    assert [pair for pair in binned if pair[0] < 1000] == [[value, count] for value, count in histogram.items() if value < 1000]
+    # Binned values are the lower edges of bins about 4% wide, which do not depend on the data
+    edges = set(int(numpy.ceil(1000 * 2 ** (step / 16.0))) for step in range(64))
+    assert all(value in edges for value, count in binned if value >= 1000)
+    assert sum(count for value, count in binned if value >= 1000) == sum(count for value, count in exact.items() if value >= 1000)
+
+def test_empty():
+    histogram = histogramkit.Histogram()
+    assert (histogram.mean(), histogram.sd(), histogram.percentile(50)) == (None, None, None)
+    histogram.add(7)
+    assert (histogram.mean(), histogram.sd(), histogram.percentile(50)) == (7.0, None, 7.0)
@@ -0,0 +1,53 @@
+import random
+import numpy
+
+import coveragekit.utils.region as covregion
+import coveragekit.utils.intervals as intervalkit
+
+def _regions(seed):
+    rng = random.Random(seed)
+    regions = []
+    for i in range(60):
+        start = rng.randint(0, 10000)
+        regions.append(covregion.Region("1", start, start + rng.randint(1, 400), "R{}".format(i), rng.choice(["genes", "panel"]), i))
+    return regions
+
+def _covered(spans):
+    covered = set()
+    for start, stop in spans:
+        covered.update(range(start, stop))
+    return covered
+
+def test_merged():
+    for seed in range(5):
+        regions = _regions(seed)
+        index = intervalkit.IntervalIndex(regions)
+        assert len(index) == len(regions)
+        for regionSet in (None, "genes", "panel"):
+            merged = index.merged(regionSet)
+            # Disjoint, sorted, and not touching, as touching spans are merged too
+            assert all(earlier[1] < later[0] for earlier, later in zip(merged, merged[1:]))
+            assert _covered(merged) == _covered([(r.start, r.stop) for r in regions if regionSet in (None, r.regionSet)])
+
+def test_overlaps():
+    rng = random.Random(10)
+    regions = _regions(10)
+    index = intervalkit.IntervalIndex(regions)
+    starts = numpy.array([rng.randint(-100, 10500) for i in range(500)])
+    stops = starts + numpy.array([rng.randint(1, 300) for i in range(500)])
+    masks = index.overlaps(starts, stops)
+    for regionSet in ("genes", "panel"):
+        expected = [any((r.start < stop) and (r.stop > start) for r in regions if r.regionSet == regionSet) for start, stop in zip(starts, stops)]
+        assert masks[regionSet].tolist() == expected
+
+def test_padded():
+    regions = _regions(20)
+    index = intervalkit.IntervalIndex(regions)
+    padded = index.padded(150, 100, 9000)
+    expected = set(position for position in _covered([(r.start - 150, r.stop + 150) for r in regions]) if 100 <= position < 9000)
+    assert _covered(padded) == expected
+    assert all(earlier[1] < later[0] for earlier, later in zip(padded, padded[1:]))
+
+def test_stitch():
+    assert intervalkit.stitch([[30, 40], [10, 20], [20, 30], [50, 60]]) == [[10, 40], [50, 60]]
+    assert intervalkit.stitch([]) == []
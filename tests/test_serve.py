@@ -0,0 +1,83 @@
+import os, shutil, sqlite3
+import pytest
+
+import coveragekit.covserve as covserve
+
+def test_pool_opens_read_only(sampleDatabases):
+    pool = covserve.CoverageDBPool(maxOpen = 2)
+    dbFile = dict(sampleDatabases)["bam.genes"]
+    coverageDB = pool.get(dbFile)[0]
+    genes = [row[0] for row in coverageDB.c.execute("SELECT id FROM regions ORDER BY id LIMIT 3")]
+    # Gene lists go to a temporary table, which a read-only handle can still write
+    assert [row[0] for row in coverageDB.query(genes + ["nope"])] == genes
+    assert coverageDB.notFound(genes + ["nope"]) == ["nope"]
+    with pytest.raises(sqlite3.OperationalError):
+        coverageDB.c.execute("CREATE TABLE scratch(id text)")
+    pool.close()
+
+def test_lru_cache():
+    evicted = []
+    cache = covserve.LRUCache(3, onEvict = lambda key, value: evicted.append((key, value)))
+    for key in "abc":
+        cache[key] = key.upper()
+    assert cache.get("a") == "A"
+    cache["d"] = "D"
+    # b was the least recently used once a was read
+    assert evicted == [("b", "B")]
+    assert cache.keys() == ["c", "a", "d"]
+    cache["c"] = "C2"
+    assert (cache.keys(), len(evicted)) == (["a", "d", "c"], 1)
+    assert cache.get("b", "missing") == "missing"
+    assert (cache.pop("a"), "a" in cache, len(cache)) == ("A", False, 2)
+    cache.clear()
+    assert evicted == [("b", "B"), ("d", "D"), ("c", "C2")]
+    with pytest.raises(Exception):
+        covserve.LRUCache(0)
+
+def test_lru_cache_bytes():
+    evicted = []
+    cache = covserve.LRUCache(10, onEvict = lambda key, value: evicted.append(key), maxBytes = 10, sizeOf = len)
+    cache["a"] = "aaaa"
+    cache["b"] = "bbbb"
+    cache["c"] = "cc"
+    assert (evicted, cache.totalBytes) == ([], 10)
+    cache["d"] = "ddd"
+    assert (evicted, cache.keys(), cache.totalBytes) == (["a"], ["b", "c", "d"], 9)
+    cache["c"] = "c"
+    assert cache.totalBytes == 8
+    cache.pop("b")
+    assert cache.totalBytes == 4
+    # A value larger than the whole budget is left as the only entry
+    cache["e"] = "e" * 20
+    assert (cache.keys(), cache.totalBytes) == (["e"], 20)
+    cache.clear()
+    assert cache.totalBytes == 0
+
+def test_service_skips_large_answers(sampleDatabases):
+    dbFile = dict(sampleDatabases)["bam.genes"]
+    service = covserve.QueryService(os.path.dirname(dbFile), cacheBytes = 8 * 1024 ** 2)
+    small = service.query({"db" : os.path.basename(dbFile), "levelsMin" : "20:95"})
+    assert (len(service.results), service.results.totalBytes) == (1, len(small))
+    service.maxAnswerBytes = len(small) - 1
+    service.query({"db" : os.path.basename(dbFile), "levelsMin" : "10:95"})
+    assert len(service.results) == 1
+    service.pool.close()
+
+def test_pool_evicts_and_reopens(sampleDatabases, tmpdir):
+    pool = covserve.CoverageDBPool(maxOpen = 2)
+    files = [dbFile for name, dbFile in sampleDatabases[:3]]
+    for dbFile in files:
+        pool.get(dbFile)
+    assert pool.handles.keys() == files[1:]
+    # A database replaced by renaming a new file over it is reopened
+    copy = str(tmpdir.join("copy.db"))
+    shutil.copy(files[0], copy)
+    first = pool.get(copy)
+    assert pool.get(copy) is first
+    replacement = str(tmpdir.join("replacement.db"))
+    shutil.copy(files[1], replacement)
+    os.rename(replacement, copy)
+    second = pool.get(copy)
+    assert first[0].regionsource != second[0].regionsource
+    assert second[0].regionsource == pool.get(files[1])[0].regionsource
+    pool.close()
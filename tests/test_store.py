@@ -0,0 +1,75 @@
+import os, json, sqlite3
+import numpy
+
+import coveragekit.covbam as covbam
+import coveragekit.covstore as covstore
+import coveragekit.utils.depthstore as covdepthstore
+from coveragekit.utils.depthstore import DepthStore, runLengths
+
+def _rows(dbFile):
+    return sqlite3.connect(dbFile).execute("SELECT * FROM regions ORDER BY id").fetchall()
+
+def test_run_lengths():
+    ends, depths = runLengths(numpy.array([0, 0, 3, 3, 3, 1, 0], dtype=numpy.int32), 100)
+    assert ends.tolist() == [102, 105, 106, 107]
+    assert depths.tolist() == [0, 3, 1, 0]
+    assert [len(x) for x in runLengths(numpy.zeros(0, dtype=numpy.int32), 5)] == [0, 0]
+
+def test_writer_round_trip(tmpdir):
+    rng = numpy.random.RandomState(1)
+    header = {"SQ" : [{"SN" : "chr1", "LN" : 5000}, {"SN" : "chr2", "LN" : 3000}, {"SN" : "chrM", "LN" : 100}]}
+    depths = {"chr1" : numpy.repeat(rng.randint(0, 40, 400), rng.randint(1, 40, 400))[:4900], "chr2" : rng.randint(0, 3, 3000)}
+    # Chunks cut across runs, added in random order, chr1 stopping short of its length and chrM left without reads
+    chunks = []
+    for chrom, chromDepths in depths.items():
+        cuts = [0] + sorted(rng.choice(numpy.arange(1, len(chromDepths)), 6, replace = False).tolist()) + [len(chromDepths)]
+        chunks.extend((chrom, start, stop) for start, stop in zip(cuts, cuts[1:]))
+    storeFile = str(tmpdir.join("synthetic.ckds"))
+    writer = covdepthstore.DepthStoreWriter(storeFile, header, {"bamSource" : "synthetic.bam"})
+    for i in rng.permutation(len(chunks)).tolist():
+        chrom, start, stop = chunks[i]
+        writer.add(chrom, runLengths(depths[chrom][start:stop], start))
+    writer.close()
+    assert not os.path.exists(storeFile + ".spool")
+
+    depthStore = DepthStore(storeFile)
+    assert depthStore.index["bamSource"] == "synthetic.bam"
+    assert depthStore.depth("chr1", 0, 5000).tolist() == depths["chr1"].tolist() + [0] * 100
+    assert depthStore.depth("2", 1234, 1300).tolist() == depths["chr2"][1234:1300].tolist()
+    assert depthStore.depth("chrM", 0, 100).tolist() == [0] * 100
+    assert depthStore.depth("chr9", 0, 10).tolist() == [0] * 10
+    allDepths = numpy.concatenate((depths["chr1"], numpy.zeros(100, dtype=int), depths["chr2"], numpy.zeros(100, dtype=int)))
+    counts = depthStore.depthCounts()
+    assert counts.tolist() == numpy.bincount(allDepths).tolist()
+
+def test_store_matches_bam_run(sampleData, tmpdir):
+    directory = str(tmpdir)
+    storeFile = os.path.join(directory, "sample.ckds")
+    regions = {"genes" : sampleData["genes"], "panel" : sampleData["panel"]}
+    # Regions cut by the edge of a processing window are stored as two subregions by a bam run, so databases are compared with runs reading
+    # each chromosome as a single window
+    for genome, windowSize, threads, balance in [(False, 7000, 2, True), (True, 7000, 2, True), (False, 1000000, 1, False), (True, 1000000, 1, False)]:
+        bamDatabases = dict((descriptor, os.path.join(directory, "{}.{}.bam.db".format(descriptor, genome))) for descriptor in regions)
+        storeDatabases = dict((descriptor, os.path.join(directory, "{}.{}.store.db".format(descriptor, genome))) for descriptor in regions)
+        bamReport = covbam.bam(sampleData["bam"], regions, bamDatabases, [5, 10, 20], windowSize, threads, 1, False, genome, balance = balance, depthStore = storeFile)
+        storeReport = covstore.store(storeFile, regions, storeDatabases, [5, 10, 20])
+        assert storeReport["regionStats"] == bamReport["regionStats"]
+        if genome:
+            assert json.loads(json.dumps(storeReport["genome"])) == json.loads(json.dumps(bamReport["genome"]))
+        if windowSize < 1000000:
+            continue
+        for descriptor in regions:
+            assert _rows(storeDatabases[descriptor]) == _rows(bamDatabases[descriptor])
+            assert sqlite3.connect(storeDatabases[descriptor]).execute("SELECT * FROM metadata").fetchall() == sqlite3.connect(bamDatabases[descriptor]).execute("SELECT * FROM metadata").fetchall()
+
+def test_depth_lookup(sampleData, tmpdir):
+    storeFile = str(tmpdir.join("sample.ckds"))
+    covbam.bam(sampleData["bam"], {}, {}, [20], 5000, 2, 1, False, True, depthStore = storeFile)
+    depthStore = DepthStore(storeFile)
+    assert depthStore.hasChromosome("chr1") and depthStore.hasChromosome("1") and not depthStore.hasChromosome("chr3")
+    whole = depthStore.depth("chr1", 0, depthStore.chromosomeLength("chr1"))
+    for start, stop in [(0, 10), (19990, 20150), (59990, 60000), (123, 124)]:
+        assert depthStore.depth("1", start, stop).tolist() == whole[start:stop].tolist()
+    assert depthStore.depth("chr1", 59995, 60010).tolist()[5:] == [0] * 10
+    counts = depthStore.depthCounts()
+    assert counts.sum() == sum(length for name, length in [("chr1", 60000), ("chr2", 40000), ("chrUn", 3000)])